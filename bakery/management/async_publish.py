@@ -0,0 +1,274 @@
+"""
+An asyncio engine for the publish management command.
+
+Listing, uploads and batch deletes run as asyncio tasks that share a single
+aiobotocore client, with a semaphore capping how many requests are in flight.
+Suited to builds made up of many small files, where the time spent waiting on
+each request matters more than bandwidth.
+"""
+import os
+import asyncio
+import logging
+from bakery.management.commands import get_s3_connection_kwargs
+from botocore.exceptions import ClientError
+from bakery.management.rate_limit import THROTTLING_ERROR_CODES
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:
+    raise ImportError("aiobotocore must be installed to use django-bakery's async publishing engine")
+logger = logging.getLogger(__name__)
+
+
+class AsyncPublisher(object):
+    """
+    Syncs the build directory with S3 on behalf of the publish command.
+
+    Accepts the publish Command instance, which holds the configured options
+    and keeps the tally of uploaded and deleted files, along with the
+    maximum number of requests to keep in flight.
+    """
+    # S3 accepts up to 1,000 keys in each delete_objects request
+    delete_chunk_size = 1000
+    # How many times to retry keys that couldn't be deleted
+    max_delete_retries = 3
+
+    def __init__(self, command, concurrency):
+        self.command = command
+        self.concurrency = concurrency
+
+    def run(self):
+        """
+        Runs the publish to completion on a new event loop.
+        """
+        asyncio.run(self.publish())
+
+    async def publish(self):
+        """
+        Lists the bucket, compares it with the build directory, then uploads
+        and deletes files.
+        """
+        cmd = self.command
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        session_kwargs, s3_kwargs, config_kwargs = get_s3_connection_kwargs(
+            max_pool_connections=self.concurrency,
+            region_name=cmd.aws_region,
+            endpoint_url=cmd.endpoint_url
+        )
+        session = get_session()
+        async with session.create_client(
+            's3',
+            config=AioConfig(**config_kwargs),
+            **dict(session_kwargs, **s3_kwargs)
+        ) as client:
+            self.client = client
+            cmd.rate_limiter.watch_client(client)
+            cmd.metrics.watch_client(client)
+
+            # Pick up where an interrupted publish left off, if we've been asked to
+            if not cmd.resume_from_journal():
+                await self.compare()
+
+            # Upload everything that's new or changed
+            logger.debug("Uploading {} new or updated files to bucket".format(len(cmd.update_list)))
+            with cmd.metrics.phase('upload'):
+                await self.run_bounded(self.upload, cmd.update_list)
+
+            # Delete anything that's left over
+            if cmd.delete_list:
+                logger.debug("Deleting %s keys" % len(cmd.delete_list))
+                if cmd.verbosity > 0:
+                    cmd.stdout.write("Deleting %s keys" % len(cmd.delete_list))
+                chunks = [
+                    (cmd.delete_list[i:i + self.delete_chunk_size],)
+                    for i in range(0, len(cmd.delete_list), self.delete_chunk_size)
+                ]
+                with cmd.metrics.phase('delete'):
+                    await self.run_bounded(self.delete_chunk, chunks)
+                cmd.deleted_files = len(cmd.deleted_file_list)
+
+    async def compare(self):
+        """
+        Lists the bucket and compares it with the build directory to decide
+        what needs to be uploaded and deleted.
+        """
+        cmd = self.command
+        loop = asyncio.get_running_loop()
+
+        # If we've been handed a list of paths, only look at those ...
+        if cmd.paths is not None:
+            cmd.blind_upload = cmd.force_publish and cmd.no_delete
+            logger.debug("Retrieving {} listed paths".format(len(cmd.paths)))
+            with cmd.metrics.phase('list'):
+                cmd.s3_obj_dict, cmd.local_file_list = await loop.run_in_executor(
+                    None,
+                    cmd.get_scoped_file_lists,
+                    cmd.paths
+                )
+        # ... otherwise look at everything
+        else:
+            # Get a list of all keys in our s3 bucket,
+            # unless we're blindly pushing everything
+            if cmd.force_publish and cmd.no_delete:
+                cmd.blind_upload = True
+                logger.debug("Skipping object retrieval. We won't need to because we're blindly uploading everything.")
+                cmd.s3_obj_dict = cmd.get_bucket_index()
+            else:
+                cmd.blind_upload = False
+                logger.debug("Retrieving objects now published in bucket")
+                with cmd.metrics.phase('list'):
+                    cmd.s3_obj_dict = await self.get_bucket_file_list()
+
+            # Get a list of all the local files in our build directory
+            logger.debug("Retrieving files built locally")
+            with cmd.metrics.phase('walk'):
+                cmd.local_file_list = cmd.get_local_files()
+
+        # Hashing is bound by the disk and CPU rather than the network,
+        # so the comparison stays on the command's pool of threads.
+        cmd.update_list = []
+        logger.debug("Comparing {} local files with {} bucket files".format(
+            len(cmd.local_file_list),
+            len(cmd.s3_obj_dict)
+        ))
+        await loop.run_in_executor(
+            None,
+            cmd.run_pooled,
+            cmd.pooled_compare_local_file,
+            cmd.local_file_list
+        )
+
+        # Write down the plan before changing anything, so it can be resumed
+        cmd.plan_publish()
+
+    async def run_bounded(self, func, arg_list):
+        """
+        Runs the provided coroutine function once for each tuple of arguments
+        in the list, never scheduling more tasks than our concurrency allows.
+
+        The first error raised by a task, if any, is passed along to the caller.
+        """
+        pending = set()
+        for args in arg_list:
+            if len(pending) >= self.concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                [task.result() for task in done]
+            pending.add(asyncio.ensure_future(func(*args)))
+        if pending:
+            done, pending = await asyncio.wait(pending)
+            [task.result() for task in done]
+
+    async def get_bucket_file_list(self):
+        """
+        Handles pagination and returns all objects in the bucket.
+        """
+        cmd = self.command
+        paginator = self.client.get_paginator('list_objects')
+        options = {
+            'Bucket': cmd.aws_bucket_name
+        }
+        if cmd.aws_bucket_prefix:
+            logger.debug("Adding prefix {} to bucket list as a filter".format(cmd.aws_bucket_prefix))
+            options['Prefix'] = cmd.aws_bucket_prefix
+
+        obj_dict = cmd.get_bucket_index()
+        async with self.semaphore:
+            async for page in paginator.paginate(**options):
+                obj_dict.add_page(page, prefix=cmd.aws_bucket_prefix)
+        return obj_dict
+
+    async def upload(self, key, filename):
+        """
+        Uploads the provided file to S3 with the same headers as the
+        thread engine.
+
+        Large files are rare, so they're handed to the command's shared
+        transfer manager rather than reimplementing multipart uploads here.
+        Copies of content already in the bucket go through the command too.
+        """
+        cmd = self.command
+        extra_args = cmd.get_extra_args(filename, key)
+
+        loop = asyncio.get_running_loop()
+        if not cmd.dry_run and not await loop.run_in_executor(
+            None,
+            cmd.copy_in_bucket,
+            key,
+            filename,
+            extra_args
+        ):
+            logger.debug("Uploading %s" % filename)
+            if cmd.verbosity > 0:
+                cmd.stdout.write("Uploading %s" % filename)
+            size = os.path.getsize(filename)
+            if size < cmd.transfer_config.multipart_threshold:
+                with open(filename, 'rb') as f:
+                    body = f.read()
+                async with self.semaphore, cmd.rate_limiter.request(size):
+                    await self.client.put_object(
+                        Bucket=cmd.aws_bucket_name,
+                        Key=cmd.get_s3_key(key),
+                        Body=body,
+                        **extra_args
+                    )
+            else:
+                async with cmd.rate_limiter.request():
+                    future = cmd.transfer_manager.upload(
+                        filename,
+                        cmd.aws_bucket_name,
+                        cmd.get_s3_key(key),
+                        extra_args=extra_args,
+                        subscribers=[cmd.rate_limiter.get_transfer_subscriber()]
+                    )
+                    await loop.run_in_executor(None, future.result)
+            cmd.metrics.add('bytes_uploaded', size)
+
+        # Update counts
+        with cmd.lock:
+            cmd.uploaded_files += 1
+            cmd.uploaded_file_list.append(filename)
+            cmd.uploads[key] = extra_args
+        if cmd.journal:
+            cmd.journal.record_upload(key)
+
+    async def delete_chunk(self, keys):
+        """
+        Deletes the provided list of keys with a single request.
+
+        Keys S3 reports it could not delete, and chunks whose request failed,
+        are retried with the same backoff as batch_delete_s3_objects.
+        """
+        cmd = self.command
+        for attempt in range(self.max_delete_retries + 1):
+            if attempt:
+                logger.debug("Retrying deletion of {} keys".format(len(keys)))
+                await asyncio.sleep(0.1 * 2 ** attempt)
+            try:
+                async with self.semaphore, cmd.rate_limiter.request():
+                    response = await self.client.delete_objects(
+                        Bucket=cmd.aws_bucket_name,
+                        Delete={
+                            'Objects': [{'Key': cmd.get_s3_key(key)} for key in keys],
+                            'Quiet': True
+                        }
+                    )
+            except ClientError as e:
+                # Retry the whole chunk if the request itself failed
+                if attempt == self.max_delete_retries:
+                    raise
+                logger.debug("Deleting {} keys failed: {}".format(len(keys), e))
+                continue
+            errors = response.get('Errors', [])
+            if any(e.get('Code') in THROTTLING_ERROR_CODES for e in errors):
+                cmd.rate_limiter.throttled()
+            # Errors come back with the bucket's keys, so take the prefix off
+            failed = [e.get('Key')[len(cmd.aws_bucket_prefix):] for e in errors]
+            if len(failed) < len(keys):
+                failed_keys = set(failed)
+                cmd.record_deletes([key for key in keys if key not in failed_keys])
+            if not errors:
+                return
+            keys = failed
+        for error in errors:
+            logger.error("Could not delete {}: {}".format(error.get('Key'), error.get('Message')))
@@ -0,0 +1,258 @@
+"""
+A compact index of the objects in an S3 bucket.
+
+Publishing only needs to know the ETag and size of each key, so rather than
+holding on to the full dict boto returns for every object, each key is mapped
+to a small packed record. Very large buckets can spill the index to SQLite.
+
+The index also remembers which key holds each piece of content, so files
+that already exist in the bucket under another key can be copied there
+rather than uploaded again.
+"""
+import os
+import sys
+import struct
+import sqlite3
+import binascii
+import logging
+import tempfile
+import threading
+from collections import namedtuple
+logger = logging.getLogger(__name__)
+
+# The md5 digest from the ETag, the number of parts for multipart uploads
+# (zero otherwise) and the size of the object in bytes.
+RECORD = struct.Struct('<16sIQ')
+
+# An object in the bucket, as handed back by the index
+RemoteObject = namedtuple('RemoteObject', ['etag', 'size'])
+
+
+def pack_record(etag, size):
+    """
+    Packs the provided ETag and size into a fixed-size record.
+
+    Returns None if the ETag isn't an md5 digest, as is the case for some
+    encrypted objects and S3-compatible services.
+    """
+    etag = etag.strip('"').strip("'")
+    digest, _, parts = etag.partition('-')
+    if len(digest) != 32:
+        return None
+    try:
+        return RECORD.pack(binascii.unhexlify(digest), int(parts or 0), size or 0)
+    except (binascii.Error, ValueError, struct.error):
+        return None
+
+
+def unpack_record(record):
+    """
+    Unpacks a record into a RemoteObject.
+    """
+    digest, parts, size = RECORD.unpack(record)
+    etag = binascii.hexlify(digest).decode('ascii')
+    if parts:
+        etag = "{}-{}".format(etag, parts)
+    return RemoteObject(etag, size)
+
+
+class BucketIndex(object):
+    """
+    Maps the keys in a bucket to their ETag and size.
+
+    Keys are interned, and everything else is packed into a 28-byte record.
+    If a spill threshold is provided, the index moves itself to a temporary
+    SQLite database once it holds that many keys.
+
+    Objects uploaded in a single part are also indexed by their content,
+    which is left in place when their key is popped, since the object
+    stays in the bucket until it's deleted.
+
+    The index is safe to use from multiple threads.
+    """
+    def __init__(self, spill_threshold=None):
+        self.spill_threshold = spill_threshold
+        self.lock = threading.Lock()
+        self.records = {}
+        # ETags we couldn't pack are kept as they came
+        self.other_etags = {}
+        # The key holding each piece of content, and the sizes among them
+        self.contents = {}
+        self.sizes = set()
+        self.db = None
+        self.db_path = None
+
+    def add(self, key, etag, size):
+        """
+        Adds an object to the index.
+        """
+        key = sys.intern(key)
+        record = pack_record(etag, size)
+        # Only single-part uploads can be matched with a local file's md5
+        has_content = record is not None and RECORD.unpack(record)[1] == 0
+        with self.lock:
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+                    (key, record, None if record else etag.strip('"').strip("'"), size)
+                )
+                if has_content:
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO contents VALUES (?, ?, ?)",
+                        (record, key, size)
+                    )
+                return
+            if has_content:
+                self.contents[record] = key
+                self.sizes.add(size)
+            if record is None:
+                self.other_etags[key] = (etag.strip('"').strip("'"), size)
+                self.records.pop(key, None)
+            else:
+                self.records[key] = record
+                self.other_etags.pop(key, None)
+            if self.spill_threshold and len(self.records) + len(self.other_etags) >= self.spill_threshold:
+                self.spill()
+
+    def add_page(self, page, prefix=''):
+        """
+        Adds every object in a page of results from list_objects
+        or list_objects_v2.
+
+        If a prefix is provided, it's taken off each key, and keys
+        that don't start with it are skipped.
+        """
+        key_list = page.get('Contents', [])
+        logger.debug("Indexing page with {} keys".format(len(key_list)))
+        for obj in key_list:
+            key = obj.get('Key')
+            if prefix:
+                if not key.startswith(prefix):
+                    continue
+                key = key[len(prefix):]
+            self.add(key, obj.get('ETag', ''), obj.get('Size'))
+
+    def spill(self):
+        """
+        Moves the index out of memory into a temporary SQLite database.
+
+        Expects to be called while holding the lock.
+        """
+        fd, self.db_path = tempfile.mkstemp(prefix='bakery-index-', suffix='.sqlite3')
+        os.close(fd)
+        logger.debug("Spilling index of {} keys to {}".format(
+            len(self.records) + len(self.other_etags),
+            self.db_path
+        ))
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute(
+            "CREATE TABLE objects (key TEXT PRIMARY KEY, record BLOB, etag TEXT, size INTEGER)"
+        )
+        self.db.execute(
+            "CREATE TABLE contents (record BLOB PRIMARY KEY, key TEXT, size INTEGER)"
+        )
+        self.db.execute("CREATE INDEX contents_size ON contents (size)")
+        self.db.execute("BEGIN")
+        self.db.executemany(
+            "INSERT INTO objects VALUES (?, ?, NULL, NULL)",
+            self.records.items()
+        )
+        self.db.executemany(
+            "INSERT INTO objects VALUES (?, NULL, ?, ?)",
+            ((k, etag, size) for k, (etag, size) in self.other_etags.items())
+        )
+        self.db.executemany(
+            "INSERT INTO contents VALUES (?, ?, ?)",
+            ((record, k, RECORD.unpack(record)[2]) for record, k in self.contents.items())
+        )
+        self.db.execute("COMMIT")
+        self.records = {}
+        self.other_etags = {}
+        self.contents = {}
+        self.sizes = set()
+
+    def pop(self, key, default=None):
+        """
+        Removes the provided key from the index and returns its RemoteObject,
+        or the default if it isn't there.
+        """
+        with self.lock:
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT record, etag, size FROM objects WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return default
+                self.db.execute("DELETE FROM objects WHERE key = ?", (key,))
+                record, etag, size = row
+            else:
+                record = self.records.pop(key, None)
+                if record is None:
+                    if key not in self.other_etags:
+                        return default
+                    etag, size = self.other_etags.pop(key)
+        if record is not None:
+            return unpack_record(record)
+        return RemoteObject(etag, size)
+
+    def has_size(self, size):
+        """
+        Returns True if any object indexed by its content has the provided size.
+
+        It's a cheap check to make before hashing a file to look it up.
+        """
+        with self.lock:
+            if self.db is not None:
+                return self.db.execute(
+                    "SELECT 1 FROM contents WHERE size = ? LIMIT 1", (size,)
+                ).fetchone() is not None
+            return size in self.sizes
+
+    def find_content(self, md5, size):
+        """
+        Returns a key in the bucket with the provided md5 and size,
+        or None if there isn't one.
+        """
+        record = pack_record(md5, size)
+        if record is None:
+            return None
+        with self.lock:
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT key FROM contents WHERE record = ?", (record,)
+                ).fetchone()
+                return row[0] if row else None
+            return self.contents.get(record)
+
+    def keys(self):
+        """
+        Returns a list of every key in the index.
+        """
+        with self.lock:
+            if self.db is not None:
+                return [row[0] for row in self.db.execute("SELECT key FROM objects")]
+            return list(self.records) + list(self.other_etags)
+
+    def __contains__(self, key):
+        with self.lock:
+            if self.db is not None:
+                return self.db.execute("SELECT 1 FROM objects WHERE key = ?", (key,)).fetchone() is not None
+            return key in self.records or key in self.other_etags
+
+    def __len__(self):
+        with self.lock:
+            if self.db is not None:
+                return self.db.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+            return len(self.records) + len(self.other_etags)
+
+    def close(self):
+        """
+        Removes the SQLite database, if the index was spilled to one.
+        """
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+                os.remove(self.db_path)
@@ -1,15 +1,37 @@
+import os
+import time
 import boto3
 import logging
+import threading
+from itertools import islice
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from bakery.management.rate_limit import THROTTLING_ERROR_CODES
 logger = logging.getLogger(__name__)
 
+# boto3's default session isn't safe to set up from several threads at once
+_client_lock = threading.Lock()
 
-def get_s3_client():
+
+def get_s3_connection_kwargs(
+        max_pool_connections=None,
+        retry_mode=None,
+        max_attempts=None,
+        region_name=None,
+        endpoint_url=None
+):
     """
-    A DRY place to make sure AWS credentials in settings override
-    environment based credentials.  Boto3 will fall back to:
-    http://boto3.readthedocs.io/en/latest/guide/configuration.html
+    Returns the session, client and client config keyword arguments
+    for connecting to S3, as drawn from the settings.
+
+    Shared by get_s3_client and the async publishing engine so they
+    always connect with the same credentials and endpoint. A region
+    and endpoint can be passed in to override the settings.
     """
     session_kwargs = {}
     if hasattr(settings, 'AWS_ACCESS_KEY_ID'):
@@ -17,7 +39,6 @@ def get_s3_client():
 
     if hasattr(settings, 'AWS_SECRET_ACCESS_KEY'):
         session_kwargs['aws_secret_access_key'] = settings.AWS_SECRET_ACCESS_KEY
-    boto3.setup_default_session(**session_kwargs)
 
     s3_kwargs = {}
     if hasattr(settings, 'AWS_S3_ENDPOINT'):
@@ -33,11 +54,145 @@ def get_s3_client():
         )
     if hasattr(settings, "AWS_REGION"):
         s3_kwargs['region_name'] = settings.AWS_REGION
-    s3_client = boto3.client('s3', **s3_kwargs)
-    s3_resource = boto3.resource('s3', **s3_kwargs)
+    if endpoint_url:
+        s3_kwargs['endpoint_url'] = endpoint_url
+    if region_name:
+        s3_kwargs['region_name'] = region_name
+
+    config_kwargs = {}
+    if max_pool_connections is None:
+        max_pool_connections = getattr(settings, 'AWS_S3_MAX_POOL_CONNECTIONS', None)
+    if max_pool_connections:
+        config_kwargs['max_pool_connections'] = max_pool_connections
+    retries = {}
+    if retry_mode is None:
+        retry_mode = getattr(settings, 'AWS_S3_RETRY_MODE', None)
+    if retry_mode:
+        retries['mode'] = retry_mode
+    if max_attempts is None:
+        max_attempts = getattr(settings, 'AWS_S3_MAX_ATTEMPTS', None)
+    if max_attempts:
+        retries['max_attempts'] = max_attempts
+    if retries:
+        config_kwargs['retries'] = retries
+
+    return session_kwargs, s3_kwargs, config_kwargs
+
+
+def get_s3_client(
+        max_pool_connections=None,
+        retry_mode=None,
+        max_attempts=None,
+        region_name=None,
+        endpoint_url=None
+):
+    """
+    A DRY place to make sure AWS credentials in settings override
+    environment based credentials.  Boto3 will fall back to:
+    http://boto3.readthedocs.io/en/latest/guide/configuration.html
+
+    The size of the connection pool and the retry behavior can be passed in
+    as arguments, or set with AWS_S3_MAX_POOL_CONNECTIONS, AWS_S3_RETRY_MODE
+    and AWS_S3_MAX_ATTEMPTS in settings. So can the region and endpoint.
+    Arguments win over settings.
+    """
+    session_kwargs, s3_kwargs, config_kwargs = get_s3_connection_kwargs(
+        max_pool_connections=max_pool_connections,
+        retry_mode=retry_mode,
+        max_attempts=max_attempts,
+        region_name=region_name,
+        endpoint_url=endpoint_url
+    )
+    if config_kwargs:
+        s3_kwargs['config'] = Config(**config_kwargs)
+
+    with _client_lock:
+        boto3.setup_default_session(**session_kwargs)
+        s3_client = boto3.client('s3', **s3_kwargs)
+        s3_resource = boto3.resource('s3', **s3_kwargs)
     return s3_client, s3_resource
 
 
+def get_transfer_config(**kwargs):
+    """
+    Returns the TransferConfig used to upload large files to S3.
+
+    The multipart threshold, the multipart chunk size and the number of
+    threads used by each transfer can be passed in as keyword arguments,
+    or set with AWS_S3_MULTIPART_THRESHOLD, AWS_S3_MULTIPART_CHUNKSIZE and
+    AWS_S3_MAX_CONCURRENCY in settings. Otherwise boto's defaults are used.
+    """
+    setting_map = (
+        ('multipart_threshold', 'AWS_S3_MULTIPART_THRESHOLD'),
+        ('multipart_chunksize', 'AWS_S3_MULTIPART_CHUNKSIZE'),
+        ('max_concurrency', 'AWS_S3_MAX_CONCURRENCY'),
+    )
+    for kwarg, setting in setting_map:
+        if kwargs.get(kwarg) is None and hasattr(settings, setting):
+            kwargs[kwarg] = getattr(settings, setting)
+    return TransferConfig(**dict((k, v) for k, v in kwargs.items() if v is not None))
+
+
+def get_transfer_manager(s3_client, transfer_config=None):
+    """
+    Returns a TransferManager that can be shared by every upload in a run.
+
+    It should be shut down by the caller once all transfers are complete.
+    """
+    if transfer_config is None:
+        transfer_config = get_transfer_config()
+    return create_transfer_manager(s3_client, transfer_config)
+
+
+# A file found in the build directory, with the stats we need to publish it
+LocalFile = namedtuple('LocalFile', ['key', 'size', 'mtime_ns'])
+
+
+def iter_directory(root, workers=8):
+    """
+    Walks the provided directory and yields a LocalFile for every file
+    inside it, keyed by its path relative to the root with forward slashes.
+
+    Each directory is scanned as its own task on a pool of threads,
+    so subtrees are walked in parallel, and files are yielded as soon as
+    their directory has been scanned. Like os.walk, symlinks to
+    directories are not followed.
+    """
+    root = str(root)
+
+    def scan(dirpath, prefix):
+        files = []
+        subdirs = []
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append((entry.path, prefix + entry.name + '/'))
+                elif entry.is_file():
+                    st = entry.stat()
+                    files.append(LocalFile(prefix + entry.name, st.st_size, st.st_mtime_ns))
+        return files, subdirs
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set([executor.submit(scan, root, '')])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                for args in subdirs:
+                    pending.add(executor.submit(scan, *args))
+                for f in files:
+                    yield f
+
+
+def scan_directory(root, workers=8):
+    """
+    Walks the provided directory and returns a list with a LocalFile
+    for every file inside it. See iter_directory.
+    """
+    return list(iter_directory(root, workers=workers))
+
+
 def get_bucket_page(page):
     """
     Returns all the keys in a s3 bucket paginator page.
@@ -74,29 +229,122 @@ def get_all_objects_in_bucket(
     return obj_dict
 
 
+def iter_keys_in_bucket(aws_bucket_name, prefix=None, s3_client=None):
+    """
+    Yields the key of every object in the given bucket, optionally limited
+    to those starting with a prefix.
+
+    Keys are yielded as each page of the listing arrives, so memory use
+    stays flat no matter how large the bucket is.
+    """
+    if s3_client is None:
+        s3_client, s3_resource = get_s3_client()
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    options = {
+        'Bucket': aws_bucket_name
+    }
+    if prefix:
+        options['Prefix'] = prefix
+    for page in paginator.paginate(**options):
+        key_list = page.get('Contents', [])
+        logger.debug("Loading page with {} keys".format(len(key_list)))
+        for obj in key_list:
+            yield obj.get('Key')
+
+
 def batch_delete_s3_objects(
         keys,
         aws_bucket_name,
-        chunk_size=100,
-        s3_client=None
+        chunk_size=1000,
+        s3_client=None,
+        workers=10,
+        max_retries=3,
+        callback=None,
+        rate_limiter=None,
+        prefix=''
 ):
     """
     Utility method that batch deletes objects in given bucket.
+
+    Accepts any iterable of keys, including a generator, and reads it one
+    chunk at a time so the full list never needs to be held in memory.
+    Chunks are deleted concurrently by a pool of threads. Keys S3 reports
+    it could not delete, and chunks whose request failed, are retried.
+
+    If provided, the callback is called with the list of keys
+    deleted by each chunk, from the thread that deleted them.
+
+    If a RateLimiter is provided, each request waits for its turn with it,
+    and keys S3 refused to delete because it was throttling count against it.
+
+    If a prefix is provided, it's added to each key before it's deleted,
+    and the callback is passed the keys without it.
+
+    Returns the number of keys deleted.
     """
     if s3_client is None:
-        s3_client, s3_resource = get_s3_client()
+        s3_client, s3_resource = get_s3_client(max_pool_connections=workers)
 
-    key_chunks = []
-    for i in range(0, len(keys), chunk_size):
-        chunk = []
-        for key in (list(keys)[i:i+100]):
-            chunk.append({'Key': key})
-        key_chunks.append(chunk)
-    for chunk in key_chunks:
-        s3_client.delete_objects(
-            Bucket=aws_bucket_name,
-            Delete={'Objects': chunk}
-        )
+    # S3 won't take more than 1,000 keys in a single request
+    chunk_size = min(chunk_size, 1000)
+
+    def delete_chunk(chunk):
+        for attempt in range(max_retries + 1):
+            if attempt:
+                logger.debug("Retrying deletion of {} keys".format(len(chunk)))
+                time.sleep(0.1 * 2 ** attempt)
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            try:
+                response = s3_client.delete_objects(
+                    Bucket=aws_bucket_name,
+                    Delete={
+                        'Objects': [{'Key': prefix + key} for key in chunk],
+                        'Quiet': True
+                    }
+                )
+            except ClientError as e:
+                # Retry the whole chunk if the request itself failed
+                if attempt == max_retries:
+                    raise
+                logger.debug("Deleting {} keys failed: {}".format(len(chunk), e))
+                continue
+            finally:
+                if rate_limiter is not None:
+                    rate_limiter.release()
+            errors = response.get('Errors', [])
+            if rate_limiter is not None and any(e.get('Code') in THROTTLING_ERROR_CODES for e in errors):
+                rate_limiter.throttled()
+            # Errors come back with the bucket's keys, so take the prefix off
+            failed = [e.get('Key')[len(prefix):] for e in errors]
+            if callback is not None and len(failed) < len(chunk):
+                failed_keys = set(failed)
+                callback([key for key in chunk if key not in failed_keys])
+            if not errors:
+                return
+            chunk = failed
+        for e in errors:
+            logger.error("Could not delete {}: {}".format(e.get('Key'), e.get('Message')))
+        return errors
+
+    deleted = 0
+    key_iterator = iter(keys)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        while True:
+            chunk = list(islice(key_iterator, chunk_size))
+            if chunk:
+                futures[executor.submit(delete_chunk, chunk)] = len(chunk)
+            # Don't read further ahead than the pool can keep up with
+            if futures and (len(futures) >= workers * 2 or not chunk):
+                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    errors = future.result()
+                    deleted += futures.pop(future) - len(errors or [])
+            if not chunk and not futures:
+                break
+    return deleted
 
 
 class BasePublishCommand(BaseCommand):
@@ -105,11 +353,14 @@ class BasePublishCommand(BaseCommand):
     Commands that need them.
     """
 
-    def get_s3_client(self):
-        return get_s3_client()
+    def get_s3_client(self, *args, **kwargs):
+        return get_s3_client(*args, **kwargs)
 
     def get_all_objects_in_bucket(self, *args, **kwargs):
         return get_all_objects_in_bucket(*args, **kwargs)
 
+    def iter_keys_in_bucket(self, *args, **kwargs):
+        return iter_keys_in_bucket(*args, **kwargs)
+
     def batch_delete_s3_objects(self, *args, **kwargs):
         return batch_delete_s3_objects(*args, **kwargs)
@@ -4,11 +4,17 @@ from __future__ import unicode_literals
 
 # Env
 import os
+import re
 import sys
 import six
+import json
+import time
+import threading
+from contextlib import ExitStack, contextmanager, nullcontext
 
 # Files
 import gzip
+import zlib
 import mimetypes
 from bakery import DEFAULT_GZIP_CONTENT_TYPES
 
@@ -16,6 +22,7 @@ from bakery import DEFAULT_GZIP_CONTENT_TYPES
 from fs import path
 from fs import copy
 from django.utils.encoding import smart_str
+from bakery.views.base import record_path, record_directory, record_build_paths, build_database
 
 # Pooling
 import multiprocessing
@@ -25,6 +32,7 @@ from multiprocessing.pool import ThreadPool
 from django.apps import apps
 from django.conf import settings
 from django.core import management
+from django.db import connections
 try:
     from django.core.urlresolvers import get_callable
 except ImportError:
@@ -37,10 +45,86 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def get_shard(key, count):
+    """
+    Returns which of count shards the provided key belongs to.
+
+    The key's crc32 is used rather than Python's hash, which changes
+    between processes, so every machine agrees on the split.
+    """
+    return zlib.crc32(smart_str(key).encode('utf-8')) % count
+
+
+class QueryLimiter(object):
+    """
+    Holds queries to the provided rate with a token bucket, allowing up
+    to a second's worth in a burst.
+
+    The limiter is safe to use from multiple threads.
+    """
+    def __init__(self, queries_per_second):
+        self.queries_per_second = queries_per_second
+        self.tokens = float(queries_per_second)
+        self.last_fill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def delay(self):
+        """
+        Takes a query from the bucket and returns 0 if it can run now.
+        Otherwise returns how many seconds to wait before asking again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                float(self.queries_per_second),
+                self.tokens + (now - self.last_fill) * self.queries_per_second
+            )
+            self.last_fill = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.queries_per_second
+            self.tokens -= 1
+            return 0
+
+    def acquire(self):
+        """
+        Blocks until a query can run.
+        """
+        while True:
+            wait = self.delay()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+@contextmanager
+def limit_queries(limiter):
+    """
+    Holds every query made in this thread inside the block to the provided
+    QueryLimiter.
+
+    Does nothing if there's no limiter.
+    """
+    if limiter is None:
+        yield
+        return
+
+    def wrapper(execute, sql, params, many, context):
+        limiter.acquire()
+        return execute(sql, params, many, context)
+
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(wrapper))
+        yield
+
+
 class Command(BaseCommand):
     help = 'Bake out a site as flat files in the build directory'
     build_unconfig_msg = "Build directory unconfigured. Set BUILD_DIR in settings.py or provide it with --build-dir"
     views_unconfig_msg = "Bakery views unconfigured. Set BAKERY_VIEWS in settings.py or provide a list as arguments."
+    shard_invalid_msg = "Shard must be given as i/N, where i is between 1 and N"
+    database_invalid_msg = "Database %s is not in the DATABASES setting"
+    query_limit_invalid_msg = "The query limit must be greater than zero"
     # regex to match against for gzipping. CSS, JS, JSON, HTML, etc.
     gzip_file_match = getattr(
         settings,
@@ -86,6 +170,38 @@ Will use settings.BUILD_DIR by default."
             default=False,
             help=("Pool builds to run concurrently rather than running them one by one.")
         )
+        parser.add_argument(
+            "--shard",
+            action="store",
+            dest="shard",
+            default='',
+            help=("Build only one of N slices of the site, given as i/N. \
+Views, detail pages and static and media files are split the same way on every machine.")
+        )
+        parser.add_argument(
+            "--manifest",
+            action="store",
+            dest="manifest",
+            default='',
+            help=("Write a JSON list of the files built, relative to the build directory, to this path.")
+        )
+        parser.add_argument(
+            "--database",
+            action="store",
+            dest="database",
+            default='',
+            help=("The alias of the database the views read from, like a replica. \
+Will use settings.BAKERY_DATABASE, or Django's routers, by default.")
+        )
+        parser.add_argument(
+            "--max-queries-per-second",
+            action="store",
+            dest="max_queries_per_second",
+            type=float,
+            default=None,
+            help=("The most database queries the build may make each second. \
+Will use settings.BAKERY_BUILD_MAX_QUERIES_PER_SECOND by default.")
+        )
 
     def handle(self, *args, **options):
         """
@@ -100,16 +216,23 @@ Will use settings.BUILD_DIR by default."
         if not options.get("keep_build_dir"):
             self.init_build_dir()
 
-        # Build up static files
-        if not options.get("skip_static"):
-            self.build_static()
+        # Only keep track of the files built if we've been asked for a manifest
+        manifest = options.get("manifest")
+        with record_build_paths() if manifest else nullcontext(set()) as paths, \
+                build_database(self.database), limit_queries(self.query_limiter):
+            # Build up static files
+            if not options.get("skip_static"):
+                self.build_static()
+
+            # Build the media directory
+            if not options.get("skip_media"):
+                self.build_media()
 
-        # Build the media directory
-        if not options.get("skip_media"):
-            self.build_media()
+            # Build views
+            self.build_views()
 
-        # Build views
-        self.build_views()
+        if manifest:
+            self.write_manifest(manifest, paths)
 
         # Close out
         logger.info("Build finished")
@@ -154,6 +277,55 @@ Will use settings.BUILD_DIR by default."
         # Are we pooling?
         self.pooling = options.get('pooling')
 
+        # Which database are the views reading from?
+        self.database = options.get('database') or getattr(settings, 'BAKERY_DATABASE', None)
+        if self.database and self.database not in connections.databases:
+            raise CommandError(self.database_invalid_msg % self.database)
+
+        # How hard can the build lean on the database?
+        queries_per_second = options.get('max_queries_per_second')
+        if queries_per_second is None:
+            queries_per_second = getattr(settings, 'BAKERY_BUILD_MAX_QUERIES_PER_SECOND', None)
+        self.query_limiter = self.get_query_limiter(queries_per_second)
+
+        # Are we only building one slice of the site?
+        self.shard = None
+        if options.get('shard'):
+            self.shard = self.parse_shard(options['shard'])
+
+    def parse_shard(self, value):
+        """
+        Parses a shard given as i/N, counting from one, into a zero-based
+        (index, count) pair.
+        """
+        match = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', smart_str(value))
+        if not match:
+            raise CommandError(self.shard_invalid_msg)
+        number, count = int(match.group(1)), int(match.group(2))
+        if not 1 <= number <= count:
+            raise CommandError(self.shard_invalid_msg)
+        return (number - 1, count)
+
+    def get_query_limiter(self, queries_per_second):
+        """
+        Returns a QueryLimiter that holds the build's queries to the provided
+        rate, or None if it isn't set.
+        """
+        if queries_per_second is None:
+            return None
+        if queries_per_second <= 0:
+            raise CommandError(self.query_limit_invalid_msg)
+        logger.debug("Limiting the build to {} queries a second".format(queries_per_second))
+        return QueryLimiter(queries_per_second)
+
+    def write_manifest(self, manifest_path, paths):
+        """
+        Writes the provided paths to a JSON file, as a sorted list.
+        """
+        logger.debug("Writing manifest of {} files to {}".format(len(paths), manifest_path))
+        with open(manifest_path, 'w') as f:
+            json.dump(sorted(paths), f, indent=2)
+
     def init_build_dir(self):
         """
         Clear out the build directory and create a new one.
@@ -188,13 +360,17 @@ Will use settings.BUILD_DIR by default."
         target_dir = smart_str(target_dir)
 
         if os.path.exists(self.static_root) and settings.STATIC_URL:
-            if getattr(settings, 'BAKERY_GZIP', False):
+            if self.shard is not None:
+                self.copytree_shard(self.static_root, target_dir, getattr(settings, 'BAKERY_GZIP', False))
+            elif getattr(settings, 'BAKERY_GZIP', False):
                 self.copytree_and_gzip(self.static_root, target_dir)
             # if gzip isn't enabled, just copy the tree straight over
             else:
                 logger.debug("Copying {}{} to {}{}".format("osfs://", self.static_root, self.fs_name, target_dir))
                 copy.copy_dir("osfs:///", self.static_root, self.fs, target_dir)
 
+            record_directory(self.fs, target_dir)
+
         # If they exist in the static directory, copy the robots.txt
         # and favicon.ico files down to the root so they will work
         # on the live website.
@@ -203,12 +379,14 @@ Will use settings.BUILD_DIR by default."
             robots_target = path.join(self.build_dir, 'robots.txt')
             logger.debug("Copying {}{} to {}{}".format(self.fs_name, robots_src, self.fs_name, robots_target))
             self.fs.copy(robots_src, robots_target)
+            record_path(robots_target)
 
         favicon_src = path.join(target_dir, 'favicon.ico')
         if self.fs.exists(favicon_src):
             favicon_target = path.join(self.build_dir, 'favicon.ico')
             logger.debug("Copying {}{} to {}{}".format(self.fs_name, favicon_src, self.fs_name, favicon_target))
             self.fs.copy(favicon_src, favicon_target)
+            record_path(favicon_target)
 
     def build_media(self):
         """
@@ -220,7 +398,11 @@ Will use settings.BUILD_DIR by default."
         if os.path.exists(self.media_root) and settings.MEDIA_URL:
             target_dir = path.join(self.fs_name, self.build_dir, settings.MEDIA_URL.lstrip('/'))
             logger.debug("Copying {}{} to {}{}".format("osfs://", self.media_root, self.fs_name, target_dir))
-            copy.copy_dir("osfs:///", smart_str(self.media_root), self.fs, smart_str(target_dir))
+            if self.shard is not None:
+                self.copytree_shard(smart_str(self.media_root), smart_str(target_dir))
+            else:
+                copy.copy_dir("osfs:///", smart_str(self.media_root), self.fs, smart_str(target_dir))
+            record_directory(self.fs, target_dir)
 
     def get_view_instance(self, view):
         """
@@ -234,11 +416,77 @@ Will use settings.BUILD_DIR by default."
         """
         # Then loop through and run them all
         for view_str in self.view_list:
-            logger.debug("Building %s" % view_str)
-            if self.verbosity > 1:
-                self.stdout.write("Building %s" % view_str)
-            view = get_callable(view_str)
-            self.get_view_instance(view).build_method()
+            self.build_view(view_str, self.shard)
+
+    def build_view(self, view_str, shard=None):
+        """
+        Bake out the provided buildable view.
+
+        If a shard is provided as an (index, count) pair, detail views only
+        build the objects whose primary key falls in it. Other views, and
+        detail views that change how their queryset is built, are only built
+        whole by the shard their name falls in.
+        """
+        from bakery.views import BuildableDetailView
+        view = get_callable(view_str)
+        if shard is not None:
+            index, count = shard
+            split = issubclass(view, BuildableDetailView) and (
+                view.build_method is BuildableDetailView.build_method and
+                view.build_queryset is BuildableDetailView.build_queryset
+            )
+            if not split and get_shard(view_str, count) != index:
+                logger.debug("Skipping %s, which belongs to another shard" % view_str)
+                return
+        logger.debug("Building %s" % view_str)
+        if self.verbosity > 1:
+            self.stdout.write("Building %s" % view_str)
+        instance = self.get_view_instance(view)
+        if shard is not None and split:
+            self.build_queryset_shard(instance, index, count)
+        else:
+            instance.build_method()
+
+    def build_queryset_shard(self, instance, index, count, chunk_size=2000):
+        """
+        Builds the objects in the provided detail view's queryset whose
+        primary key falls in the shard.
+
+        Only the primary keys are read to split the queryset, then the
+        objects in the shard are loaded chunk_size at a time.
+        """
+        queryset = instance.get_queryset()
+        pk_list = [
+            pk for pk in queryset.values_list('pk', flat=True).iterator()
+            if get_shard(pk, count) == index
+        ]
+        for i in range(0, len(pk_list), chunk_size):
+            for obj in queryset.filter(pk__in=pk_list[i:i + chunk_size]):
+                instance.build_object(obj)
+
+    def copytree_shard(self, source_dir, target_dir, gzip=False):
+        """
+        Copies the files in the provided source directory that belong to
+        this command's shard, by their path, to the target directory.
+
+        Gzips them along the way if asked to.
+        """
+        index, count = self.shard
+        for (dirpath, dirnames, filenames) in os.walk(source_dir):
+            for f in filenames:
+                source_path = os.path.join(dirpath, f)
+                # Hash the path the same way on every operating system
+                rel_path = os.path.relpath(source_path, source_dir).replace(os.sep, '/')
+                if get_shard(rel_path, count) != index:
+                    continue
+                target_path = path.join(target_dir, rel_path)
+                if gzip:
+                    self.copyfile_and_gzip(source_path, target_path)
+                else:
+                    target_subdir = path.dirname(target_path)
+                    if not self.fs.exists(target_subdir):
+                        self.fs.makedirs(target_subdir)
+                    copy.copy_file("osfs:///", smart_str(source_path), self.fs, smart_str(target_path))
 
     def copytree_and_gzip(self, source_dir, target_dir):
         """
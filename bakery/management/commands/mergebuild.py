@@ -0,0 +1,150 @@
+import json
+import logging
+from fs import path
+from django.apps import apps
+from django.conf import settings
+from django.core import management
+from django.utils.encoding import smart_str
+from django.core.management.base import BaseCommand, CommandError
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Merges the build directories made by build --shard into one"
+    build_unconfig_msg = "Build directory unconfigured. Set BUILD_DIR in settings.py or provide it with --build-dir"
+    conflict_msg = "%s was built by more than one shard"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'shard_dirs',
+            nargs='+',
+            type=str,
+            help="The build directories of each shard."
+        )
+        parser.add_argument(
+            "--build-dir",
+            action="store",
+            dest="build_dir",
+            default='',
+            help="Specify the path of the build directory to merge into. \
+Will use settings.BUILD_DIR by default."
+        )
+        parser.add_argument(
+            "--manifest",
+            action="append",
+            dest="manifests",
+            default=[],
+            help="The manifest written by a shard's build. Only the files it lists are merged \
+from the shard directory in the same position. Can be given once for each shard."
+        )
+        parser.add_argument(
+            "--merged-manifest",
+            action="store",
+            dest="merged_manifest",
+            default='',
+            help="Write a JSON list of every file merged to this path."
+        )
+        parser.add_argument(
+            "--keep-build-dir",
+            action="store_true",
+            dest="keep_build_dir",
+            default=False,
+            help="Skip clearing out the build directory before merging files into it."
+        )
+        parser.add_argument(
+            "--publish",
+            action="store_true",
+            dest="publish",
+            default=False,
+            help="Publish the merged build directory once it's ready."
+        )
+
+    def handle(self, *args, **options):
+        """
+        Copies every shard's files into the build directory, then
+        publishes it if asked to.
+        """
+        self.verbosity = int(options.get('verbosity', 1))
+        if options.get("build_dir"):
+            self.build_dir = smart_str(options["build_dir"])
+            settings.BUILD_DIR = self.build_dir
+        else:
+            if not hasattr(settings, 'BUILD_DIR'):
+                raise CommandError(self.build_unconfig_msg)
+            self.build_dir = smart_str(settings.BUILD_DIR)
+        self.fs = apps.get_app_config("bakery").filesystem
+
+        manifests = options.get('manifests') or []
+        if manifests and len(manifests) != len(options['shard_dirs']):
+            raise CommandError("Provide a manifest for every shard directory, or none at all")
+
+        # Settle where every file comes from before anything is copied,
+        # so a conflict doesn't leave a half-merged build directory behind
+        merged = {}
+        for i, shard_dir in enumerate(options['shard_dirs']):
+            shard_dir = smart_str(shard_dir)
+            if not self.fs.isdir(shard_dir):
+                raise CommandError("Shard directory %s does not exist" % shard_dir)
+            if path.isbase(self.build_dir, shard_dir):
+                raise CommandError("Shard directory %s is inside the build directory" % shard_dir)
+            if manifests:
+                with open(manifests[i]) as f:
+                    file_list = json.load(f)
+            else:
+                file_list = self.get_shard_files(shard_dir)
+            for rel_path in file_list:
+                if rel_path in merged:
+                    raise CommandError(self.conflict_msg % rel_path)
+                merged[rel_path] = shard_dir
+
+        if not options.get("keep_build_dir"):
+            self.init_build_dir()
+        elif not self.fs.exists(self.build_dir):
+            self.fs.makedirs(self.build_dir)
+
+        logger.debug("Merging {} files from {} shards".format(len(merged), len(options['shard_dirs'])))
+        if self.verbosity > 1:
+            self.stdout.write("Merging %s files into %s" % (len(merged), self.build_dir))
+        for rel_path, shard_dir in merged.items():
+            self.merge_file(shard_dir, rel_path)
+
+        if options.get('merged_manifest'):
+            with open(options['merged_manifest'], 'w') as f:
+                json.dump(sorted(merged), f, indent=2)
+        if self.verbosity > 0:
+            self.stdout.write("Merged %s files from %s shards" % (len(merged), len(options['shard_dirs'])))
+
+        if options.get('publish'):
+            management.call_command("publish", build_dir=self.build_dir, verbosity=self.verbosity)
+
+    def init_build_dir(self):
+        """
+        Clear out the build directory and create a new one, so nothing
+        left from an earlier merge is published.
+        """
+        logger.debug("Initializing %s" % self.build_dir)
+        if self.verbosity > 1:
+            self.stdout.write("Initializing build directory")
+        if self.fs.exists(self.build_dir):
+            self.fs.removetree(self.build_dir)
+        self.fs.makedirs(self.build_dir)
+
+    def get_shard_files(self, shard_dir):
+        """
+        Returns the paths of every file in the shard directory, relative to it.
+        """
+        return [
+            path.relativefrom(shard_dir, file_path)
+            for file_path in self.fs.walk.files(shard_dir)
+        ]
+
+    def merge_file(self, shard_dir, rel_path):
+        """
+        Copies a file from the shard directory to the same place in the
+        build directory. Both are read through BAKERY_FILESYSTEM.
+        """
+        target_path = path.join(self.build_dir, rel_path)
+        target_dir = path.dirname(target_path)
+        if not self.fs.exists(target_dir):
+            self.fs.makedirs(target_dir)
+        self.fs.copy(path.join(shard_dir, rel_path), smart_str(target_path), overwrite=True)
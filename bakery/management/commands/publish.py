@@ -1,16 +1,31 @@
 import os
+import re
+import sys
 import time
+import queue
+import posixpath
 import hashlib
 import logging
+import inspect
+import threading
 import mimetypes
-import multiprocessing
 from django.conf import settings
-from multiprocessing.pool import ThreadPool
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from bakery import DEFAULT_GZIP_CONTENT_TYPES
+from bakery.management.bucket_index import BucketIndex
+from bakery.management.digests import DigestCache
+from bakery.management.journal import PublishJournal, get_default_journal_path
+from bakery.management.metrics import PublishMetrics
+from bakery.management.rate_limit import RateLimiter
 from bakery.management.commands import (
     BasePublishCommand,
     get_s3_client,
-    get_bucket_page
+    get_transfer_config,
+    get_transfer_manager,
+    iter_directory,
+    scan_directory,
+    LocalFile
 )
 try:
     from django.core.urlresolvers import get_callable
@@ -26,11 +41,41 @@ class Command(BasePublishCommand):
     # Default permissions for the files published to s3
     DEFAULT_ACL = 'public-read'
 
+    # Default number of threads used to compare and upload files. The work is
+    # bound by the network rather than the CPU, so it's sized independently.
+    DEFAULT_WORKERS = 20
+
+    # Default number of requests the async engine keeps in flight
+    DEFAULT_CONCURRENCY = 200
+
+    # S3 won't copy an object larger than 5 GB with a single request
+    MAX_COPY_SIZE = 5 * 1024 ** 3
+
+    # Options that can only be passed in from Python with call_command
+    stealth_options = ('paths', 'region', 'endpoint_url', 'local_files', 'digest_cache', 'rate_limiter')
+
+    # The keys that describe each target of a publish to several buckets
+    TARGET_KEYS = ('bucket', 'prefix', 'region', 'endpoint')
+
+    # Shared between the commands publishing one build to several targets
+    digest_cache = None
+    shared_local_files = None
+    shared_rate_limiter = None
+
+    # Every key is published under this prefix, if there is one
+    aws_bucket_prefix = ''
+
     # Error messages we might use below
     build_missing_msg = "Build directory does not exist. Cannot publish something before you build it."
     build_unconfig_msg = "Build directory unconfigured. Set BUILD_DIR in settings.py or provide it with --build-dir"
     bucket_unconfig_msg = "Bucket unconfigured. Set AWS_BUCKET_NAME in settings.py or provide it with --aws-bucket-name"
     views_unconfig_msg = "Bakery views unconfigured. Set BAKERY_VIEWS in settings.py or provide a list as arguments."
+    workers_invalid_msg = "The number of workers must be a positive integer."
+    engine_invalid_msg = "Publishing engine must be either 'threads' or 'async'."
+    concurrency_invalid_msg = "The concurrency must be a positive integer."
+    paths_missing_msg = "The file of paths to publish does not exist."
+    target_invalid_msg = "Targets must name a bucket, and may only set its %s." % ", ".join(TARGET_KEYS)
+    bandwidth_invalid_msg = "The maximum bandwidth must be a positive number of bytes per second."
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -47,6 +92,15 @@ class Command(BasePublishCommand):
             default='',
             help="Specify the AWS bucket to sync with. Will use settings.AWS_BUCKET_NAME by default."
         )
+        parser.add_argument(
+            "--target",
+            action="append",
+            dest="targets",
+            default=None,
+            help=("Publish to this target as well as any other --target, in the form \
+bucket=NAME[,prefix=PREFIX][,region=REGION][,endpoint=URL]. \
+Will use settings.BAKERY_PUBLISH_TARGETS if no bucket name is provided.")
+        )
         parser.add_argument(
             "--aws-bucket-prefix",
             action="store",
@@ -82,26 +136,145 @@ class Command(BasePublishCommand):
             default=False,
             help=("Run uploads one by one rather than pooling them to run concurrently.")
         )
+        parser.add_argument(
+            "--no-copy",
+            action="store_true",
+            dest="no_copy",
+            default=False,
+            help=("Always upload files, rather than copying content that's already in the bucket under another key.")
+        )
+        parser.add_argument(
+            "--workers",
+            action="store",
+            dest="workers",
+            type=int,
+            default=None,
+            help=("Number of threads used to compare and upload files. \
+Will use settings.BAKERY_PUBLISH_WORKERS or %s by default." % self.DEFAULT_WORKERS)
+        )
+        parser.add_argument(
+            "--engine",
+            action="store",
+            dest="engine",
+            choices=('threads', 'async'),
+            default=None,
+            help=("Publish with a pool of threads or with asyncio tasks. \
+Will use settings.BAKERY_PUBLISH_ENGINE or 'threads' by default.")
+        )
+        parser.add_argument(
+            "--concurrency",
+            action="store",
+            dest="concurrency",
+            type=int,
+            default=None,
+            help=("Number of requests the async engine keeps in flight. \
+Will use settings.BAKERY_PUBLISH_CONCURRENCY or %s by default." % self.DEFAULT_CONCURRENCY)
+        )
+        parser.add_argument(
+            "--max-bandwidth",
+            action="store",
+            dest="max_bandwidth",
+            type=int,
+            default=None,
+            help=("Cap the bytes uploaded each second. \
+Will use settings.BAKERY_PUBLISH_MAX_BANDWIDTH or no limit by default.")
+        )
+        parser.add_argument(
+            "--paths-from",
+            action="store",
+            dest="paths_from",
+            default='',
+            help=("Only publish the paths listed, one per line, in this file. Use - to read from stdin. \
+Listed files missing from the build directory are deleted from the bucket.")
+        )
+        parser.add_argument(
+            "--metrics-json",
+            action="store",
+            dest="metrics_json",
+            default='',
+            help=("Write the publish's timings and counts to this path as JSON. \
+Will use settings.BAKERY_PUBLISH_METRICS_JSON by default.")
+        )
+        parser.add_argument(
+            "--metrics-prometheus",
+            action="store",
+            dest="metrics_prometheus",
+            default='',
+            help=("Write the publish's timings and counts to this path in Prometheus's text format. \
+Will use settings.BAKERY_PUBLISH_METRICS_PROMETHEUS by default.")
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            dest="resume",
+            default=False,
+            help=("Pick up an interrupted publish from its journal rather than comparing everything again.")
+        )
+        parser.add_argument(
+            "--journal",
+            action="store",
+            dest="journal",
+            default='',
+            help=("Specify the path of the publish journal. Will use settings.BAKERY_PUBLISH_JOURNAL \
+or a file in the system's temporary directory by default.")
+        )
 
     def handle(self, *args, **options):
         """
         Sync files in the build directory to a specified S3 bucket
         """
+        # Publishing to several targets hands each one to its own command
+        targets = self.get_targets(options)
+        if targets:
+            return self.publish_to_targets(targets, options)
+
         # Counts and such we can use to keep tabs on this as they progress
         self.uploaded_files = 0
         self.uploaded_file_list = []
+        self.copied_files = 0
+        self.uploads = {}
+        self.s3_obj_dict = None
+        self.upload_queue = None
+        self.resumed_plan = {}
+        self.resumed_uploads = set()
         self.deleted_files = 0
         self.deleted_file_list = []
         self.start_time = time.time()
+        self.metrics = PublishMetrics()
+
+        # A lock to guard the counts and lists above from our worker threads
+        self.lock = threading.Lock()
 
         # Configure all the options we're going to use
         self.set_options(options)
 
-        # Initialize the boto connection
+        # Load up the views, and any headers they want set on their files
+        self.views = self.get_views()
+        self.upload_extra_args = self.get_upload_extra_args()
+
+        # Initialize the boto connection, with enough pooled connections
+        # for every upload thread and every thread inside large transfers
         logger.debug("Connecting to s3")
         if self.verbosity > 2:
             self.stdout.write("Connecting to s3")
-        self.s3_client, self.s3_resource = get_s3_client()
+        self.transfer_config = get_transfer_config()
+        self.s3_client, self.s3_resource = get_s3_client(
+            max_pool_connections=getattr(
+                settings,
+                'AWS_S3_MAX_POOL_CONNECTIONS',
+                self.workers + self.transfer_config.max_request_concurrency
+            ),
+            region_name=self.aws_region,
+            endpoint_url=self.endpoint_url
+        )
+
+        # One transfer manager is shared by all the uploads of large files
+        self.transfer_manager = get_transfer_manager(self.s3_client, self.transfer_config)
+
+        # Back off when S3 asks us to slow down, and keep under any bandwidth cap
+        self.rate_limiter = self.shared_rate_limiter or self.get_rate_limiter()
+        self.rate_limiter.watch_client(self.s3_client)
+        self.metrics.watch_client(self.s3_client)
 
         # Grab our bucket
         logger.debug("Retriving bucket {}".format(self.aws_bucket_name))
@@ -109,52 +282,45 @@ class Command(BasePublishCommand):
             self.stdout.write("Retriving bucket {}".format(self.aws_bucket_name))
         self.bucket = self.s3_resource.Bucket(self.aws_bucket_name)
 
-        # Get a list of all keys in our s3 bucket ...
-        # ...nunless you're this is case where we're blindly pushing
-        if self.force_publish and self.no_delete:
-            self.blind_upload = True
-            logger.debug("Skipping object retrieval. We won't need to because we're blinding uploading everything.")
-            self.s3_obj_dict = {}
+        # Keep a journal of our work so an interrupted publish can be resumed.
+        # Publishes of a short list of paths are quick to redo, and shouldn't
+        # clobber the journal of an interrupted full publish.
+        if self.dry_run or self.paths is not None:
+            self.journal = None
         else:
-            self.blind_upload = False
-            logger.debug("Retrieving objects now published in bucket")
-            if self.verbosity > 2:
-                self.stdout.write("Retrieving objects now published in bucket")
-            self.s3_obj_dict = {}
-            self.s3_obj_dict = self.get_bucket_file_list()
+            self.journal = PublishJournal(self.journal_path, {
+                'bucket': self.aws_bucket_name,
+                'prefix': self.aws_bucket_prefix,
+                'build_dir': os.path.abspath(str(self.build_dir)),
+            })
 
-        # Get a list of all the local files in our build directory
-        logger.debug("Retrieving files built locally")
-        if self.verbosity > 2:
-            self.stdout.write("Retrieving files built locally")
-        self.local_file_list = self.get_local_file_list()
+        # Sync the bucket with whichever engine was chosen
+        try:
+            if self.engine == 'async':
+                self.publish_with_async_engine()
+            else:
+                self.publish_with_thread_engine()
+        except BaseException:
+            self.write_metrics(success=False)
+            raise
+        finally:
+            self.transfer_manager.shutdown()
+            if self.journal:
+                self.journal.close()
+            if getattr(self, 's3_obj_dict', None) is not None:
+                self.s3_obj_dict.close()
 
-        # Sync local files with s3 bucket
-        logger.debug("Syncing local files with bucket")
-        if self.verbosity > 2:
-            self.stdout.write("Syncing local files with bucket")
-        self.sync_with_s3()
-
-        # Delete anything that's left in our keys dict
-        if not self.dry_run and not self.no_delete:
-            self.deleted_file_list = list(self.s3_obj_dict.keys())
-            self.deleted_files = len(self.deleted_file_list)
-            if self.deleted_files:
-                logger.debug("Deleting %s keys" % self.deleted_files)
-                if self.verbosity > 0:
-                    self.stdout.write("Deleting %s keys" % self.deleted_files)
-                self.batch_delete_s3_objects(
-                    self.deleted_file_list,
-                    self.aws_bucket_name
-                )
+        # We made it through, so there's nothing left to resume
+        if self.journal:
+            self.journal.finish()
 
         # Run any post publish hooks on the views
-        if not hasattr(settings, 'BAKERY_VIEWS'):
-            raise CommandError(self.views_unconfig_msg)
-        for view_str in settings.BAKERY_VIEWS:
-            view = get_callable(view_str)()
-            if hasattr(view, 'post_publish'):
-                getattr(view, 'post_publish')(self.bucket)
+        hook_list = [v for v in self.views if hasattr(v, 'post_publish')]
+        with self.metrics.phase('post_publish'):
+            if self.no_pooling:
+                [self.run_post_publish(v) for v in hook_list]
+            else:
+                self.run_pooled(self.run_post_publish, hook_list)
 
         # We're finished, print the final output
         elapsed_time = time.time() - self.start_time
@@ -167,11 +333,155 @@ class Command(BasePublishCommand):
         if self.verbosity > 0:
             self.stdout.write(msg)
 
+        if self.rate_limiter.throttles:
+            msg = "S3 throttled %d requests" % self.rate_limiter.throttles
+            logger.info(msg)
+            if self.verbosity > 0:
+                self.stdout.write(msg)
+
+        if self.copied_files:
+            msg = "%d of the uploaded files were copied from content already in the bucket" % self.copied_files
+            logger.info(msg)
+            if self.verbosity > 0:
+                self.stdout.write(msg)
+
         if self.dry_run:
             logger.info("Publish executed with the --dry-run option. No content was changed on S3.")
             if self.verbosity > 0:
                 self.stdout.write("Publish executed with the --dry-run option. No content was changed on S3.")
 
+        self.write_metrics(success=True)
+
+    def get_targets(self, options):
+        """
+        Returns a list of the targets to publish to, each a dict with the
+        keys in TARGET_KEYS, or None if there's just the one bucket.
+
+        Targets passed with --target win. Otherwise, unless a bucket name
+        is provided, BAKERY_PUBLISH_TARGETS is used if it's set.
+        """
+        if options.get('targets'):
+            targets = []
+            for target in options.get('targets'):
+                if '=' not in target:
+                    target = 'bucket=' + target
+                try:
+                    targets.append(dict(pair.split('=', 1) for pair in target.split(',')))
+                except ValueError:
+                    raise CommandError(self.target_invalid_msg)
+        elif not options.get('aws_bucket_name') and getattr(settings, 'BAKERY_PUBLISH_TARGETS', None):
+            targets = [dict(t) for t in settings.BAKERY_PUBLISH_TARGETS]
+        else:
+            return None
+
+        for target in targets:
+            if not target.get('bucket') or set(target) - set(self.TARGET_KEYS):
+                raise CommandError(self.target_invalid_msg)
+        return targets
+
+    def get_target_path(self, path, target):
+        """
+        Returns the provided file path with the target worked into its name,
+        so each target gets a file of its own.
+        """
+        root, ext = os.path.splitext(path)
+        slug = re.sub(r'[^A-Za-z0-9_.-]+', '-', "{}-{}".format(target['bucket'], target.get('prefix', '')))
+        return "{}.{}{}".format(root, slug.strip('-'), ext)
+
+    def publish_to_targets(self, targets, options):
+        """
+        Publishes the build directory to each of the provided targets at once.
+
+        The build directory is walked once, and each file hashed no more than
+        once, with the results shared by a publish command for every target.
+        They share a rate limiter too, so the bandwidth cap covers them all
+        and throttling by one slows them all down.
+        """
+        start_time = time.time()
+        self.set_options(dict(options, aws_bucket_name=targets[0]['bucket']))
+        if self.paths is None:
+            logger.debug("Retrieving files built locally")
+            local_files = self.get_local_files()
+        else:
+            local_files = None
+        digest_cache = DigestCache()
+        rate_limiter = self.get_rate_limiter(len(targets))
+
+        def publish(target):
+            target_options = dict(
+                options,
+                targets=None,
+                aws_bucket_name=target['bucket'],
+                aws_bucket_prefix=target.get('prefix', ''),
+                region=target.get('region'),
+                endpoint_url=target.get('endpoint'),
+                local_files=local_files,
+                digest_cache=digest_cache,
+                rate_limiter=rate_limiter,
+                paths=self.paths,
+                paths_from='',
+            )
+            # Files written by each publish need a name of their own
+            for option, setting in (
+                ('journal', 'BAKERY_PUBLISH_JOURNAL'),
+                ('metrics_json', 'BAKERY_PUBLISH_METRICS_JSON'),
+                ('metrics_prometheus', 'BAKERY_PUBLISH_METRICS_PROMETHEUS'),
+            ):
+                path = options.get(option) or getattr(settings, setting, None)
+                if path:
+                    target_options[option] = self.get_target_path(path, target)
+            logger.debug("Publishing to {}".format(target['bucket']))
+            self.__class__(stdout=self.stdout._out, stderr=self.stderr._out).handle(**target_options)
+
+        failures = []
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            futures = [(t, executor.submit(publish, t)) for t in targets]
+            for target, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("Publish to {} failed: {}".format(target['bucket'], e))
+                    failures.append((target, e))
+
+        if failures:
+            if len(failures) == 1 and len(targets) == 1:
+                raise failures[0][1]
+            raise CommandError("Publish failed for %s" % ", ".join(
+                "{} ({})".format(target['bucket'], e) for target, e in failures
+            ))
+
+        msg = "Published to %d targets in %.2f seconds" % (len(targets), time.time() - start_time)
+        logger.info(msg)
+        if self.verbosity > 0:
+            self.stdout.write(msg)
+
+    def get_rate_limiter(self, targets=1):
+        """
+        Returns a RateLimiter that allows as many requests in flight as the
+        provided number of targets can make, under the bandwidth cap.
+        """
+        return RateLimiter(
+            (self.concurrency if self.engine == 'async' else self.workers) * targets,
+            bytes_per_second=self.max_bandwidth
+        )
+
+    def write_metrics(self, success):
+        """
+        Writes the publish's timings and counts to the files requested
+        with the --metrics-json and --metrics-prometheus options.
+        """
+        if not self.metrics_json and not self.metrics_prometheus:
+            return
+        self.metrics.add('uploaded_files', self.uploaded_files)
+        self.metrics.add('copied_files', self.copied_files)
+        self.metrics.add('deleted_files', self.deleted_files)
+        self.metrics.add('throttled_requests', self.rate_limiter.throttles)
+        self.metrics.finish(success=success)
+        if self.metrics_json:
+            self.metrics.write_json(self.metrics_json)
+        if self.metrics_prometheus:
+            self.metrics.write_prometheus(self.metrics_prometheus)
+
     def set_options(self, options):
         """
         Configure all the many options we'll need to make this happen.
@@ -221,8 +531,19 @@ class Command(BasePublishCommand):
                 raise CommandError(self.bucket_unconfig_msg)
             self.aws_bucket_name = settings.AWS_BUCKET_NAME
 
-        # The bucket prefix, if it exists
-        self.aws_bucket_prefix = options.get("aws_bucket_prefix")
+        # The bucket prefix, if it exists, which every key is published under
+        self.aws_bucket_prefix = (options.get("aws_bucket_prefix") or '').lstrip('/')
+        if self.aws_bucket_prefix and not self.aws_bucket_prefix.endswith('/'):
+            self.aws_bucket_prefix += '/'
+
+        # The bucket's region and endpoint, if they differ from the settings
+        self.aws_region = options.get("region")
+        self.endpoint_url = options.get("endpoint_url")
+
+        # The walk and digests shared with publishes to other targets
+        self.shared_local_files = options.get("local_files")
+        self.digest_cache = options.get("digest_cache")
+        self.shared_rate_limiter = options.get("rate_limiter")
 
         # If the user sets the --force option
         if options.get('force'):
@@ -240,6 +561,260 @@ class Command(BasePublishCommand):
 
         self.no_delete = options.get('no_delete')
         self.no_pooling = options.get('no_pooling')
+        self.copy = not options.get('no_copy')
+
+        # How many threads will we use to compare and upload files?
+        if options.get('workers') is not None:
+            self.workers = options.get('workers')
+        else:
+            self.workers = getattr(settings, 'BAKERY_PUBLISH_WORKERS', self.DEFAULT_WORKERS)
+        if self.workers < 1:
+            raise CommandError(self.workers_invalid_msg)
+
+        # Which engine will do the publishing?
+        self.engine = options.get('engine') or getattr(settings, 'BAKERY_PUBLISH_ENGINE', 'threads')
+        if self.engine not in ('threads', 'async'):
+            raise CommandError(self.engine_invalid_msg)
+
+        # And how many requests can the async engine keep in flight?
+        if options.get('concurrency') is not None:
+            self.concurrency = options.get('concurrency')
+        else:
+            self.concurrency = getattr(settings, 'BAKERY_PUBLISH_CONCURRENCY', self.DEFAULT_CONCURRENCY)
+        if self.concurrency < 1:
+            raise CommandError(self.concurrency_invalid_msg)
+
+        # Is there a limit on how fast we can upload?
+        if options.get('max_bandwidth') is not None:
+            self.max_bandwidth = options.get('max_bandwidth')
+        else:
+            self.max_bandwidth = getattr(settings, 'BAKERY_PUBLISH_MAX_BANDWIDTH', None)
+        if self.max_bandwidth is not None and self.max_bandwidth < 1:
+            raise CommandError(self.bandwidth_invalid_msg)
+
+        # Are we only publishing a list of paths?
+        if options.get('paths') is not None:
+            self.paths = list(options.get('paths'))
+        elif options.get('paths_from'):
+            self.paths = self.read_paths(options.get('paths_from'))
+        else:
+            self.paths = None
+
+        # Where should we write our metrics?
+        self.metrics_json = options.get('metrics_json') or getattr(
+            settings,
+            'BAKERY_PUBLISH_METRICS_JSON',
+            None
+        )
+        self.metrics_prometheus = options.get('metrics_prometheus') or getattr(
+            settings,
+            'BAKERY_PUBLISH_METRICS_PROMETHEUS',
+            None
+        )
+
+        # Are we resuming an interrupted publish, and where is its journal?
+        self.resume = options.get('resume')
+        self.journal_path = options.get('journal') or getattr(
+            settings,
+            'BAKERY_PUBLISH_JOURNAL',
+            get_default_journal_path(self.aws_bucket_name, self.aws_bucket_prefix, self.build_dir)
+        )
+
+    def get_views(self):
+        """
+        Returns an instance of each view in BAKERY_VIEWS.
+        """
+        if not hasattr(settings, 'BAKERY_VIEWS'):
+            raise CommandError(self.views_unconfig_msg)
+        return [get_callable(view_str)() for view_str in settings.BAKERY_VIEWS]
+
+    def get_upload_extra_args(self):
+        """
+        Returns a dict, keyed by file, of the extra upload arguments views
+        ask for with a ``get_upload_extra_args`` method.
+
+        This lets views like BuildableRedirectView have their S3 headers
+        set as their files are uploaded, rather than with a second request.
+        """
+        upload_extra_args = {}
+        for view in self.views:
+            if hasattr(view, 'get_upload_extra_args'):
+                for key, extra_args in view.get_upload_extra_args().items():
+                    upload_extra_args.setdefault(key.lstrip('/'), {}).update(extra_args)
+        return upload_extra_args
+
+    def run_post_publish(self, view):
+        """
+        Runs the provided view's post_publish hook.
+
+        Hooks that accept them are also passed the shared S3 client, a dict,
+        keyed by path in the build directory, of the extra arguments each file
+        was uploaded with, and the prefix the keys were published under.
+        """
+        kwargs = {}
+        params = inspect.signature(view.post_publish).parameters
+        if 'uploads' in params:
+            kwargs['uploads'] = self.uploads
+        if 's3_client' in params:
+            kwargs['s3_client'] = self.s3_client
+        if 'prefix' in params:
+            kwargs['prefix'] = self.aws_bucket_prefix
+        view.post_publish(self.bucket, **kwargs)
+
+    def publish_with_thread_engine(self):
+        """
+        Lists the bucket, compares it with the build directory, then uploads
+        and deletes files using a pool of threads.
+        """
+        # Pick up where an interrupted publish left off, if we've been asked to
+        if self.resume_from_journal():
+            self.upload_files()
+            self.delete_files()
+            return
+
+        # If we've been handed a list of paths, only look at those ...
+        if self.paths is not None:
+            self.blind_upload = self.force_publish and self.no_delete
+            logger.debug("Retrieving {} listed paths".format(len(self.paths)))
+            if self.verbosity > 2:
+                self.stdout.write("Retrieving {} listed paths".format(len(self.paths)))
+            with self.metrics.phase('list'):
+                self.s3_obj_dict, self.local_file_list = self.get_scoped_file_lists(self.paths)
+        # ... otherwise look at everything
+        else:
+            # Get a list of all keys in our s3 bucket ...
+            # ...nunless you're this is case where we're blindly pushing
+            if self.force_publish and self.no_delete:
+                self.blind_upload = True
+                logger.debug("Skipping object retrieval. We won't need to because we're blinding uploading everything.")
+                self.s3_obj_dict = self.get_bucket_index()
+            else:
+                self.blind_upload = False
+                logger.debug("Retrieving objects now published in bucket")
+                if self.verbosity > 2:
+                    self.stdout.write("Retrieving objects now published in bucket")
+                with self.metrics.phase('list'):
+                    self.s3_obj_dict = self.get_bucket_file_list()
+
+            # Get a list of all the local files in our build directory
+            logger.debug("Retrieving files built locally")
+            if self.verbosity > 2:
+                self.stdout.write("Retrieving files built locally")
+            self.local_file_list = self.iter_local_files()
+
+        # Sync local files with s3 bucket
+        logger.debug("Syncing local files with bucket")
+        if self.verbosity > 2:
+            self.stdout.write("Syncing local files with bucket")
+        self.sync_with_s3()
+
+        # Delete anything that's left in our keys dict
+        self.delete_files()
+
+    def resume_from_journal(self):
+        """
+        Loads the uploads and deletes left undone by an interrupted publish,
+        if the --resume option is set.
+
+        If the interrupted publish never finished comparing files, what it
+        planned and uploaded is noted so the new comparison can skip it.
+
+        Returns True if there was a complete plan to resume.
+        """
+        if not self.resume or not self.journal:
+            return False
+        state = self.journal.load()
+        if state is None:
+            msg = "No interrupted publish to resume. Starting from scratch."
+        elif state.planned:
+            self.update_list, self.delete_list = state.uploads, state.deletes
+            msg = "Resuming publish with %d uploads and %d deletes remaining" % (
+                len(self.update_list),
+                len(self.delete_list)
+            )
+        else:
+            self.resumed_plan = dict(state.uploads)
+            self.resumed_uploads = state.uploaded
+            msg = "Resuming publish with %d uploads remaining and %d already made. Comparing the rest." % (
+                len(self.resumed_plan),
+                len(self.resumed_uploads)
+            )
+        logger.info(msg)
+        if self.verbosity > 0:
+            self.stdout.write(msg)
+        return state is not None and state.planned
+
+    def plan_publish(self, uploads_planned=False):
+        """
+        Settles which keys will be deleted once the comparison is finished,
+        then writes the planned uploads and deletes to the journal.
+
+        If the uploads were already written to the journal as they were
+        found, only the deletes are added.
+        """
+        if not self.dry_run and not self.no_delete:
+            self.delete_list = list(self.s3_obj_dict.keys())
+        else:
+            self.delete_list = []
+        if self.journal:
+            if uploads_planned:
+                self.journal.plan_deletes(self.delete_list)
+                self.journal.end_plan()
+            else:
+                self.journal.start(self.update_list, self.delete_list)
+
+    def delete_files(self):
+        """
+        Deletes the keys in self.delete_list from the bucket.
+        """
+        if self.delete_list:
+            logger.debug("Deleting %s keys" % len(self.delete_list))
+            if self.verbosity > 0:
+                self.stdout.write("Deleting %s keys" % len(self.delete_list))
+            with self.metrics.phase('delete'):
+                self.deleted_files = self.batch_delete_s3_objects(
+                    self.delete_list,
+                    self.aws_bucket_name,
+                    s3_client=self.s3_client,
+                    workers=self.workers,
+                    callback=self.record_deletes,
+                    rate_limiter=self.rate_limiter,
+                    prefix=self.aws_bucket_prefix
+                )
+
+    def record_deletes(self, keys):
+        """
+        Notes keys S3 has confirmed were deleted, and journals them.
+        """
+        with self.lock:
+            self.deleted_file_list.extend(keys)
+        if self.journal:
+            self.journal.record_deletes(keys)
+
+    def publish_with_async_engine(self):
+        """
+        Lists the bucket, uploads and deletes files as asyncio tasks.
+        """
+        try:
+            from bakery.management.async_publish import AsyncPublisher
+        except ImportError as e:
+            raise CommandError(str(e))
+        logger.debug("Publishing with the async engine and {} requests in flight".format(self.concurrency))
+        AsyncPublisher(self, self.concurrency).run()
+
+    def read_paths(self, paths_from):
+        """
+        Reads the list of paths to publish from the provided file, or stdin
+        if it's "-". Blank lines and lines starting with "#" are skipped.
+        """
+        if paths_from == '-':
+            lines = sys.stdin.readlines()
+        else:
+            if not os.path.exists(paths_from):
+                raise CommandError(self.paths_missing_msg)
+            with open(paths_from, 'r') as f:
+                lines = f.readlines()
+        return [line.strip() for line in lines if line.strip() and not line.startswith('#')]
 
     def get_bucket_file_list(self):
         """
@@ -257,65 +832,224 @@ class Command(BasePublishCommand):
             options['Prefix'] = self.aws_bucket_prefix
         page_iterator = paginator.paginate(**options)
 
-        obj_dict = {}
+        obj_dict = self.get_bucket_index()
         for page in page_iterator:
-            obj_dict.update(get_bucket_page(page))
+            obj_dict.add_page(page, prefix=self.aws_bucket_prefix)
 
         return obj_dict
 
+    def get_s3_key(self, key):
+        """
+        Returns the key in the bucket of the provided path in the build directory.
+        """
+        return self.aws_bucket_prefix + key
+
+    def get_bucket_index(self):
+        """
+        Returns an empty BucketIndex to hold the objects in the bucket.
+
+        Set BAKERY_PUBLISH_INDEX_SPILL_THRESHOLD to the number of keys
+        at which the index should move out of memory into SQLite.
+        """
+        return BucketIndex(
+            spill_threshold=getattr(settings, 'BAKERY_PUBLISH_INDEX_SPILL_THRESHOLD', None)
+        )
+
+    def get_scoped_file_lists(self, paths):
+        """
+        Returns the objects in the bucket and the files in the build directory
+        for just the provided list of paths.
+
+        A path to a directory stands in for its index.html. Rather than
+        listing the whole bucket, each key is checked with a HEAD request.
+        """
+        key_list = []
+        for p in paths:
+            key = posixpath.normpath(p.strip()).lstrip('/')
+            if key in ('', '.') or key.startswith('..'):
+                continue
+            if p.strip().endswith('/') or os.path.isdir(os.path.join(self.build_dir, key)):
+                key = posixpath.join(key, 'index.html')
+            if key not in key_list:
+                key_list.append(key)
+
+        local_file_list = []
+        for key in key_list:
+            file_path = os.path.join(self.build_dir, key)
+            if os.path.isfile(file_path):
+                st = os.stat(file_path)
+                local_file_list.append(LocalFile(key, st.st_size, st.st_mtime_ns))
+
+        obj_dict = self.get_bucket_index()
+        if not self.blind_upload:
+            def head(key):
+                try:
+                    obj = self.s3_client.head_object(Bucket=self.aws_bucket_name, Key=self.get_s3_key(key))
+                except ClientError as e:
+                    if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                        return
+                    raise
+                obj_dict.add(key, obj.get('ETag', ''), obj.get('ContentLength'))
+            if self.no_pooling:
+                [head(k) for k in key_list]
+            else:
+                self.run_pooled(head, key_list)
+
+        return obj_dict, local_file_list
+
     def get_local_file_list(self):
         """
         Walk the local build directory and create a list of relative and
         absolute paths to files.
         """
-        file_list = []
-        for (dirpath, dirnames, filenames) in os.walk(self.build_dir):
-            for fname in filenames:
-                # relative path, to sync with the S3 key
-                local_key = os.path.join(
-                    os.path.relpath(dirpath, self.build_dir),
-                    fname
-                )
-                if local_key.startswith('./'):
-                    local_key = local_key[2:]
-                file_list.append(local_key)
-        return file_list
+        return [f.key for f in self.get_local_files()]
+
+    def get_local_files(self):
+        """
+        Walk the local build directory and return a LocalFile, with its
+        relative path, size and modification time, for every file.
+        """
+        if self.shared_local_files is not None:
+            return self.shared_local_files
+        return scan_directory(self.build_dir, workers=self.workers)
+
+    def iter_local_files(self):
+        """
+        Walk the local build directory and yield a LocalFile for every
+        file as soon as it's found.
+        """
+        if self.shared_local_files is not None:
+            return iter(self.shared_local_files)
+        return iter_directory(self.build_dir, workers=self.workers)
 
     def sync_with_s3(self):
         """
         Walk through our self.local_files list, and match them with the list
         of keys in the S3 bucket.
+
+        Unless pooling is turned off, files are compared and uploaded as a
+        pipeline, so the first uploads go out while the comparison continues.
         """
         # Create a list to put all the files we're going to update
         self.update_list = []
 
         # Figure out which files need to be updated and upload all these files
-        logger.debug("Comparing {} local files with {} bucket files".format(
-            len(self.local_file_list),
-            len(self.s3_obj_dict.keys())
-        ))
+        logger.debug("Comparing local files with {} bucket files".format(len(self.s3_obj_dict)))
+        local_files = self.metrics.timed_iter('walk', self.local_file_list)
         if self.no_pooling:
-            [self.compare_local_file(f) for f in self.local_file_list]
+            [self.pooled_compare_local_file(f) for f in local_files]
+
+            # Write down the plan before changing anything, so it can be resumed
+            self.plan_publish()
+
+            # Then send it all up
+            self.upload_files()
         else:
-            cpu_count = multiprocessing.cpu_count()
-            logger.debug("Pooling local file comparison on {} CPUs".format(cpu_count))
-            pool = ThreadPool(processes=cpu_count)
-            pool.map(self.compare_local_file, self.local_file_list)
+            logger.debug("Pipelining comparison and uploads on {} workers each".format(self.workers))
+            self.run_pipeline(local_files)
+
+            # Whatever's left in the bucket can be deleted
+            self.plan_publish(uploads_planned=True)
+
+    def run_pipeline(self, local_files):
+        """
+        Compares and uploads the provided LocalFiles in stages joined by
+        bounded queues.
+
+        A pool of threads compares each file with the bucket as the walk
+        finds it, and hands anything new or changed straight on to a pool of
+        threads that uploads it.
+
+        The first error raised by a worker, if any, stops the pipeline and
+        is passed along to the caller.
+        """
+        stop = object()
+        errors = []
+        compare_queue = queue.Queue(maxsize=self.workers * 2)
+        self.upload_queue = queue.Queue(maxsize=self.workers * 2)
+
+        def work(in_queue, func):
+            while True:
+                item = in_queue.get()
+                if item is stop:
+                    return
+                # After a failure, keep draining so nothing upstream blocks
+                if errors:
+                    continue
+                try:
+                    func(item)
+                except Exception as e:
+                    errors.append(e)
+
+        def start_stage(in_queue, func):
+            threads = [
+                threading.Thread(target=work, args=(in_queue, func), daemon=True)
+                for i in range(self.workers)
+            ]
+            [t.start() for t in threads]
+            return threads
+
+        def stop_stage(in_queue, threads):
+            [in_queue.put(stop) for t in threads]
+            [t.join() for t in threads]
+
+        # Planned uploads are journaled as they're found,
+        # after any left by the publish we're resuming
+        if self.journal and not (self.resumed_plan or self.resumed_uploads):
+            self.journal.begin()
+
+        uploaders = start_stage(self.upload_queue, self.pooled_upload_to_s3)
+        comparers = start_stage(compare_queue, self.pooled_compare_local_file)
+        try:
+            for local_file in local_files:
+                if errors:
+                    break
+                compare_queue.put(local_file)
+        finally:
+            stop_stage(compare_queue, comparers)
+            stop_stage(self.upload_queue, uploaders)
+            self.upload_queue = None
 
+        if errors:
+            raise errors[0]
+
+    def upload_files(self):
+        """
+        Uploads the files in self.update_list to the bucket.
+        """
         logger.debug("Uploading {} new or updated files to bucket".format(len(self.update_list)))
         if self.no_pooling:
-            [self.upload_to_s3(*u) for u in self.update_list]
+            [self.pooled_upload_to_s3(u) for u in self.update_list]
         else:
-            logger.debug("Pooling s3 uploads on {} CPUs".format(cpu_count))
-            pool = ThreadPool(processes=cpu_count)
-            pool.map(self.pooled_upload_to_s3, self.update_list)
+            logger.debug("Pooling s3 uploads on {} workers".format(self.workers))
+            self.run_pooled(self.pooled_upload_to_s3, self.update_list)
+
+    def run_pooled(self, func, iterable):
+        """
+        Maps the provided function across the iterable with a pool of threads.
+
+        The pool is shut down before returning and the first error raised
+        by a worker, if any, is passed along to the caller.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for _ in executor.map(func, iterable):
+                pass
 
     def get_md5(self, filename):
         """
         Returns the md5 checksum of the provided file name.
+
+        When publishing to several targets, each file is only hashed once.
         """
+        if self.digest_cache is not None:
+            return self.digest_cache.get(filename, 'md5', self.compute_md5)
+        return self.compute_md5(filename)
+
+    def compute_md5(self, filename):
+        m = hashlib.md5()
         with open(filename, 'rb') as f:
-            m = hashlib.md5(f.read())
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                m.update(chunk)
         return m.hexdigest()
 
     def get_multipart_md5(self, filename, chunk_size=8 * 1024 * 1024):
@@ -324,6 +1058,15 @@ class Command(BasePublishCommand):
 
         This is done to mirror the method used by Amazon S3 after a multipart upload.
         """
+        if self.digest_cache is not None:
+            return self.digest_cache.get(
+                filename,
+                ('multipart', chunk_size),
+                lambda f: self.compute_multipart_md5(f, chunk_size)
+            )
+        return self.compute_multipart_md5(filename, chunk_size)
+
+    def compute_multipart_md5(self, filename, chunk_size):
         # Loop through the file contents ...
         md5s = []
         with open(filename, 'rb') as fp:
@@ -348,31 +1091,54 @@ class Command(BasePublishCommand):
         # Trim it down and pass it back for comparison
         return new_etag.strip('"').strip("'")
 
-    def compare_local_file(self, file_key):
+    def compare_local_file(self, file_key, size=None):
         """
         Compares a local version of a file with what's already published.
 
+        If the file's size is provided and doesn't match the size of the object
+        in S3, it's known to have changed without hashing it.
+
         If an update is needed, the file's key is added self.update_list.
         """
         # Where is the file?
         file_path = os.path.join(self.build_dir, file_key)
 
+        # Pull the file from the s3 dict, we won't need it there anymore
+        with self.lock:
+            s3_obj = self.s3_obj_dict.pop(file_key, None)
+
+        # Skip anything the publish we're resuming already dealt with
+        if file_key in self.resumed_uploads:
+            return
+        if file_key in self.resumed_plan:
+            self.queue_upload(file_key, file_path)
+            return
+
         # If we're in force_publish mode just add it
         if self.force_publish:
-            self.update_list.append((file_key, file_path))
+            self.queue_upload(file_key, file_path)
             # And quit now
             return
 
         # Does it exist in our s3 object list?
-        if file_key in self.s3_obj_dict:
+        if s3_obj is not None:
+
+            # If the sizes don't match, it has changed and there's no need to hash it
+            if size is not None and s3_obj.size is not None and size != s3_obj.size:
+                logger.debug("{} has changed size".format(file_key))
+                self.queue_upload(file_key, file_path)
+                return
 
             # Get the md5 stored in Amazon's header
-            s3_md5 = self.s3_obj_dict[file_key].get('ETag').strip('"').strip("'")
+            s3_md5 = s3_obj.etag
 
             # If there is a multipart ETag on S3, compare that to our local file after its chunked up.
             # We are presuming this file was uploaded in multiple parts.
             if "-" in s3_md5:
-                local_md5 = self.get_multipart_md5(file_path)
+                local_md5 = self.get_multipart_md5(
+                    file_path,
+                    chunk_size=self.transfer_config.multipart_chunksize
+                )
             # Other, do it straight for the whole file
             else:
                 local_md5 = self.get_md5(file_path)
@@ -383,29 +1149,50 @@ class Command(BasePublishCommand):
             # If they don't match, we want to add it
             else:
                 logger.debug("{} has changed".format(file_key))
-                self.update_list.append((file_key, file_path))
-
-            # Remove the file from the s3 dict, we don't need it anymore
-            del self.s3_obj_dict[file_key]
+                self.queue_upload(file_key, file_path)
 
         # If the file doesn't exist, queue it for creation
         else:
             logger.debug("{} has been added".format(file_key))
+            self.queue_upload(file_key, file_path)
+
+    def queue_upload(self, file_key, file_path):
+        """
+        Adds the provided file to self.update_list and, if the pipeline is
+        running, passes it along to be uploaded.
+        """
+        with self.lock:
             self.update_list.append((file_key, file_path))
+        if self.upload_queue is not None:
+            if self.journal:
+                self.journal.plan_upload(file_key, file_path)
+            self.upload_queue.put((file_key, file_path))
+
+    def pooled_compare_local_file(self, local_file):
+        """
+        A passthrough for our thread pool that splits a LocalFile
+        into the args for the real comparison function.
+        """
+        with self.metrics.phase('compare'):
+            self.compare_local_file(local_file.key, size=local_file.size)
 
     def pooled_upload_to_s3(self, payload):
         """
-        A passthrough for our ThreadPool because it can't take two arguments.
+        A passthrough for our thread pool because its map can't take two arguments.
 
         So all we're doing here is split the list into args for the real
         upload function.
         """
-        self.upload_to_s3(*payload)
+        with self.metrics.phase('upload'):
+            self.upload_to_s3(*payload)
 
-    def upload_to_s3(self, key, filename):
+    def get_extra_args(self, filename, key=None):
         """
-        Set the content type and gzip headers if applicable
-        and upload the item to S3
+        Returns the ACL, content type, gzip and cache-control headers
+        to upload with the provided file.
+
+        If the file's key is provided, any extra arguments requested by
+        the views for it are included as well.
         """
         extra_args = {'ACL': self.acl}
         # determine the mimetype of the file
@@ -427,14 +1214,96 @@ class Command(BasePublishCommand):
                 str(self.cache_control[content_type])
             ))
 
-        # access and write the contents from the file
-        if not self.dry_run:
+        # add anything the views asked for
+        if key is not None and key in self.upload_extra_args:
+            extra_args.update(self.upload_extra_args[key])
+
+        return extra_args
+
+    def copy_in_bucket(self, key, filename, extra_args):
+        """
+        Copies the provided file's content to its key from another object in
+        the bucket, if one holds the same bytes, rather than uploading it.
+
+        The copy only goes through if the source still has the same ETag,
+        since it may be overwritten as part of this publish.
+
+        Returns True if the file was copied.
+        """
+        if not self.copy or self.s3_obj_dict is None:
+            return False
+
+        # Only hash files that have a chance of being found
+        size = os.path.getsize(filename)
+        if size > self.MAX_COPY_SIZE or not self.s3_obj_dict.has_size(size):
+            return False
+        md5 = self.get_md5(filename)
+        source = self.s3_obj_dict.find_content(md5, size)
+        if source is None:
+            return False
+
+        logger.debug("Copying {} to {}".format(source, key))
+        if self.verbosity > 0:
+            self.stdout.write("Copying %s from %s" % (filename, source))
+        try:
+            with self.rate_limiter.request():
+                self.s3_client.copy_object(
+                    Bucket=self.aws_bucket_name,
+                    Key=self.get_s3_key(key),
+                    CopySource={'Bucket': self.aws_bucket_name, 'Key': self.get_s3_key(source)},
+                    CopySourceIfMatch='"%s"' % md5,
+                    MetadataDirective='REPLACE',
+                    **extra_args
+                )
+        except ClientError as e:
+            logger.debug("Could not copy {} to {}, uploading it instead: {}".format(source, key, e))
+            return False
+
+        with self.lock:
+            self.copied_files += 1
+        self.metrics.add('bytes_copied', size)
+        return True
+
+    def upload_to_s3(self, key, filename):
+        """
+        Set the content type and gzip headers if applicable
+        and upload the item to S3
+
+        Files smaller than the multipart threshold are read into memory and
+        sent with a single PUT. Larger ones go through the shared transfer manager.
+        """
+        extra_args = self.get_extra_args(filename, key)
+
+        # access and write the contents from the file, unless they're already in the bucket
+        if not self.dry_run and not self.copy_in_bucket(key, filename, extra_args):
             logger.debug("Uploading %s" % filename)
             if self.verbosity > 0:
                 self.stdout.write("Uploading %s" % filename)
-            s3_obj = self.s3_resource.Object(self.aws_bucket_name, key)
-            s3_obj.upload_file(filename, ExtraArgs=extra_args)
+            size = os.path.getsize(filename)
+            if size < self.transfer_config.multipart_threshold:
+                with self.rate_limiter.request(size), open(filename, 'rb') as f:
+                    self.s3_client.put_object(
+                        Bucket=self.aws_bucket_name,
+                        Key=self.get_s3_key(key),
+                        Body=f.read(),
+                        **extra_args
+                    )
+            else:
+                # Large files pay for their bandwidth a chunk at a time
+                with self.rate_limiter.request():
+                    self.transfer_manager.upload(
+                        filename,
+                        self.aws_bucket_name,
+                        self.get_s3_key(key),
+                        extra_args=extra_args,
+                        subscribers=[self.rate_limiter.get_transfer_subscriber()]
+                    ).result()
+            self.metrics.add('bytes_uploaded', size)
 
         # Update counts
-        self.uploaded_files += 1
-        self.uploaded_file_list.append(filename)
+        with self.lock:
+            self.uploaded_files += 1
+            self.uploaded_file_list.append(filename)
+            self.uploads[key] = extra_args
+        if self.journal:
+            self.journal.record_upload(key)
@@ -9,6 +9,9 @@ class Command(BasePublishCommand):
     help = "Empties the Amazon S3 bucket defined in settings.py"
     bucket_unconfig_msg = "Bucket unconfigured. Set AWS_BUCKET_NAME in settings.py or provide it with --aws-bucket-name"
 
+    # Number of threads sending delete requests while the bucket is listed
+    delete_workers = 10
+
     def add_arguments(self, parser):
         parser.add_argument(
             "--aws-bucket-name",
@@ -17,6 +20,13 @@ class Command(BasePublishCommand):
             default='',
             help="Specify the AWS bucket to sync with. Will use settings.AWS_BUCKET_NAME by default."
         )
+        parser.add_argument(
+            "--prefix",
+            action="store",
+            dest="prefix",
+            default='',
+            help="Only delete the keys that start with this prefix. The whole bucket is emptied by default."
+        )
 
     def handle(self, *args, **options):
         if options.get("aws_bucket_name"):
@@ -27,10 +37,20 @@ class Command(BasePublishCommand):
                 raise CommandError(self.bucket_unconfig_msg)
             aws_bucket_name = settings.AWS_BUCKET_NAME
 
-        # Pull all the keys from the bucket
-        all_objects = self.get_all_objects_in_bucket(aws_bucket_name)
-        keys = all_objects.keys()
-        self.batch_delete_s3_objects(keys, aws_bucket_name)
+        # Delete the keys as each page of the bucket listing arrives,
+        # rather than holding the whole bucket in memory first
+        s3_client, s3_resource = self.get_s3_client(max_pool_connections=self.delete_workers + 1)
+        keys = self.iter_keys_in_bucket(
+            aws_bucket_name,
+            prefix=options.get("prefix"),
+            s3_client=s3_client
+        )
+        deleted = self.batch_delete_s3_objects(
+            keys,
+            aws_bucket_name,
+            s3_client=s3_client,
+            workers=self.delete_workers
+        )
 
         # A little logging
-        logger.info("unpublish completed, %d deleted files" % len(keys))
+        logger.info("unpublish completed, %d deleted files" % deleted)
@@ -0,0 +1,52 @@
+"""
+A cache of the digests of files in the build directory, so publishing the
+same build to several targets only hashes each file once.
+"""
+import os
+import threading
+from concurrent.futures import Future
+
+
+class DigestCache(object):
+    """
+    Remembers each digest computed for a file, along with the file's size
+    and modification time, and recomputes it if either has changed.
+
+    If several threads ask for the same digest at once, one computes it
+    while the rest wait for the result.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.digests = {}
+
+    def get(self, filename, kind, compute):
+        """
+        Returns the digest of the provided kind for the file, calling
+        compute with the file name if it isn't already known.
+        """
+        st = os.stat(filename)
+        key = (filename, kind)
+        version = (st.st_size, st.st_mtime_ns)
+        with self.lock:
+            entry = self.digests.get(key)
+            if entry is not None and entry[0] == version:
+                future = entry[1]
+                owner = False
+            else:
+                future = Future()
+                self.digests[key] = (version, future)
+                owner = True
+
+        if not owner:
+            return future.result()
+
+        try:
+            digest = compute(filename)
+        except BaseException as e:
+            with self.lock:
+                if self.digests.get(key, (None, None))[1] is future:
+                    del self.digests[key]
+            future.set_exception(e)
+            raise
+        future.set_result(digest)
+        return digest
@@ -0,0 +1,167 @@
+"""
+A journal that lets an interrupted publish pick up where it left off.
+"""
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import namedtuple
+logger = logging.getLogger(__name__)
+
+# What a journal says is left to do. The deletes are only known once the
+# plan is complete, and the keys already uploaded are kept for plans that
+# were cut short so the comparison can skip them.
+JournalState = namedtuple('JournalState', ['planned', 'uploads', 'deletes', 'uploaded'])
+
+
+def get_default_journal_path(aws_bucket_name, aws_bucket_prefix, build_dir):
+    """
+    Returns a path in the system's temporary directory that's unique to the
+    provided bucket, prefix and build directory.
+    """
+    target = "{}/{}:{}".format(aws_bucket_name, aws_bucket_prefix or '', os.path.abspath(str(build_dir)))
+    digest = hashlib.md5(target.encode("utf-8")).hexdigest()
+    return os.path.join(tempfile.gettempdir(), "bakery-publish-{}.journal".format(digest))
+
+
+class PublishJournal(object):
+    """
+    An append-only log of the uploads and deletes a publish plans to make,
+    followed by a record of each one as it's completed.
+
+    Each line is a JSON object. The first describes the target, then come
+    the planned operations and a marker once the plan is complete. Each
+    completed operation is recorded after it was planned, though uploads
+    may finish before the rest of the plan is written, and a resumed publish
+    can carry on a plan that was cut short. The file is removed
+    when the publish finishes, so a journal left on disk means the last run
+    was interrupted.
+    """
+    def __init__(self, path, target):
+        self.path = path
+        self.target = target
+        self.lock = threading.Lock()
+        self.file = None
+
+    def load(self):
+        """
+        Reads the journal left by an interrupted publish.
+
+        Returns a JournalState with whether the plan was finished, the list
+        of (key, path) uploads and the list of keys to delete that were planned
+        but never completed, and the set of keys that were uploaded. Returns
+        None if there's no journal for this target.
+        """
+        if not os.path.exists(self.path):
+            return None
+
+        planned = False
+        uploads = {}
+        deletes = set()
+        uploaded = set()
+        with open(self.path, 'r') as f:
+            for i, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short when the last run died
+                    break
+                op = entry.get('op')
+                if i == 0:
+                    if op != 'start' or entry.get('target') != self.target:
+                        logger.warning("Ignoring journal at {} for another target".format(self.path))
+                        return None
+                elif op == 'upload':
+                    uploads[entry['key']] = entry['path']
+                elif op == 'delete':
+                    deletes.add(entry['key'])
+                elif op == 'planned':
+                    planned = True
+                elif op == 'uploaded':
+                    uploads.pop(entry['key'], None)
+                    uploaded.add(entry['key'])
+                elif op == 'deleted':
+                    deletes.difference_update(entry['keys'])
+
+        if not planned:
+            logger.debug("Journal at {} has no complete plan".format(self.path))
+
+        # Carry on appending to the same journal
+        self.file = open(self.path, 'a')
+        return JournalState(planned, list(uploads.items()), list(deletes), uploaded)
+
+    def start(self, update_list, delete_list):
+        """
+        Starts a new journal with the planned uploads and deletes.
+        """
+        self.begin()
+        for key, path in update_list:
+            self.plan_upload(key, path)
+        self.plan_deletes(delete_list)
+        self.end_plan()
+
+    def begin(self):
+        """
+        Starts a new journal with an empty plan.
+
+        Planned uploads can be added as they're found and completed ones
+        recorded alongside them. Until the plan has been ended, a resumed
+        publish has to compare everything that wasn't planned again.
+        """
+        self.close()
+        self.file = open(self.path, 'w')
+        self.write({'op': 'start', 'target': self.target})
+
+    def plan_upload(self, key, path):
+        """
+        Adds an upload of the provided file to the plan.
+        """
+        self.write({'op': 'upload', 'key': key, 'path': path})
+
+    def plan_deletes(self, keys):
+        """
+        Adds deletes of the provided keys to the plan.
+        """
+        for key in keys:
+            self.write({'op': 'delete', 'key': key})
+
+    def end_plan(self):
+        """
+        Marks the plan as complete and makes sure it's on disk.
+        """
+        self.write({'op': 'planned'})
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record_upload(self, key):
+        """
+        Records that the provided key was uploaded.
+        """
+        self.write({'op': 'uploaded', 'key': key}, flush=True)
+
+    def record_deletes(self, keys):
+        """
+        Records that the provided list of keys were deleted.
+        """
+        self.write({'op': 'deleted', 'keys': list(keys)}, flush=True)
+
+    def write(self, entry, flush=False):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            if flush:
+                self.file.flush()
+
+    def finish(self):
+        """
+        Closes the journal and removes it, since there's nothing left to resume.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,246 @@
+"""
+Timings and counts collected while publishing, so a slow publish can be
+traced to listing, hashing or the network.
+
+They can be written out as JSON, or in the text format read by the
+Prometheus node exporter's textfile collector.
+"""
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+logger = logging.getLogger(__name__)
+
+# The upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram(object):
+    """
+    Counts observations into buckets by their upper bound, as Prometheus does.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative_counts(self):
+        """
+        Returns a list of (upper bound, count of observations at or below it)
+        for each bucket.
+        """
+        total = 0
+        counts = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict((str(bound), count) for bound, count in self.cumulative_counts()),
+        }
+
+
+class PublishMetrics(object):
+    """
+    Collects the timings and counts of a publish.
+
+    Each phase keeps both its span, from when it first started to when it
+    last finished, and the time spent in it summed across every thread.
+    Phases that run in a pipeline overlap, so their spans can add up to
+    more than the publish took.
+
+    Safe to use from multiple threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.end_time = None
+        self.success = False
+        self.phases = {}
+        self.counts = {}
+        self.requests = {}
+        self.retries = 0
+        self.latencies = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the enclosed block as part of the named phase.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase_time(name, start, time.time())
+
+    def add_phase_time(self, name, start, end):
+        with self.lock:
+            first, last, busy = self.phases.get(name, (start, end, 0.0))
+            self.phases[name] = (min(first, start), max(last, end), busy + end - start)
+
+    def timed_iter(self, name, iterable):
+        """
+        Yields from the provided iterable, timing each step as part
+        of the named phase.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_phase_time(name, start, time.time())
+                return
+            self.add_phase_time(name, start, time.time())
+            yield item
+
+    def add(self, name, value=1):
+        """
+        Adds the provided value to the named count.
+        """
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def watch_client(self, s3_client):
+        """
+        Registers with the provided boto client, or aiobotocore client, to
+        count and time every API call it makes, and count the retries boto
+        made for them.
+        """
+        s3_client.meta.events.register('before-call.s3', self.on_before_call)
+        s3_client.meta.events.register('after-call.s3', self.on_after_call)
+
+    def on_before_call(self, context=None, **kwargs):
+        if context is not None:
+            context['bakery_start_time'] = time.time()
+
+    def on_after_call(self, parsed=None, model=None, context=None, **kwargs):
+        operation = model.name if model is not None else 'Unknown'
+        retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        start = (context or {}).get('bakery_start_time')
+        with self.lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            self.retries += retries
+            if start is not None:
+                if operation not in self.latencies:
+                    self.latencies[operation] = Histogram()
+                self.latencies[operation].observe(time.time() - start)
+
+    def finish(self, success=True):
+        self.end_time = time.time()
+        self.success = success
+
+    def to_dict(self):
+        with self.lock:
+            end_time = self.end_time or time.time()
+            return {
+                'success': self.success,
+                'start_time': self.start_time,
+                'duration_seconds': end_time - self.start_time,
+                'phases': dict(
+                    (name, {'seconds': last - first, 'busy_seconds': busy})
+                    for name, (first, last, busy) in self.phases.items()
+                ),
+                'counts': dict(self.counts),
+                'requests': dict(self.requests),
+                'retries': self.retries,
+                'latency_seconds': dict(
+                    (operation, histogram.to_dict())
+                    for operation, histogram in self.latencies.items()
+                ),
+            }
+
+    def to_prometheus(self, prefix='bakery_publish'):
+        """
+        Returns the metrics in Prometheus's text exposition format.
+        """
+        data = self.to_dict()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP {}_{} {}".format(prefix, name, help_text))
+            lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+            for suffix, labels, value in samples:
+                label_str = ",".join('{}="{}"'.format(k, v) for k, v in labels)
+                lines.append("{}_{}{}{} {}".format(
+                    prefix,
+                    name,
+                    suffix,
+                    "{" + label_str + "}" if label_str else "",
+                    repr(float(value)) if isinstance(value, float) else value
+                ))
+
+        metric('success', 'gauge', "Whether the last publish finished.", [
+            ('', [], int(data['success']))
+        ])
+        metric('last_run_timestamp_seconds', 'gauge', "When the last publish started.", [
+            ('', [], data['start_time'])
+        ])
+        metric('duration_seconds', 'gauge', "How long the last publish took.", [
+            ('', [], data['duration_seconds'])
+        ])
+        metric('phase_seconds', 'gauge', "Time from the start to the end of each phase.", [
+            ('', [('phase', name)], phase['seconds'])
+            for name, phase in sorted(data['phases'].items())
+        ])
+        metric('phase_busy_seconds', 'gauge', "Time spent in each phase, summed across threads.", [
+            ('', [('phase', name)], phase['busy_seconds'])
+            for name, phase in sorted(data['phases'].items())
+        ])
+        for name, value in sorted(data['counts'].items()):
+            metric(name, 'gauge', "The {} in the last publish.".format(name.replace('_', ' ')), [
+                ('', [], value)
+            ])
+        metric('requests', 'gauge', "API calls made to S3, by operation.", [
+            ('', [('operation', name)], value)
+            for name, value in sorted(data['requests'].items())
+        ])
+        metric('retries', 'gauge', "Requests boto retried.", [
+            ('', [], data['retries'])
+        ])
+        samples = []
+        for operation, histogram in sorted(self.latencies.items()):
+            labels = [('operation', operation)]
+            for bound, count in histogram.cumulative_counts():
+                samples.append(('_bucket', labels + [('le', bound)], count))
+            samples.append(('_bucket', labels + [('le', '+Inf')], histogram.count))
+            samples.append(('_sum', labels, histogram.sum))
+            samples.append(('_count', labels, histogram.count))
+        metric('request_duration_seconds', 'histogram', "Latency of requests to S3, by operation.", samples)
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.to_dict(), indent=2, sort_keys=True))
+
+    def write_prometheus(self, path):
+        write_atomically(path, self.to_prometheus())
+
+
+def write_atomically(path, content):
+    """
+    Writes the content to a temporary file beside the provided path, then
+    moves it into place, so readers never see a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.bakery-metrics-')
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+    logger.debug("Wrote publish metrics to {}".format(path))
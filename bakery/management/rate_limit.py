@@ -0,0 +1,210 @@
+"""
+Adaptive rate control for the requests publish makes to S3.
+
+When S3 is asked for more than it can handle, usually on a fresh prefix, it
+answers with 503 SlowDown. Rather than leave each thread to back off alone
+inside boto's retries, the limiter watches for throttling and changes how
+many requests are allowed in flight: one more for each window of requests
+that go through, and half as many after each throttled one. It can also cap
+the bytes sent each second.
+"""
+import time
+import asyncio
+import logging
+import threading
+from s3transfer.subscribers import BaseSubscriber
+logger = logging.getLogger(__name__)
+
+# The error codes S3 and its look-alikes use to ask clients to slow down
+THROTTLING_ERROR_CODES = (
+    'SlowDown',
+    'ServiceUnavailable',
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequests',
+)
+
+
+class RateLimiter(object):
+    """
+    Limits the number of requests in flight with additive increase and
+    multiplicative decrease, and the bytes sent with a token bucket.
+
+    The number of requests starts at, and never grows past, max_in_flight.
+    After a throttled response it is halved, though no more than once each
+    cooldown in seconds, so a burst of errors from the same moment only
+    counts once. If bytes_per_second is provided, requests wait until enough
+    bytes have been earned, with up to a second's worth allowed in a burst.
+    A request larger than that is let through and paid off afterwards, so
+    large uploads should instead pay for each chunk as it's sent with consume.
+
+    The limiter is safe to use from multiple threads, and from asyncio.
+    """
+    def __init__(self, max_in_flight, bytes_per_second=None, min_in_flight=1, cooldown=1.0):
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min(min_in_flight, max_in_flight)
+        self.bytes_per_second = bytes_per_second
+        self.cooldown = cooldown
+        self.limit = float(max_in_flight)
+        self.in_flight = 0
+        self.throttles = 0
+        self.last_throttle = None
+        self.tokens = float(bytes_per_second or 0)
+        self.last_fill = time.monotonic()
+        self.condition = threading.Condition()
+
+    def delay(self, nbytes=0):
+        """
+        Starts a request of the provided size and returns 0 if it can go now.
+        Otherwise returns how many seconds to wait before asking again.
+
+        Expects to be called while holding the condition's lock.
+        """
+        if self.in_flight >= int(self.limit):
+            # Waits on a free slot are cut short when one is released
+            return 0.05
+        if self.bytes_per_second and nbytes:
+            wait = self.spend(nbytes)
+            if wait:
+                return wait
+        self.in_flight += 1
+        return 0
+
+    def spend(self, nbytes):
+        """
+        Takes the provided number of bytes from the bucket and returns 0 if
+        there were tokens to spare. Otherwise returns how many seconds to wait
+        before asking again.
+
+        Expects to be called while holding the condition's lock.
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            float(self.bytes_per_second),
+            self.tokens + (now - self.last_fill) * self.bytes_per_second
+        )
+        self.last_fill = now
+        if self.tokens < 0:
+            return -self.tokens / self.bytes_per_second
+        self.tokens -= nbytes
+        return 0
+
+    def acquire(self, nbytes=0):
+        """
+        Blocks until a request of the provided size can be sent.
+        """
+        with self.condition:
+            while True:
+                wait = self.delay(nbytes)
+                if not wait:
+                    return
+                self.condition.wait(wait)
+
+    async def acquire_async(self, nbytes=0):
+        """
+        Waits, without blocking the event loop, until a request
+        of the provided size can be sent.
+        """
+        while True:
+            with self.condition:
+                wait = self.delay(nbytes)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def consume(self, nbytes):
+        """
+        Blocks until the provided number of bytes, sent as part of a request
+        already in flight, can be paid for.
+        """
+        if not self.bytes_per_second or nbytes <= 0:
+            return
+        with self.condition:
+            while True:
+                wait = self.spend(nbytes)
+                if not wait:
+                    return
+                self.condition.wait(wait)
+
+    def get_transfer_subscriber(self):
+        """
+        Returns a subscriber for boto's transfer manager that pays for
+        each chunk of an upload as it's read.
+        """
+        return _TransferSubscriber(self)
+
+    def release(self):
+        """
+        Finishes a request, and lets one more into flight for every
+        limit's worth that goes through.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.limit = min(float(self.max_in_flight), self.limit + 1.0 / self.limit)
+            self.condition.notify()
+
+    def throttled(self):
+        """
+        Halves the number of requests allowed in flight.
+        """
+        with self.condition:
+            self.throttles += 1
+            now = time.monotonic()
+            if self.last_throttle is not None and now - self.last_throttle < self.cooldown:
+                return
+            self.last_throttle = now
+            self.limit = max(float(self.min_in_flight), self.limit / 2)
+            logger.debug("Throttled by S3, allowing {} requests in flight".format(int(self.limit)))
+
+    def request(self, nbytes=0):
+        """
+        Returns a context manager that holds a request's place in flight.
+        """
+        return _Request(self, nbytes)
+
+    def watch_client(self, s3_client):
+        """
+        Registers with the provided boto client, or aiobotocore client,
+        so the limiter hears about every throttled response, including
+        those boto retries on its own.
+        """
+        s3_client.meta.events.register('needs-retry.s3', self.on_needs_retry)
+
+    def on_needs_retry(self, response=None, **kwargs):
+        if response is None:
+            return
+        error = response[1].get('Error', {})
+        status = response[1].get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if error.get('Code') in THROTTLING_ERROR_CODES or status == 503:
+            self.throttled()
+
+
+class _Request(object):
+
+    def __init__(self, limiter, nbytes):
+        self.limiter = limiter
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.limiter.acquire(self.nbytes)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.limiter.release()
+
+    async def __aenter__(self):
+        await self.limiter.acquire_async(self.nbytes)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.limiter.release()
+
+
+class _TransferSubscriber(BaseSubscriber):
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def on_progress(self, bytes_transferred, **kwargs):
+        self.limiter.consume(bytes_transferred)
@@ -9,6 +9,64 @@ from django.db import models
 from django.db import transaction
 
 
+class BuildableQuerySet(models.QuerySet):
+    """
+    A queryset of buildable objects that can all be built, or unbuilt, at once.
+
+    Use it through BuildableManager, or your own manager made with
+    from_queryset, for backfills where calling build() on each object
+    would rebuild the same related content over and over.
+    """
+    def bulk_build(self, chunk_size=2000):
+        """
+        Builds every object in the queryset, as build() does for one.
+
+        Each detail view is created once and reused for every object, which
+        are loaded chunk_size at a time. _build_extra() runs for each object,
+        but _build_related() only once at the end.
+
+        Returns the set of paths in the build directory that were written,
+        relative to it.
+        """
+        return self._bulk_build('build_object', '_build_extra', chunk_size)
+
+    def bulk_unbuild(self, chunk_size=2000):
+        """
+        Unbuilds every object in the queryset, as unbuild() does for one.
+
+        _build_related() runs once at the end to drop the objects from
+        feeds and the like.
+
+        Returns the set of paths in the build directory that were removed
+        or rewritten, relative to it.
+        """
+        return self._bulk_build('unbuild_object', '_unbuild_extra', chunk_size)
+
+    def _bulk_build(self, view_method, extra_method, chunk_size):
+        from bakery.views.base import record_build_paths
+        views = {}
+        last_obj = None
+        with record_build_paths() as paths:
+            for obj in self.iterator(chunk_size=chunk_size):
+                for detail_view in obj.detail_views:
+                    if detail_view not in views:
+                        views[detail_view] = obj._get_view(detail_view)()
+                    getattr(views[detail_view], view_method)(obj)
+                getattr(obj, extra_method)()
+                last_obj = obj
+            # Related content covers the whole model, so it only needs one build
+            if last_obj is not None:
+                last_obj._build_related()
+        return paths
+
+
+class BuildableManager(models.Manager.from_queryset(BuildableQuerySet)):
+    """
+    A manager that adds bulk_build and bulk_unbuild to buildable models.
+    """
+    pass
+
+
 class BuildableModel(models.Model):
     """
     An abstract base model for an object that builds out
@@ -38,6 +96,9 @@ class BuildableModel(models.Model):
         """
         Build extra content, like copying an image to a thumbnails folder under
         the media folder.
+
+        Files written without a view should be passed to
+        bakery.views.base.record_path so they're published.
         """
         pass
 
@@ -45,6 +106,9 @@ class BuildableModel(models.Model):
         """
         Remove extra content, like deleting an image from a thumbnails folder
         under the media folder.
+
+        Files removed without a view should be passed to
+        bakery.views.base.record_path so they're unpublished.
         """
         pass
 
@@ -53,25 +117,37 @@ class BuildableModel(models.Model):
         Iterates through the views pointed to by self.detail_views, runs
         build_object with `self`, and calls _build_extra()
         and _build_related().
+
+        Returns the set of paths in the build directory that were written,
+        relative to it.
         """
-        for detail_view in self.detail_views:
-            view = self._get_view(detail_view)
-            view().build_object(self)
-        self._build_extra()
-        self._build_related()
+        from bakery.views.base import record_build_paths
+        with record_build_paths() as paths:
+            for detail_view in self.detail_views:
+                view = self._get_view(detail_view)
+                view().build_object(self)
+            self._build_extra()
+            self._build_related()
+        return paths
 
     def unbuild(self):
         """
         Iterates through the views pointed to by self.detail_views, runs
         unbuild_object with `self`, and calls _build_extra()
         and _build_related().
+
+        Returns the set of paths in the build directory that were removed
+        or rewritten, relative to it.
         """
-        for detail_view in self.detail_views:
-            view = self._get_view(detail_view)
-            view().unbuild_object(self)
-        self._unbuild_extra()
-        # _build_related again to kill the object from RSS etc.
-        self._build_related()
+        from bakery.views.base import record_build_paths
+        with record_build_paths() as paths:
+            for detail_view in self.detail_views:
+                view = self._get_view(detail_view)
+                view().unbuild_object(self)
+            self._unbuild_extra()
+            # _build_related again to kill the object from RSS etc.
+            self._build_related()
+        return paths
 
     def get_absolute_url(self):
         pass
@@ -114,28 +190,119 @@ class AutoPublishingBuildableModel(BuildableModel):
         """
         return getattr(self, self.publication_status_field)
 
+    def get_publication_status_fields(self):
+        """
+        Returns the names of the fields that get_publication_status reads.
+
+        Only these are remembered when the object is loaded, so a save can
+        tell the previous status without reading the row again. Models that
+        override get_publication_status should list the fields it uses.
+        """
+        return [self.publication_status_field]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """
+        Remembers the publication status fields the object was loaded with.
+        """
+        instance = super(AutoPublishingBuildableModel, cls).from_db(db, field_names, values)
+        instance._loaded_values = {}
+        instance._remember_loaded_values()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        """
+        Remembers the publication status fields read back from the database.
+        """
+        super(AutoPublishingBuildableModel, self).refresh_from_db(using=using, fields=fields, **kwargs)
+        if hasattr(self, '_loaded_values'):
+            self._remember_loaded_values(fields)
+
+    def get_loaded_publication_status(self):
+        """
+        Returns the publication status the object had in the database before
+        this save, or None if it's a new record.
+
+        Objects loaded from the database answer from the values they were
+        loaded with. Only objects created by hand with a primary key set
+        need to go back to the database.
+        """
+        loaded_values = getattr(self, '_loaded_values', None)
+        if loaded_values is None:
+            if self.pk is None:
+                return None
+            try:
+                return self.__class__.objects.get(pk=self.pk).get_publication_status()
+            except self.__class__.DoesNotExist:
+                return None
+        # Anything that wasn't remembered is deferred and read on access
+        field_names = [
+            f.attname for f in self._meta.concrete_fields
+            if f.attname in loaded_values
+        ]
+        loaded = self.__class__.from_db(
+            self._state.db,
+            field_names,
+            [loaded_values[name] for name in field_names]
+        )
+        return loaded.get_publication_status()
+
+    def _remember_loaded_values(self, fields=None):
+        """
+        Records the current values of the primary key and the publication
+        status fields as the ones in the database.
+
+        Limited to the provided field names when there are any.
+        """
+        loaded_values = getattr(self, '_loaded_values', None) or {}
+        status_fields = set(self.get_publication_status_fields())
+        for field in self._meta.concrete_fields:
+            if not field.primary_key and field.name not in status_fields and field.attname not in status_fields:
+                continue
+            if fields is not None and field.name not in fields and field.attname not in fields:
+                continue
+            # Skip deferred fields, which weren't loaded or saved
+            if field.attname in self.__dict__:
+                loaded_values[field.attname] = self.__dict__[field.attname]
+        self._loaded_values = loaded_values
+
+    def _queue_task(self, task, pk):
+        """
+        Sends the provided task once the current transaction commits,
+        or right away outside of one.
+        """
+        from django.contrib.contenttypes.models import ContentType
+        model = self.__class__
+        using = self._state.db
+
+        def send():
+            # ContentType's manager caches the lookup after the first call
+            ct = ContentType.objects.db_manager(using).get_for_model(model)
+            task.delay(ct.pk, pk)
+        transaction.on_commit(send, using=using)
+
     def save(self, *args, **kwargs):
         """
         A custom save that publishes or unpublishes the object where
         appropriate.
 
+        The task is sent once the save's transaction commits, so it never
+        sees the database before the change. Saves made together inside
+        a transaction.atomic block all go out after it.
+
         Save with keyword argument obj.save(publish=False) to skip the process.
         """
         from bakery import tasks
-        from django.contrib.contenttypes.models import ContentType
         # if obj.save(publish=False) has been passed, we skip everything.
         if not kwargs.pop('publish', True):
             super(AutoPublishingBuildableModel, self).save(*args, **kwargs)
         # Otherwise, for the standard obj.save(), here we go...
         else:
-            # First figure out if the record is an addition, or an edit of
-            # a preexisting record.
-            try:
-                preexisting = self.__class__.objects.get(pk=self.pk)
-            except self.__class__.DoesNotExist:
-                preexisting = None
+            # First figure out what the record's status was before, if
+            # it's an edit of a preexisting record.
+            preexisting_status = self.get_loaded_publication_status()
             # If this is an addition...
-            if not preexisting:
+            if preexisting_status is None:
                 # We will publish if that's the boolean
                 if self.get_publication_status():
                     action = 'publish'
@@ -145,8 +312,7 @@ class AutoPublishingBuildableModel(BuildableModel):
             # If this is an edit...
             else:
                 # If it's being unpublished...
-                if not self.get_publication_status() and \
-                        preexisting.get_publication_status():
+                if not self.get_publication_status() and preexisting_status:
                     action = 'unpublish'
                 # If it's being published...
                 elif self.get_publication_status():
@@ -157,14 +323,14 @@ class AutoPublishingBuildableModel(BuildableModel):
             # Now, no matter what, save it normally inside of a dedicated
             # database transaction so that we are sure that the save will
             # be complete before we trigger any task
-            with transaction.atomic():
+            with transaction.atomic(using=kwargs.get('using')):
                 super(AutoPublishingBuildableModel, self).save(*args, **kwargs)
             # Finally, depending on the action, fire off a task
-            ct = ContentType.objects.get_for_model(self.__class__)
             if action == 'publish':
-                tasks.publish_object.delay(ct.pk, self.pk)
+                self._queue_task(tasks.publish_object, self.pk)
             elif action == 'unpublish':
-                tasks.unpublish_object.delay(ct.pk, self.pk)
+                self._queue_task(tasks.unpublish_object, self.pk)
+        self._remember_loaded_values(kwargs.get('update_fields'))
 
     def delete(self, *args, **kwargs):
         """
@@ -173,14 +339,14 @@ class AutoPublishingBuildableModel(BuildableModel):
         Save with keyword argument obj.delete(unpublish=False) to skip it.
         """
         from bakery import tasks
-        from django.contrib.contenttypes.models import ContentType
         # if obj.save(unpublish=False) has been passed, we skip the task.
         unpublish = kwargs.pop('unpublish', True)
+        # Django clears the primary key once the row is gone
+        pk = self.pk
         # Delete it from the database
         super(AutoPublishingBuildableModel, self).delete(*args, **kwargs)
         if unpublish:
-            ct = ContentType.objects.get_for_model(self.__class__)
-            tasks.unpublish_object.delay(ct.pk, self.pk)
+            self._queue_task(tasks.unpublish_object, pk)
 
     class Meta:
         abstract = True
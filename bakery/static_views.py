@@ -2,6 +2,7 @@
 Views and functions for serving static files. These are only to be used
 during development, and SHOULD NOT be used in a production setting.
 """
+import gzip
 import django
 import mimetypes
 import os
@@ -11,7 +12,7 @@ import stat
 from six.moves.urllib.parse import unquote
 from django.template import loader
 from django.http import Http404, HttpResponse, HttpResponseRedirect
-from django.http import HttpResponseNotModified
+from django.http import FileResponse, HttpResponseNotModified
 from django.template import Template, Context, TemplateDoesNotExist
 from django.utils.http import http_date, parse_http_date
 
@@ -64,25 +65,227 @@ def serve(request, path, document_root=None, show_indexes=False, default=''):
         raise Http404("Directory indexes are not allowed here.")
     if not os.path.exists(fullpath):
         raise Http404('"%s" does not exist' % fullpath)
-    # Respect the If-Modified-Since header.
-    statobj = os.stat(fullpath)
     mimetype = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
-    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
-                              statobj[stat.ST_MTIME], statobj[stat.ST_SIZE]):
+    # Pick the copy of the file to send, and how it's encoded
+    fullpath, encoding, decompress, negotiated = get_representation(request, fullpath)
+    statobj = os.stat(fullpath)
+    etag = get_etag(statobj, 'identity' if decompress else None)
+    last_modified = http_date(statobj[stat.ST_MTIME])
+    # Respect the If-None-Match header, or failing that If-Modified-Since.
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        not_modified = etag_matches(if_none_match, etag)
+    else:
+        not_modified = not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                                              statobj[stat.ST_MTIME], statobj[stat.ST_SIZE])
+    if not_modified:
         if django.VERSION > (1, 6):
-            return HttpResponseNotModified(content_type=mimetype)
+            response = HttpResponseNotModified(content_type=mimetype)
         else:
-            return HttpResponseNotModified(mimetype=mimetype)
-    contents = open(fullpath, 'rb').read()
-    if django.VERSION > (1, 6):
-        response = HttpResponse(contents, content_type=mimetype)
+            response = HttpResponseNotModified(mimetype=mimetype)
+        response["ETag"] = etag
+        if negotiated:
+            response["Vary"] = "Accept-Encoding"
+        return response
+
+    # Only send part of the file if that's what was asked for, and the
+    # If-Range header, if any, still matches the file. Ranges of a file
+    # being decompressed on the fly would mean decompressing up to them,
+    # so those get the whole file.
+    size = statobj[stat.ST_SIZE]
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if 'HTTP_RANGE' in request.META and not decompress and \
+            (if_range is None or if_range.strip() in (etag, last_modified)):
+        byte_range = parse_range(request.META['HTTP_RANGE'], size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = "bytes */%d" % size
+        return response
+
+    # Stream the file, so the server can hand it to sendfile or the
+    # WSGI file wrapper rather than reading it into memory.
+    if decompress:
+        # The decompressed size isn't known, so no Content-Length
+        response = FileResponse(FileRange(gzip.open(fullpath, 'rb')), content_type=mimetype)
     else:
-        response = HttpResponse(contents, mimetype=mimetype)
-    response["Last-Modified"] = http_date(statobj[stat.ST_MTIME])
-    response["Content-Length"] = len(contents)
+        f = open(fullpath, 'rb')
+        if byte_range is None:
+            response = FileResponse(f, content_type=mimetype)
+            response["Content-Length"] = size
+        else:
+            start, end = byte_range
+            response = FileResponse(FileRange(f, start, end - start + 1), status=206, content_type=mimetype)
+            response["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+            response["Content-Length"] = end - start + 1
+        response["Accept-Ranges"] = "bytes"
+    # FileResponse names the open file in a Content-Disposition header,
+    # which the old HttpResponse never sent
+    del response["Content-Disposition"]
+    if encoding:
+        response["Content-Encoding"] = encoding
+    if negotiated:
+        response["Vary"] = "Accept-Encoding"
+    response["Last-Modified"] = last_modified
+    response["ETag"] = etag
     return response
 
 
+# The encodings of the precompressed copies we look for beside a file,
+# in the order we'd rather send them
+SIDECAR_ENCODINGS = (
+    ('br', '.br'),
+    ('gzip', '.gz'),
+)
+
+
+def get_representation(request, fullpath):
+    """
+    Decides which bytes to send for the file at the provided path.
+
+    Files that build gzipped in place are sent as they are to clients that
+    accept gzip, and decompressed on the way out for those that don't.
+    Otherwise a .br or .gz copy beside the file is sent to clients that
+    accept its encoding.
+
+    Returns the path of the file to send, its Content-Encoding, whether it
+    needs to be decompressed, and whether the choice depended on the
+    request's Accept-Encoding header.
+    """
+    accepted = parse_accept_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    # Archives like .tar.gz are meant to be downloaded compressed
+    if mimetypes.guess_type(fullpath)[1] is None and is_gzipped(fullpath):
+        if accepts_encoding(accepted, 'gzip'):
+            return fullpath, 'gzip', False, True
+        return fullpath, None, True, True
+    negotiated = False
+    for encoding, extension in SIDECAR_ENCODINGS:
+        if os.path.isfile(fullpath + extension):
+            negotiated = True
+            if accepts_encoding(accepted, encoding):
+                return fullpath + extension, encoding, False, True
+    return fullpath, None, False, negotiated
+
+
+def is_gzipped(fullpath):
+    """
+    Does the file start with gzip's magic number?
+    """
+    with open(fullpath, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def parse_accept_encoding(header):
+    """
+    Parses an Accept-Encoding header into a dict mapping each
+    content coding to its quality.
+    """
+    accepted = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        matches = re.search(r"q\s*=\s*([0-9.]+)", params)
+        if matches:
+            try:
+                quality = float(matches.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+def accepts_encoding(accepted, encoding):
+    """
+    Does the parsed Accept-Encoding header allow the provided content coding?
+    """
+    if encoding in accepted:
+        return accepted[encoding] > 0
+    return accepted.get('*', 0) > 0
+
+
+class FileRange(object):
+    """
+    A file-like view of part of an open file, so a FileResponse only
+    streams the bytes from start, up to the provided length or the end.
+
+    Only reading and closing are offered, so FileResponse streams it as it
+    is rather than measuring it or handing it to sendfile.
+    """
+    def __init__(self, f, start=0, length=None):
+        if start:
+            f.seek(start)
+        self.file = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining is None:
+            return self.file.read(size)
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def get_etag(statobj, suffix=None):
+    """
+    Returns a strong ETag for a file made from its modification time and
+    size, as nginx and Apache do, rather than hashing its contents.
+
+    A suffix tells apart other representations made from the same file.
+    """
+    if suffix:
+        return '"%x-%x-%s"' % (statobj.st_mtime_ns, statobj[stat.ST_SIZE], suffix)
+    return '"%x-%x"' % (statobj.st_mtime_ns, statobj[stat.ST_SIZE])
+
+
+def etag_matches(header, etag):
+    """
+    Does the If-None-Match header list the provided ETag?
+
+    Comparisons are weak, as RFC 7232 asks for If-None-Match.
+    """
+    if header.strip() == '*':
+        return True
+
+    def strip_weak(tag):
+        tag = tag.strip()
+        return tag[2:] if tag.startswith('W/') else tag
+    return strip_weak(etag) in [strip_weak(tag) for tag in header.split(',')]
+
+
+def parse_range(header, size):
+    """
+    Parses a Range header for a file of the provided size.
+
+    Returns the first and last bytes asked for, False if none of them are
+    in the file, or None if the header should be ignored and the whole file
+    sent, as it is for malformed headers and requests for several ranges.
+    """
+    matches = re.match(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$", header)
+    if not matches or not (matches.group(1) or matches.group(2)):
+        return None
+    if not matches.group(1):
+        # A suffix, like the last 500 bytes
+        length = int(matches.group(2))
+        if not length or not size:
+            return False
+        return (max(0, size - length), size - 1)
+    start = int(matches.group(1))
+    if start >= size:
+        return False
+    end = int(matches.group(2)) if matches.group(2) else size - 1
+    if end < start:
+        return None
+    return (start, min(end, size - 1))
+
+
 DEFAULT_DIRECTORY_INDEX_TEMPLATE = """
 <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" \
 "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
@@ -1,18 +1,183 @@
+import time
+import uuid
 import logging
+from contextlib import contextmanager
 from django.conf import settings
 from django.core import management
+from django.db import router
+from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
+from bakery.views.base import build_database
 logger = logging.getLogger(__name__)
 try:
-    from celery import shared_task
+    from celery import chord, shared_task
 except ImportError:
     raise ImportError("celery must be installed to use django-bakery's tasks")
 
+# The cache keys used to coordinate publishes between workers
+PUBLISH_PENDING_KEY = 'bakery:publish:pending'
+PUBLISH_PATHS_KEY = 'bakery:publish:paths'
+PUBLISH_PATHS_LOCK_KEY = 'bakery:publish:paths:lock'
+PUBLISH_SCHEDULED_KEY = 'bakery:publish:scheduled'
+PUBLISH_LOCK_KEY = 'bakery:publish:lock'
+
+
+def get_publish_window():
+    """
+    Returns the number of seconds to wait for more changes before publishing.
+    """
+    return getattr(settings, 'BAKERY_PUBLISH_DEBOUNCE', 0)
+
+
+@contextmanager
+def paths_lock():
+    """
+    Holds a short-lived lock on the list of paths waiting to be published.
+    """
+    token = str(uuid.uuid4())
+    while not cache.add(PUBLISH_PATHS_LOCK_KEY, token, 30):
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        if cache.get(PUBLISH_PATHS_LOCK_KEY) == token:
+            cache.delete(PUBLISH_PATHS_LOCK_KEY)
+
+
+def schedule_publish(paths=None, delay=0):
+    """
+    Asks for a publish of the provided paths in the build directory,
+    or of everything that's been built if there's no list.
+
+    Requests are coalesced. Rather than publishing right away, the first
+    request schedules a publish once the window set by BAKERY_PUBLISH_DEBOUNCE,
+    or the provided delay in seconds if it's longer, has passed, and any that
+    arrive before then are folded into it. Requests that arrive while a
+    publish is running are folded into one follow-up.
+
+    The state is kept in Django's cache, which must be shared by every
+    worker for publishes to be coalesced between them.
+    """
+    # Run the `publish` management command unless the
+    # ALLOW_BAKERY_AUTO_PUBLISHING variable is explictly set to False.
+    if not getattr(settings, 'ALLOW_BAKERY_AUTO_PUBLISHING', True):
+        logger.info("Not running publish command because \
+ALLOW_BAKERY_AUTO_PUBLISHING is False")
+        return
+    if paths is None:
+        cache.set(PUBLISH_PENDING_KEY, True, None)
+    elif not paths:
+        logger.debug("No paths to publish")
+        return
+    else:
+        with paths_lock():
+            pending_paths = cache.get(PUBLISH_PATHS_KEY) or set()
+            pending_paths.update(paths)
+            cache.set(PUBLISH_PATHS_KEY, pending_paths, None)
+    window = max(get_publish_window(), delay)
+    # Only the first request in the window schedules the publish
+    if cache.add(PUBLISH_SCHEDULED_KEY, True, window + getattr(settings, 'BAKERY_PUBLISH_LOCK_TIMEOUT', 3600)):
+        publish_pending.apply_async(countdown=window)
+    else:
+        logger.debug("Publish already scheduled")
+
+
+def get_targeted_paths(paths):
+    """
+    Returns the provided paths if only they should be published, or None
+    if BAKERY_PUBLISH_TARGETED is False and everything should be synced.
+    """
+    if not getattr(settings, 'BAKERY_PUBLISH_TARGETED', True):
+        return None
+    return paths
+
+
+@shared_task()
+def publish_pending():
+    """
+    Syncs the build directory with S3 if a publish has been asked for.
+
+    Only one runs at a time. If another publish is running, this one is put
+    off until the end of another window.
+    """
+    token = str(uuid.uuid4())
+    lock_timeout = getattr(settings, 'BAKERY_PUBLISH_LOCK_TIMEOUT', 3600)
+    if not cache.add(PUBLISH_LOCK_KEY, token, lock_timeout):
+        logger.debug("Publish already running, trying again later")
+        publish_pending.apply_async(countdown=max(get_publish_window(), 1))
+        return
+
+    everything = False
+    paths = None
+    try:
+        # From here on, new requests need a publish of their own
+        cache.delete(PUBLISH_SCHEDULED_KEY)
+        with paths_lock():
+            paths = cache.get(PUBLISH_PATHS_KEY)
+            cache.delete(PUBLISH_PATHS_KEY)
+        # A request for everything covers any list of paths
+        everything = cache.delete(PUBLISH_PENDING_KEY)
+        if everything:
+            management.call_command("publish")
+        elif paths:
+            management.call_command("publish", paths=sorted(paths))
+        else:
+            logger.debug("Nothing to publish")
+    except Exception:
+        # Log the error if this crashes
+        logger.error("Task Error: publish_pending", exc_info=True)
+        # Then ask again for what we took, so it isn't lost
+        if everything or paths:
+            schedule_publish(
+                None if everything else paths,
+                delay=getattr(settings, 'BAKERY_PUBLISH_RETRY_DELAY', 60)
+            )
+    finally:
+        # Only let go of the lock if it's still ours
+        if cache.get(PUBLISH_LOCK_KEY) == token:
+            cache.delete(PUBLISH_LOCK_KEY)
+
+
+def get_build_database(model, pk):
+    """
+    Returns the alias of the database to build the provided object from.
+
+    If BAKERY_DATABASE points builds at a replica, waits up to
+    BAKERY_DATABASE_LAG_TIMEOUT seconds for the replica's copy of the object
+    to match the primary's, so a page isn't built from the row as it was
+    before the save. If the replica doesn't catch up in time, returns None
+    so the build reads from the primary instead.
+    """
+    alias = getattr(settings, 'BAKERY_DATABASE', None)
+    if not alias:
+        return None
+    primary = router.db_for_write(model)
+    if alias == primary:
+        return alias
+    fields = [f.attname for f in model._meta.concrete_fields]
+
+    def fetch(using):
+        return model._base_manager.using(using).filter(pk=pk).values_list(*fields).first()
+
+    expected = fetch(primary)
+    deadline = time.time() + getattr(settings, 'BAKERY_DATABASE_LAG_TIMEOUT', 5)
+    while fetch(alias) != expected:
+        if time.time() >= deadline:
+            logger.warning("{} {} is out of date in the {} database. Building from {} instead.".format(
+                model.__name__,
+                pk,
+                alias,
+                primary
+            ))
+            return None
+        time.sleep(0.1)
+    return alias
+
 
 @shared_task()
 def publish_object(content_type_pk, obj_pk):
     """
-    Build all views related to an object, and then sync with S3.
+    Build all views related to an object, and then schedule a sync with S3.
 
     Accepts primary keys to retrieve a model object that
     inherits bakery's BuildableModel class.
@@ -22,14 +187,10 @@ def publish_object(content_type_pk, obj_pk):
     try:
         # Build the object
         logger.info("publish_object task has received %s" % obj)
-        obj.build()
-        # Run the `publish` management command unless the
-        # ALLOW_BAKERY_AUTO_PUBLISHING variable is explictly set to False.
-        if not getattr(settings, 'ALLOW_BAKERY_AUTO_PUBLISHING', True):
-            logger.info("Not running publish command because \
-ALLOW_BAKERY_AUTO_PUBLISHING is False")
-        else:
-            management.call_command("publish")
+        with build_database(get_build_database(obj.__class__, obj.pk)):
+            paths = obj.build()
+        # Publish it along with anything else built around the same time
+        schedule_publish(get_targeted_paths(paths))
     except Exception:
         # Log the error if this crashes
         logger.error("Task Error: publish_object", exc_info=True)
@@ -38,7 +199,7 @@ ALLOW_BAKERY_AUTO_PUBLISHING is False")
 @shared_task()
 def unpublish_object(content_type_pk, obj_pk):
     """
-    Unbuild all views related to a object and then sync to S3.
+    Unbuild all views related to a object and then schedule a sync with S3.
 
     Accepts primary keys to retrieve a model object that
     inherits bakery's BuildableModel class.
@@ -48,14 +209,122 @@ def unpublish_object(content_type_pk, obj_pk):
     try:
         # Unbuild the object
         logger.info("unpublish_object task has received %s" % obj)
-        obj.unbuild()
-        # Run the `publish` management command unless the
-        # ALLOW_BAKERY_AUTO_PUBLISHING variable is explictly set to False.
-        if not getattr(settings, 'ALLOW_BAKERY_AUTO_PUBLISHING', True):
-            logger.info("Not running publish command because \
-ALLOW_BAKERY_AUTO_PUBLISHING is False")
-        else:
-            management.call_command("publish")
+        with build_database(get_build_database(obj.__class__, obj.pk)):
+            paths = obj.unbuild()
+        # Publish it along with anything else built around the same time
+        schedule_publish(get_targeted_paths(paths))
     except Exception:
         # Log the error if this crashes
         logger.error("Task Error: unpublish_object", exc_info=True)
+
+
+def get_build_command(build_dir=None, view_list=None):
+    """
+    Returns an instance of the build management command, set up to build
+    into the provided directory, or BUILD_DIR if there isn't one.
+    """
+    from bakery.management.commands.build import Command
+    cmd = Command()
+    cmd.set_options(build_dir=build_dir or '', view_list=view_list or [], verbosity=0)
+    return cmd
+
+
+def get_build_manifest(cmd, build):
+    """
+    Runs the provided function with the build command's database and query
+    limits, and returns a sorted list of the paths it wrote in the build directory.
+    """
+    from bakery.views.base import record_build_paths
+    from bakery.management.commands.build import limit_queries
+    with record_build_paths() as paths, build_database(cmd.database), limit_queries(cmd.query_limiter):
+        build()
+    return sorted(paths)
+
+
+@shared_task()
+def build_static(build_dir=None):
+    """
+    Collects the static files into the build directory.
+
+    Returns the manifest of paths it wrote.
+    """
+    cmd = get_build_command(build_dir)
+    return get_build_manifest(cmd, cmd.build_static)
+
+
+@shared_task()
+def build_media(build_dir=None):
+    """
+    Copies the media files into the build directory.
+
+    Returns the manifest of paths it wrote.
+    """
+    cmd = get_build_command(build_dir)
+    return get_build_manifest(cmd, cmd.build_media)
+
+
+@shared_task()
+def build_view(view_str, shard=None, build_dir=None):
+    """
+    Builds the provided view, or the provided (index, count) shard
+    of a detail view's objects.
+
+    Returns the manifest of paths it wrote.
+    """
+    cmd = get_build_command(build_dir, [view_str])
+    return get_build_manifest(cmd, lambda: cmd.build_view(view_str, shard))
+
+
+@shared_task()
+def finish_build(manifests, publish=True):
+    """
+    Merges the manifests of a distributed build's tasks and, unless
+    told not to, publishes the result.
+
+    Returns the merged manifest.
+    """
+    paths = set()
+    for manifest in manifests:
+        paths.update(manifest)
+    logger.info("Distributed build wrote {} files".format(len(paths)))
+    if publish:
+        management.call_command("publish")
+    return sorted(paths)
+
+
+def distributed_build(build_dir=None, view_list=None, shards=None,
+                      skip_static=False, skip_media=False, publish=True):
+    """
+    Rebuilds the whole site with a Celery task for each part of it,
+    then publishes it once they've all finished.
+
+    Static and media files, and each view, are built by tasks of their
+    own. Detail views are split into shards of their objects, by default
+    as many as BAKERY_BUILD_SHARDS. Every worker must write to the same
+    build directory, either on shared storage or through BAKERY_FILESYSTEM.
+
+    The build directory is cleared first, here, rather than in a task.
+    Returns the chord's AsyncResult.
+    """
+    from bakery.views import BuildableDetailView
+    try:
+        from django.core.urlresolvers import get_callable
+    except ImportError:  # Starting with Django 2.0, django.core.urlresolvers does not exist anymore
+        from django.urls import get_callable
+    cmd = get_build_command(build_dir, view_list)
+    cmd.init_build_dir()
+    if shards is None:
+        shards = getattr(settings, 'BAKERY_BUILD_SHARDS', 1)
+
+    header = []
+    if not skip_static:
+        header.append(build_static.si(build_dir))
+    if not skip_media:
+        header.append(build_media.si(build_dir))
+    for view_str in cmd.view_list:
+        if shards > 1 and issubclass(get_callable(view_str), BuildableDetailView):
+            header.extend(build_view.si(view_str, (i, shards), build_dir) for i in range(shards))
+        else:
+            header.append(build_view.si(view_str, None, build_dir))
+    logger.debug("Sending {} build tasks".format(len(header)))
+    return chord(header)(finish_build.s(publish=publish))
@@ -4,19 +4,36 @@ import six
 import boto3
 import json
 import random
+import time
+import tempfile
+import threading
 from pathlib import Path
 from moto import mock_aws
+from moto.server import ThreadedMotoServer
+from botocore.exceptions import ClientError
 from datetime import date
 from .. import views, feeds
 from django.db import models
 from .. import static_views
 from django.conf import settings
 from .. import models as bmodels
-from ..management.commands import get_s3_client
+from ..management.digests import DigestCache
+from ..management.journal import PublishJournal
+from ..management.rate_limit import RateLimiter
+from ..management.bucket_index import BucketIndex, pack_record, unpack_record
+from ..management.commands import (
+    batch_delete_s3_objects,
+    get_s3_client,
+    get_transfer_config,
+    scan_directory
+)
+from ..management.commands.build import Command as BuildCommand
+from ..management.commands.publish import Command as PublishCommand
 from django.http import HttpResponse
 from django.core.management import call_command
 from django.test import TestCase, RequestFactory, override_settings
 from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import CommandError
 
 try:
     from django.urls import reverse_lazy
@@ -45,6 +62,7 @@ class MockObject(bmodels.BuildableModel):
     detail_views = ['bakery.tests.MockDetailView']
     name = models.CharField(max_length=500)
     pub_date = models.DateField()
+    objects = bmodels.BuildableManager()
 
     def get_absolute_url(self):
         super(MockObject, self).get_absolute_url()  # Just for test coverage
@@ -159,6 +177,7 @@ class MockJSONView(JSONResponseMixin, views.BuildableTemplateView):
 
 
 class BakeryTest(TestCase):
+    databases = {'default', 'replica'}
 
     def setUp(self):
         self.factory = RequestFactory()
@@ -174,6 +193,107 @@ class BakeryTest(TestCase):
             obj.unbuild()
             obj.get_absolute_url()
 
+    def test_models_build_paths(self):
+        obj = MockObject.objects.all()[0]
+        key = '%s/index.html' % obj.id
+        self.assertEqual(obj.build(), set([key]))
+        self.assertEqual(obj.unbuild(), set([key]))
+
+        # Paths are recorded by every block they're built inside
+        with views.base.record_build_paths() as outer:
+            with views.base.record_build_paths() as inner:
+                obj.build()
+            views.base.record_path(os.path.join(settings.BUILD_DIR, 'extra.txt'))
+        self.assertEqual(inner, set([key]))
+        self.assertEqual(outer, set([key, 'extra.txt']))
+
+    def test_models_bulk_build(self):
+        from unittest import mock
+        keys = set('%s/index.html' % obj.id for obj in MockObject.objects.all())
+        with mock.patch.object(MockObject, '_build_related') as build_related, \
+                mock.patch.object(MockObject, '_get_view', wraps=MockObject()._get_view) as get_view:
+            self.assertEqual(MockObject.objects.all().bulk_build(chunk_size=2), keys)
+            # The view and related content are only set up once
+            self.assertEqual(get_view.call_count, 1)
+            self.assertEqual(build_related.call_count, 1)
+            for key in keys:
+                self.assertTrue(MockDetailView.fs.exists(os.path.join(settings.BUILD_DIR, key)))
+
+            self.assertEqual(MockObject.objects.filter(name=1).bulk_unbuild(), set(['1/index.html']))
+            self.assertFalse(MockDetailView.fs.exists(os.path.join(settings.BUILD_DIR, '1')))
+            self.assertEqual(build_related.call_count, 2)
+
+            # An empty queryset builds nothing
+            self.assertEqual(MockObject.objects.none().bulk_build(), set())
+            self.assertEqual(build_related.call_count, 2)
+
+    def test_auto_publishing_save(self):
+        from unittest import mock
+        from bakery import tasks
+        from django.db import transaction
+        from django.contrib.contenttypes.models import ContentType
+        ct = ContentType.objects.get_for_model(AutoMockObject)
+        with mock.patch.object(tasks.publish_object, 'delay') as publish, \
+                mock.patch.object(tasks.unpublish_object, 'delay') as unpublish:
+            obj = AutoMockObject.objects.all()[0]
+            obj.is_published = True
+            # A loaded object is saved without reading its row again
+            with self.captureOnCommitCallbacks() as callbacks:
+                with self.assertNumQueries(3):
+                    obj.save()
+            self.assertFalse(publish.called)
+            for callback in callbacks:
+                callback()
+            publish.assert_called_once_with(ct.pk, obj.pk)
+
+            # The loaded status follows the object through saves
+            obj.is_published = False
+            with self.captureOnCommitCallbacks(execute=True):
+                obj.save()
+            unpublish.assert_called_once_with(ct.pk, obj.pk)
+            with self.captureOnCommitCallbacks(execute=True):
+                obj.save()
+            self.assertEqual(unpublish.call_count, 1)
+
+            # Tasks wait for the transaction to commit
+            publish.reset_mock()
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                with transaction.atomic():
+                    for obj in AutoMockObject.objects.all():
+                        obj.is_published = True
+                        obj.save()
+                    self.assertFalse(publish.called)
+            self.assertEqual(publish.call_count, 3)
+
+            # Objects made by hand are checked against the database
+            unpublish.reset_mock()
+            copy = AutoMockObject(pk=obj.pk, name=obj.name, pub_date=obj.pub_date)
+            with self.captureOnCommitCallbacks(execute=True):
+                copy.save()
+            unpublish.assert_called_once_with(ct.pk, obj.pk)
+
+            # Deletes are unpublished by the primary key they had
+            unpublish.reset_mock()
+            pk = copy.pk
+            with self.captureOnCommitCallbacks(execute=True):
+                copy.delete()
+            unpublish.assert_called_once_with(ct.pk, pk)
+
+    def test_auto_publishing_refresh_from_db(self):
+        from unittest import mock
+        from bakery import tasks
+        obj = AutoMockObject.objects.all()[0]
+        # Only the fields the status is read from are remembered
+        self.assertEqual(obj._loaded_values, {'id': obj.pk, 'is_published': False})
+        AutoMockObject.objects.filter(pk=obj.pk).update(is_published=True)
+        obj.refresh_from_db()
+        self.assertEqual(obj._loaded_values, {'id': obj.pk, 'is_published': True})
+        with mock.patch.object(tasks.unpublish_object, 'delay') as unpublish:
+            obj.is_published = False
+            with self.captureOnCommitCallbacks(execute=True):
+                obj.save()
+            self.assertTrue(unpublish.called)
+
     def test_template_view_with_explicit_filename(self):
         v = views.BuildableTemplateView(
             template_name='templateview.html',
@@ -357,6 +477,47 @@ class BakeryTest(TestCase):
         )
         self.assertTrue(os.path.exists(build_path))
 
+    def test_redirect_view_post_publish(self):
+        class RecordingClient(object):
+            def __init__(self):
+                self.calls = []
+
+            def copy_object(self, **kwargs):
+                self.calls.append(kwargs)
+
+        class MockBucket(object):
+            name = 'mock_bucket'
+
+        v = MockRedirectView()
+        client = RecordingClient()
+        # Not uploaded in this run, so nothing to do
+        v.post_publish(MockBucket(), uploads={}, s3_client=client)
+        # Uploaded with the header already in place
+        v.post_publish(
+            MockBucket(),
+            uploads={'detail/badurl.html': {'WebsiteRedirectLocation': '/detail/'}},
+            s3_client=client
+        )
+        self.assertEqual(client.calls, [])
+        # Uploaded without it
+        v.post_publish(MockBucket(), uploads={'detail/badurl.html': {}}, s3_client=client)
+        self.assertEqual(len(client.calls), 1)
+        self.assertEqual(client.calls[0]['WebsiteRedirectLocation'], '/detail/')
+        # Under the prefix the keys were published with
+        v.post_publish(MockBucket(), uploads={'detail/badurl.html': {}}, s3_client=client, prefix='www/')
+        self.assertEqual(client.calls[1]['Key'], 'www/detail/badurl.html')
+        self.assertEqual(client.calls[1]['CopySource']['Key'], 'www/detail/badurl.html')
+
+    def test_publish_redirect_header(self):
+        with mock_aws():
+            self._create_bucket()
+            with self.settings(BAKERY_VIEWS=('bakery.tests.MockRedirectView',)):
+                call_command("build")
+                call_command("publish")
+            s3_client, s3_resource = get_s3_client()
+            obj = s3_client.head_object(Bucket=settings.AWS_BUCKET_NAME, Key='detail/badurl.html')
+            self.assertEqual(obj['WebsiteRedirectLocation'], '/detail/')
+
     def test_404_view(self):
         v = views.Buildable404View()
         v.build_method
@@ -427,6 +588,104 @@ class BakeryTest(TestCase):
         with self.settings(STATIC_ROOT=Path(__file__).parent / "_static"):
             call_command("build", **{'verbosity': 3})
 
+    def test_build_shards(self):
+        tmp = tempfile.mkdtemp()
+        with self.settings(BUILD_DIR=settings.BUILD_DIR):
+            full_manifest = os.path.join(tmp, 'full.json')
+            call_command("build", build_dir=os.path.join(tmp, 'full'), manifest=full_manifest)
+            with open(full_manifest) as f:
+                full = json.load(f)
+            self.assertIn('robots.txt', full)
+
+            # Each shard builds its own slice, and together they build everything
+            shard_dirs = []
+            manifests = []
+            for i in (1, 2, 3):
+                shard_dirs.append(os.path.join(tmp, 'shard%s' % i))
+                manifests.append(os.path.join(tmp, 'shard%s.json' % i))
+                call_command("build", shard='%s/3' % i, build_dir=shard_dirs[-1], manifest=manifests[-1])
+            shard_lists = []
+            for manifest in manifests:
+                with open(manifest) as f:
+                    shard_lists.append(json.load(f))
+            self.assertEqual(sorted(sum(shard_lists, [])), full)
+            self.assertTrue(all(shard_lists))
+
+            # The same split is made every time
+            call_command("build", shard='2/3', build_dir=shard_dirs[1], manifest=manifests[1])
+            with open(manifests[1]) as f:
+                self.assertEqual(json.load(f), shard_lists[1])
+
+            merged_dir = os.path.join(tmp, 'merged')
+            merged_manifest = os.path.join(tmp, 'merged.json')
+            call_command(
+                "mergebuild",
+                *shard_dirs,
+                build_dir=merged_dir,
+                manifest=manifests,
+                merged_manifest=merged_manifest
+            )
+            with open(merged_manifest) as f:
+                self.assertEqual(json.load(f), full)
+            for key in full:
+                with open(os.path.join(tmp, 'full', key), 'rb') as a, open(os.path.join(merged_dir, key), 'rb') as b:
+                    self.assertEqual(a.read(), b.read())
+
+            # Without manifests, every file in the shard directories is merged
+            call_command("mergebuild", shard_dirs[0], build_dir=os.path.join(tmp, 'one'))
+            self.assertTrue(os.path.exists(os.path.join(tmp, 'one', shard_lists[0][0])))
+            # A file can't come from two shards, and nothing is copied if one does
+            with self.assertRaises(CommandError):
+                call_command("mergebuild", shard_dirs[0], shard_dirs[0], build_dir=os.path.join(tmp, 'two'))
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'two')))
+            # A shard can't be merged into itself
+            with self.assertRaises(CommandError):
+                call_command("mergebuild", shard_dirs[0], build_dir=shard_dirs[0])
+
+            # Files left by an earlier merge are cleared out, unless asked not to
+            stale_path = os.path.join(merged_dir, 'stale.html')
+            with open(stale_path, 'w') as f:
+                f.write('Stale')
+            call_command("mergebuild", *shard_dirs, build_dir=merged_dir, keep_build_dir=True)
+            self.assertTrue(os.path.exists(stale_path))
+            call_command("mergebuild", *shard_dirs, build_dir=merged_dir)
+            self.assertFalse(os.path.exists(stale_path))
+            self.assertTrue(os.path.exists(os.path.join(merged_dir, 'robots.txt')))
+
+            for shard in ('0/3', '4/3', 'three'):
+                with self.assertRaises(CommandError):
+                    call_command("build", shard=shard, build_dir=os.path.join(tmp, 'bad'))
+
+    def test_build_view_shard(self):
+        from unittest import mock
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        cmd = BuildCommand()
+        cmd.verbosity = 0
+
+        # Each shard reads every primary key, but only loads its own objects
+        built = []
+        with mock.patch.object(MockDetailView, 'build_object', autospec=True) as build_object:
+            for i in range(3):
+                with CaptureQueriesContext(connection) as queries:
+                    cmd.build_view('bakery.tests.MockDetailView', (i, 3))
+                self.assertLessEqual(len(queries), 2)
+                built.append(set(call[0][1].pk for call in build_object.call_args_list))
+                build_object.reset_mock()
+        self.assertEqual(set.union(*built), set(MockObject.objects.values_list('pk', flat=True)))
+        self.assertEqual(sum(len(b) for b in built), MockObject.objects.count())
+
+        # A view that builds its queryset its own way is built whole by one shard
+        calls = []
+
+        class CustomDetailView(MockDetailView):
+            def build_queryset(self):
+                calls.append(self)
+
+        for i in range(3):
+            cmd.build_view(CustomDetailView, (i, 3))
+        self.assertEqual(len(calls), 1)
+
     def test_unbuild_cmd(self):
         call_command("unbuild")
 
@@ -484,6 +743,277 @@ class BakeryTest(TestCase):
             call_command("publish", no_delete=True, force=True)
             call_command("publish", aws_bucket_prefix='my-branch')
 
+    def test_publish_prefix(self):
+        with mock_aws():
+            self._create_bucket()
+            call_command("build")
+            s3_client, s3_resource = get_s3_client()
+            with open(os.path.join(settings.BUILD_DIR, 'robots.txt'), 'rb') as f:
+                s3_resource.Object(settings.AWS_BUCKET_NAME, 'www/robots.txt').put(Body=f.read())
+            s3_resource.Object(settings.AWS_BUCKET_NAME, 'www/stale.html').put(Body='Stale')
+            s3_resource.Object(settings.AWS_BUCKET_NAME, 'outside.html').put(Body='Outside')
+
+            # Every file goes under the prefix, and only keys under it are touched
+            out = six.StringIO()
+            call_command("publish", targets=["bucket=%s,prefix=www" % settings.AWS_BUCKET_NAME], stdout=out)
+            self.assertNotIn("Uploading %s" % os.path.join(settings.BUILD_DIR, 'robots.txt'), out.getvalue())
+            keys = set(o.get('Key') for o in self._get_bucket_objects())
+            local_keys = set(f.key for f in scan_directory(settings.BUILD_DIR))
+            self.assertEqual(keys, set('www/' + k for k in local_keys) | {'outside.html'})
+
+            # And they're compared with the build directory without it
+            out = six.StringIO()
+            call_command("publish", aws_bucket_prefix='www/', stdout=out)
+            self.assertIn("0 uploaded and 0 deleted", out.getvalue())
+
+    def test_publish_resume(self):
+        with mock_aws():
+            self._create_bucket()
+            call_command("build")
+            s3_client, s3_resource = get_s3_client()
+            s3_resource.Object(settings.AWS_BUCKET_NAME, 'stale.html').put(Body='Stale')
+            s3_resource.Object(settings.AWS_BUCKET_NAME, 'also-stale.html').put(Body='Stale')
+
+            # Leave a journal behind as if a publish died partway through
+            journal_path = os.path.join(settings.BUILD_DIR, '..', 'test-publish.journal')
+            journal = PublishJournal(journal_path, {
+                'bucket': settings.AWS_BUCKET_NAME,
+                'prefix': '',
+                'build_dir': os.path.abspath(str(settings.BUILD_DIR)),
+            })
+            journal.start(
+                [
+                    ('robots.txt', os.path.join(settings.BUILD_DIR, 'robots.txt')),
+                    ('favicon.ico', os.path.join(settings.BUILD_DIR, 'favicon.ico')),
+                ],
+                ['stale.html', 'also-stale.html']
+            )
+            journal.record_upload('favicon.ico')
+            journal.record_deletes(['also-stale.html'])
+            journal.close()
+
+            out = six.StringIO()
+            call_command("publish", resume=True, journal=journal_path, stdout=out)
+            self.assertIn("Resuming publish with 1 uploads and 1 deletes remaining", out.getvalue())
+            keys = set(o.get('Key') for o in self._get_bucket_objects())
+            # Only the unfinished work is done, without listing or comparing again
+            self.assertEqual(keys, set(['robots.txt', 'also-stale.html']))
+            self.assertFalse(os.path.exists(journal_path))
+
+            # With nothing to resume it starts from scratch
+            out = six.StringIO()
+            call_command("publish", resume=True, journal=journal_path, stdout=out)
+            self.assertIn("No interrupted publish to resume", out.getvalue())
+            keys = set(o.get('Key') for o in self._get_bucket_objects())
+            self.assertIn('static/foo.bar', keys)
+            self.assertNotIn('also-stale.html', keys)
+
+    def test_publish_pipeline_error(self):
+        with mock_aws():
+            self._create_bucket()
+            call_command("build")
+            s3_client, s3_resource = get_s3_client()
+            s3_resource.Object(settings.AWS_BUCKET_NAME, 'stale.html').put(Body='Stale')
+            journal_path = os.path.join(settings.BUILD_DIR, '..', 'test-pipeline.journal')
+
+            uploaded = []
+
+            class BrokenCommand(PublishCommand):
+                broken = True
+
+                def upload_to_s3(self, key, filename):
+                    if self.broken and key == 'robots.txt':
+                        raise IOError("Upload failed")
+                    super(BrokenCommand, self).upload_to_s3(key, filename)
+                    uploaded.append(key)
+
+            # A failed upload stops the pipeline before anything is deleted
+            with self.assertRaises(IOError):
+                call_command(BrokenCommand(), journal=journal_path, workers=2)
+            keys = set(o.get('Key') for o in self._get_bucket_objects())
+            self.assertIn('stale.html', keys)
+            self.assertNotIn('robots.txt', keys)
+
+            # The plan was never finished, but what was uploaded is known
+            journal = PublishJournal(journal_path, {
+                'bucket': settings.AWS_BUCKET_NAME,
+                'prefix': '',
+                'build_dir': os.path.abspath(str(settings.BUILD_DIR)),
+            })
+            state = journal.load()
+            journal.close()
+            self.assertFalse(state.planned)
+            self.assertEqual(state.uploaded, set(uploaded))
+            self.assertIn('robots.txt', dict(state.uploads))
+
+            # Resuming finishes the job without uploading anything twice
+            cmd = BrokenCommand()
+            cmd.broken = False
+            out = six.StringIO()
+            call_command(cmd, resume=True, journal=journal_path, workers=2, stdout=out)
+            self.assertIn("already made. Comparing the rest.", out.getvalue())
+            self.assertEqual(len(uploaded), len(set(uploaded)))
+            keys = set(o.get('Key') for o in self._get_bucket_objects())
+            self.assertIn('robots.txt', keys)
+            self.assertNotIn('stale.html', keys)
+            self.assertEqual(keys, set(uploaded))
+            self.assertFalse(os.path.exists(journal_path))
+
+    def test_publish_copy(self):
+        with mock_aws():
+            self._create_bucket()
+            call_command("build")
+            s3_client, s3_resource = get_s3_client()
+            robots_path = os.path.join(settings.BUILD_DIR, 'robots.txt')
+            with open(robots_path, 'rb') as f:
+                robots = f.read()
+            s3_resource.Object(settings.AWS_BUCKET_NAME, 'old/robots.txt').put(Body=robots)
+
+            # The content is copied from its old key, which is then deleted
+            out = six.StringIO()
+            call_command("publish", stdout=out)
+            self.assertIn("Copying %s from old/robots.txt" % robots_path, out.getvalue())
+            self.assertIn("were copied from content already in the bucket", out.getvalue())
+            obj = s3_client.get_object(Bucket=settings.AWS_BUCKET_NAME, Key='robots.txt')
+            self.assertEqual(obj['Body'].read(), robots)
+            self.assertEqual(obj['ContentType'], 'text/plain')
+            keys = set(o.get('Key') for o in self._get_bucket_objects())
+            self.assertNotIn('old/robots.txt', keys)
+
+            # Unless copies are turned off
+            s3_resource.Object(settings.AWS_BUCKET_NAME, 'old/robots.txt').put(Body=robots)
+            s3_client.delete_object(Bucket=settings.AWS_BUCKET_NAME, Key='robots.txt')
+            out = six.StringIO()
+            call_command("publish", no_copy=True, stdout=out)
+            self.assertNotIn("Copying", out.getvalue())
+
+    def test_copy_in_bucket_falls_back(self):
+        class ChangedSourceClient(object):
+            def copy_object(self, **kwargs):
+                raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'CopyObject')
+
+        cmd = PublishCommand()
+        cmd.copy = True
+        cmd.verbosity = 0
+        cmd.aws_bucket_name = 'bucket'
+        cmd.s3_client = ChangedSourceClient()
+        cmd.rate_limiter = RateLimiter(1)
+        cmd.s3_obj_dict = BucketIndex()
+        with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+            f.write(b'User-agent: *')
+            f.flush()
+            cmd.s3_obj_dict.add('old.txt', cmd.get_md5(f.name), os.path.getsize(f.name))
+            # The source changed since it was listed, so it's uploaded instead
+            self.assertFalse(cmd.copy_in_bucket('robots.txt', f.name, {}))
+
+    def test_publish_paths(self):
+        with mock_aws():
+            self._create_bucket()
+            call_command("build")
+            s3_client, s3_resource = get_s3_client()
+            s3_resource.Object(settings.AWS_BUCKET_NAME, 'untouched.html').put(Body='Keep me')
+            s3_resource.Object(settings.AWS_BUCKET_NAME, 'gone/index.html').put(Body='Delete me')
+
+            # Only the listed paths are published, with directories standing
+            # in for their index.html and missing files deleted
+            paths_file = os.path.join(settings.BUILD_DIR, '..', 'test-publish-paths.txt')
+            with open(paths_file, 'w') as f:
+                f.write("robots.txt\n# A comment\n\n/static/foo.bar\ngone/\n")
+            call_command("publish", paths_from=paths_file)
+            keys = set(o.get('Key') for o in self._get_bucket_objects())
+            self.assertEqual(keys, set(['robots.txt', 'static/foo.bar', 'untouched.html']))
+
+            # Unchanged files aren't uploaded again
+            out = six.StringIO()
+            call_command("publish", paths=['robots.txt'], stdout=out)
+            self.assertIn("0 uploaded and 0 deleted", out.getvalue())
+            os.remove(paths_file)
+
+            with self.assertRaises(CommandError):
+                call_command("publish", paths_from=paths_file)
+
+    def test_scan_directory(self):
+        call_command("build")
+        walked = set()
+        for (dirpath, dirnames, filenames) in os.walk(settings.BUILD_DIR):
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                walked.add((
+                    os.path.relpath(path, settings.BUILD_DIR).replace(os.sep, '/'),
+                    os.path.getsize(path)
+                ))
+        scanned = set((f.key, f.size) for f in scan_directory(settings.BUILD_DIR, workers=3))
+        self.assertEqual(scanned, walked)
+
+    def test_publish_compare_size_mismatch(self):
+        cmd = PublishCommand()
+        cmd.build_dir = '/does/not/exist'
+        cmd.force_publish = False
+        cmd.lock = threading.Lock()
+        cmd.update_list = []
+        cmd.upload_queue = None
+        cmd.resumed_plan = {}
+        cmd.resumed_uploads = set()
+        cmd.s3_obj_dict = BucketIndex()
+        cmd.s3_obj_dict.add('foo.html', '"abc"', 10)
+        # A different size marks it as changed without opening the file
+        cmd.compare_local_file('foo.html', size=20)
+        self.assertEqual([k for k, p in cmd.update_list], ['foo.html'])
+        self.assertEqual(len(cmd.s3_obj_dict), 0)
+
+    def test_publish_force_keeps_files(self):
+        with mock_aws():
+            self._create_bucket()
+            call_command("build")
+            call_command("publish")
+            before = set(o.get('Key') for o in self._get_bucket_objects())
+            call_command("publish", force=True)
+            after = set(o.get('Key') for o in self._get_bucket_objects())
+            self.assertEqual(before, after)
+
+    def test_publish_workers(self):
+        with mock_aws():
+            self._create_bucket()
+            call_command("build")
+            call_command("publish", workers=1)
+            call_command("publish", force=True, workers=8)
+            with self.settings(BAKERY_PUBLISH_WORKERS=4):
+                call_command("publish", force=True)
+            with self.assertRaises(CommandError):
+                call_command("publish", workers=-1)
+            with self.assertRaises(CommandError):
+                call_command("publish", workers=0)
+            with self.assertRaises(CommandError):
+                call_command("publish", concurrency=0)
+
+    def test_publish_async_engine(self):
+        # Run against a local S3 stand-in, since aiobotocore
+        # doesn't go through the hooks that mock_aws patches
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=0, verbose=False)
+        server.start()
+        try:
+            host, port = server.get_host_and_port()
+            with self.settings(AWS_S3_ENDPOINT='http://{}:{}'.format(host, port)):
+                self._create_bucket()
+                call_command("build")
+                call_command("publish", engine='async', concurrency=4)
+                keys = set(o.get('Key') for o in self._get_bucket_objects())
+                self.assertIn('robots.txt', keys)
+                self.assertIn('static/foo.bar', keys)
+
+                # Nothing has changed, so nothing should be uploaded
+                out = six.StringIO()
+                call_command("publish", engine='async', stdout=out)
+                self.assertIn("0 uploaded and 0 deleted", out.getvalue())
+
+                # Files missing from the build directory should be removed
+                os.remove(os.path.join(settings.BUILD_DIR, 'robots.txt'))
+                call_command("publish", engine='async')
+                keys = set(o.get('Key') for o in self._get_bucket_objects())
+                self.assertNotIn('robots.txt', keys)
+        finally:
+            server.stop()
+
     def test_unpublish_cmd(self):
         with mock_aws():
             self._create_bucket()
@@ -491,6 +1021,184 @@ class BakeryTest(TestCase):
             call_command("unpublish", verbosity=3)
             self.assertFalse(self._get_bucket_objects())
 
+    def test_publish_coalescing(self):
+        from unittest import mock
+        from bakery import tasks
+        from django.core.cache import cache
+        cache.clear()
+        with mock.patch.object(tasks.publish_pending, 'apply_async') as apply_async, \
+                mock.patch.object(tasks.management, 'call_command') as publish:
+            # Requests within the window share a single publish
+            tasks.schedule_publish()
+            tasks.schedule_publish()
+            self.assertEqual(apply_async.call_count, 1)
+
+            # Only one publish runs at a time
+            cache.add(tasks.PUBLISH_LOCK_KEY, 'someone-else', 60)
+            tasks.publish_pending()
+            self.assertEqual(apply_async.call_count, 2)
+            self.assertFalse(publish.called)
+            cache.delete(tasks.PUBLISH_LOCK_KEY)
+
+            tasks.publish_pending()
+            publish.assert_called_once_with("publish")
+            # There's nothing left to publish
+            tasks.publish_pending()
+            self.assertEqual(publish.call_count, 1)
+
+            # A request after the run schedules another
+            tasks.schedule_publish()
+            self.assertEqual(apply_async.call_count, 3)
+
+            # Lists of paths are merged into a single publish of just those paths
+            tasks.publish_pending()
+            publish.reset_mock()
+            tasks.schedule_publish(set(['a/index.html']))
+            tasks.schedule_publish(set(['b/index.html', 'feed.xml']))
+            tasks.schedule_publish(set())
+            tasks.publish_pending()
+            publish.assert_called_once_with("publish", paths=['a/index.html', 'b/index.html', 'feed.xml'])
+            self.assertEqual(apply_async.call_count, 4)
+
+            # Unless auto publishing is turned off
+            cache.clear()
+            with self.settings(ALLOW_BAKERY_AUTO_PUBLISHING=False):
+                tasks.schedule_publish()
+            self.assertEqual(apply_async.call_count, 4)
+        cache.clear()
+
+    def test_publish_pending_failure(self):
+        from unittest import mock
+        from bakery import tasks
+        from django.core.cache import cache
+        cache.clear()
+        with mock.patch.object(tasks.publish_pending, 'apply_async') as apply_async, \
+                mock.patch.object(tasks.management, 'call_command', side_effect=IOError("S3 is down")) as publish:
+            # A failed publish puts its paths back and tries again later
+            tasks.schedule_publish(set(['a/index.html']))
+            tasks.publish_pending()
+            self.assertEqual(cache.get(tasks.PUBLISH_PATHS_KEY), set(['a/index.html']))
+            self.assertEqual(apply_async.call_count, 2)
+            self.assertEqual(apply_async.call_args[1]['countdown'], 60)
+            self.assertFalse(cache.get(tasks.PUBLISH_LOCK_KEY))
+
+            # As does a failed publish of everything
+            tasks.schedule_publish()
+            tasks.publish_pending()
+            self.assertTrue(cache.get(tasks.PUBLISH_PENDING_KEY))
+
+            # And they're published once S3 is back
+            publish.side_effect = None
+            publish.reset_mock()
+            tasks.publish_pending()
+            publish.assert_called_once_with("publish")
+            self.assertIsNone(cache.get(tasks.PUBLISH_PATHS_KEY))
+            self.assertIsNone(cache.get(tasks.PUBLISH_PENDING_KEY))
+        cache.clear()
+
+    def test_build_database(self):
+        from unittest import mock
+        from bakery import tasks
+        from django.db import connections
+        from django.test.utils import CaptureQueriesContext
+        self.assertEqual(MockObject.objects.all().db, 'default')
+        with views.base.build_database('replica'):
+            self.assertEqual(MockObject.objects.all().db, 'replica')
+            # Writes are left alone
+            self.assertEqual(MockObject.objects.all()._chain()._for_write, False)
+            with views.base.build_database(None):
+                self.assertEqual(MockObject.objects.all().db, 'replica')
+        self.assertEqual(MockObject.objects.all().db, 'default')
+        with self.assertRaises(ImproperlyConfigured):
+            with views.base.build_database('nope'):
+                pass
+
+        # The replica is another connection to the test database, so let it
+        # see the data the test case hasn't committed
+        with connections['replica'].cursor() as cursor:
+            cursor.execute("PRAGMA read_uncommitted = true")
+
+        # The build command reads from the alias it's given
+        with CaptureQueriesContext(connections['replica']) as queries:
+            call_command("build", 'bakery.tests.MockDetailView', database='replica', skip_static=True)
+        self.assertTrue(queries.captured_queries)
+        with self.settings(BAKERY_DATABASE='replica'):
+            with CaptureQueriesContext(connections['replica']) as queries:
+                call_command("build", 'bakery.tests.MockDetailView', skip_static=True)
+            self.assertTrue(queries.captured_queries)
+        with self.assertRaises(CommandError):
+            call_command("build", database='nope')
+
+        # Objects are only built from a replica that's caught up with them
+        obj = AutoMockObject.objects.all()[0]
+        self.assertIsNone(tasks.get_build_database(AutoMockObject, obj.pk))
+        with self.settings(BAKERY_DATABASE='replica', BAKERY_DATABASE_LAG_TIMEOUT=0):
+            self.assertEqual(tasks.get_build_database(AutoMockObject, obj.pk), 'replica')
+            with mock.patch('django.db.models.query.QuerySet.first', side_effect=[('new',), ('old',)]):
+                self.assertIsNone(tasks.get_build_database(AutoMockObject, obj.pk))
+
+    def test_build_query_limits(self):
+        from unittest import mock
+        from bakery.management.commands.build import limit_queries, QueryLimiter
+        # Every query goes through the limiter
+        limiter = QueryLimiter(1000)
+        with mock.patch.object(limiter, 'acquire', wraps=limiter.acquire) as acquire:
+            with limit_queries(limiter):
+                list(MockObject.objects.all())
+                MockObject.objects.count()
+        self.assertEqual(acquire.call_count, 2)
+        # And none do outside the block
+        with mock.patch.object(limiter, 'acquire') as acquire:
+            MockObject.objects.count()
+        self.assertFalse(acquire.called)
+
+        # A second's worth of queries can go at once, then they wait their turn
+        limiter = QueryLimiter(10)
+        for i in range(10):
+            self.assertEqual(limiter.delay(), 0)
+        self.assertGreater(limiter.delay(), 0)
+
+        cmd = BuildCommand()
+        self.assertIsNone(cmd.get_query_limiter(None))
+        self.assertEqual(cmd.get_query_limiter(50).queries_per_second, 50)
+        for bad in (0, -1):
+            with self.assertRaises(CommandError):
+                cmd.get_query_limiter(bad)
+
+        with mock.patch('bakery.management.commands.build.limit_queries', wraps=limit_queries) as limit:
+            call_command("build", 'bakery.tests.MockDetailView', skip_static=True, max_queries_per_second=1000)
+            self.assertEqual(limit.call_args[0][0].queries_per_second, 1000)
+            with self.settings(BAKERY_BUILD_MAX_QUERIES_PER_SECOND=300):
+                call_command("build", 'bakery.tests.MockDetailView', skip_static=True)
+            self.assertEqual(limit.call_args[0][0].queries_per_second, 300)
+
+    def test_distributed_build(self):
+        from unittest import mock
+        from bakery import tasks
+        from bakery.management.commands.build import get_shard
+        detail_view = 'bakery.tests.MockDetailView'
+        view_list = [detail_view, 'bakery.tests.MockRedirectView']
+        with mock.patch.object(tasks, 'chord') as chord:
+            tasks.distributed_build(view_list=view_list, shards=3, skip_media=True)
+            header = chord.call_args[0][0]
+            callback = chord.return_value.call_args[0][0]
+            # Static files, a shard for each third of the detail view, and the other view
+            self.assertEqual(len(header), 5)
+            self.assertEqual(header[1].args, (detail_view, (0, 3), None))
+
+            manifests = [sig.apply().get() for sig in header]
+            self.assertIn('robots.txt', manifests[0])
+            keys = set('%s/index.html' % obj.pk for obj in MockObject.objects.all())
+            for i, manifest in enumerate(manifests[1:4]):
+                for key in manifest:
+                    self.assertEqual(get_shard(int(key.split('/')[0]), 3), i)
+            self.assertEqual(set().union(*manifests[1:4]), keys)
+
+            with mock.patch.object(tasks.management, 'call_command') as publish:
+                merged = callback.clone(args=(manifests,)).apply().get()
+            self.assertEqual(merged, sorted(set().union(*manifests)))
+            publish.assert_called_once_with("publish")
+
     # def test_tasks(self):
     #     from bakery import tasks
     #     obj = AutoMockObject.objects.all()[0]
@@ -514,6 +1222,122 @@ class BakeryTest(TestCase):
             document_root=os.path.join(os.path.dirname(__file__), 'static')
         )
 
+    def test_static_views_streaming(self):
+        document_root = tempfile.mkdtemp()
+        content = bytes(range(256)) * 40
+        with open(os.path.join(document_root, 'data.bin'), 'wb') as f:
+            f.write(content)
+
+        def serve(**headers):
+            return static_views.serve(self.factory.get("/data.bin", **headers), 'data.bin', document_root=document_root)
+
+        response = serve()
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), content)
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertNotIn('Content-Disposition', response)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+        response.close()
+
+        # The ETag is checked before the modification date
+        self.assertEqual(serve(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(serve(HTTP_IF_NONE_MATCH='"other", W/%s' % etag).status_code, 304)
+        response = serve(HTTP_IF_NONE_MATCH='"other"', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        # Ranges
+        for header, start, end in (
+            ('bytes=0-9', 0, 9),
+            ('bytes=100-', 100, len(content) - 1),
+            ('bytes=-50', len(content) - 50, len(content) - 1),
+            ('bytes=10000-99999', 10000, len(content) - 1),
+        ):
+            response = serve(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), content[start:end + 1])
+            self.assertEqual(response['Content-Range'], 'bytes %d-%d/%d' % (start, end, len(content)))
+            self.assertEqual(response['Content-Length'], str(end - start + 1))
+            self.assertNotIn('Content-Disposition', response)
+            response.close()
+        response = serve(HTTP_RANGE='bytes=20000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */%d' % len(content))
+        # Malformed headers, several ranges and stale If-Range headers get the whole file
+        for headers in (
+            {'HTTP_RANGE': 'bytes=5-1'},
+            {'HTTP_RANGE': 'bytes=0-1,5-6'},
+            {'HTTP_RANGE': 'lines=1-2'},
+            {'HTTP_RANGE': 'bytes=0-9', 'HTTP_IF_RANGE': '"stale"'},
+        ):
+            response = serve(**headers)
+            self.assertEqual(response.status_code, 200)
+            response.close()
+        response = serve(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        response.close()
+
+    def test_static_views_encoding(self):
+        import gzip
+        document_root = tempfile.mkdtemp()
+        content = b'<html>' + b'hello ' * 2000 + b'</html>'
+        with open(os.path.join(document_root, 'built.html'), 'wb') as f:
+            f.write(gzip.compress(content))
+        with open(os.path.join(document_root, 'plain.js'), 'wb') as f:
+            f.write(b'var a = 1;')
+        with open(os.path.join(document_root, 'plain.js.br'), 'wb') as f:
+            f.write(b'brotli bytes')
+        with open(os.path.join(document_root, 'plain.js.gz'), 'wb') as f:
+            f.write(gzip.compress(b'var a = 1;'))
+
+        def serve(path, **headers):
+            response = static_views.serve(self.factory.get("/" + path, **headers), path, document_root=document_root)
+            body = b''.join(response.streaming_content) if response.streaming else response.content
+            response.close()
+            return response, body
+
+        # Files gzipped by the build are sent as they are to clients that accept it
+        response, body = serve('built.html', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/html')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(body), content)
+        gzip_etag = response['ETag']
+
+        # And decompressed for those that don't
+        for accept in ('', 'identity', 'gzip;q=0, br'):
+            response, body = serve('built.html', HTTP_ACCEPT_ENCODING=accept)
+            self.assertNotIn('Content-Encoding', response)
+            self.assertNotIn('Content-Length', response)
+            self.assertEqual(response['Vary'], 'Accept-Encoding')
+            self.assertEqual(body, content)
+            self.assertNotEqual(response['ETag'], gzip_etag)
+        # Without support for ranges
+        response, body = serve('built.html', HTTP_RANGE='bytes=0-5')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, content)
+
+        # Compressed copies beside a file are picked by what the client accepts
+        response, body = serve('plain.js', HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(body, b'brotli bytes')
+        response, body = serve('plain.js', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), b'var a = 1;')
+        response, body = serve('plain.js', HTTP_ACCEPT_ENCODING='*;q=0.5, br;q=0')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        response, body = serve('plain.js')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(body, b'var a = 1;')
+
+        # Nothing changes for files with no compressed form
+        response, body = serve('plain.js.gz', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+        self.assertNotIn('Vary', response)
+
     def test_cache_control(self):
         with mock_aws():
             s3 = boto3.resource('s3', region_name=settings.AWS_REGION)
@@ -553,6 +1377,16 @@ class BakeryTest(TestCase):
             call_command("unpublish", verbosity=3)
             self.assertFalse(self._get_bucket_objects())
 
+    def test_unpublish_prefix(self):
+        with mock_aws():
+            s3_client, s3_resource = get_s3_client()
+            self._create_bucket()
+            for key in ['keep/1', 'keep/2', 'drop/1', 'drop/2', 'drop/3']:
+                s3_resource.Object(settings.AWS_BUCKET_NAME, key).put(Body=key)
+            call_command("unpublish", prefix='drop/')
+            keys = sorted(o.get('Key') for o in self._get_bucket_objects())
+            self.assertEqual(keys, ['keep/1', 'keep/2'])
+
     def test_get_s3_client_honors_settings_over_environ(self):
         os.environ['AWS_ACCESS_KEY_ID'] = 'env_access'
         os.environ['AWS_SECRET_ACCESS_KEY'] = 'env_secret'
@@ -591,6 +1425,31 @@ class BakeryTest(TestCase):
         self.assertEqual(s3_client.meta.endpoint_url, 'http://example.com')
         self.assertEqual(s3_resource.meta.client._endpoint.host, 'http://example.com')
 
+    @override_settings(AWS_S3_MAX_POOL_CONNECTIONS=25, AWS_S3_RETRY_MODE='adaptive')
+    def test_aws_s3_client_config_can_be_set(self):
+        s3_client, s3_resource = get_s3_client()
+        self.assertEqual(s3_client.meta.config.max_pool_connections, 25)
+        self.assertEqual(s3_client.meta.config.retries['mode'], 'adaptive')
+        s3_client, s3_resource = get_s3_client(max_pool_connections=50, max_attempts=3)
+        self.assertEqual(s3_client.meta.config.max_pool_connections, 50)
+        self.assertEqual(s3_client.meta.config.retries['total_max_attempts'], 4)
+
+    @override_settings(AWS_S3_MULTIPART_THRESHOLD=1024)
+    def test_transfer_config_can_be_set(self):
+        self.assertEqual(get_transfer_config().multipart_threshold, 1024)
+        self.assertEqual(get_transfer_config(multipart_threshold=2048).multipart_threshold, 2048)
+
+    def test_publish_multipart_upload(self):
+        with mock_aws():
+            self._create_bucket()
+            call_command("build")
+            with self.settings(AWS_S3_MULTIPART_THRESHOLD=1):
+                call_command("publish")
+                # Everything went up in parts, so the ETags should still match
+                out = six.StringIO()
+                call_command("publish", stdout=out)
+                self.assertIn("0 uploaded", out.getvalue())
+
     # @mock_s3
     # def test_get_all_objects_in_bucket(self):
     #     s3 = boto3.resource('s3', region_name=settings.AWS_REGION)
@@ -611,25 +1470,265 @@ class BakeryTest(TestCase):
     #     # It works either way though.
     #     self.assertEqual(len(keys), len(all_objects))
 
-    # @mock_s3
-    # def test_batch_delete_s3_objects(self):
-    #     s3_client, s3_resource = get_s3_client()
-    #     self._create_bucket()
-    #     keys = []
-    #     for i in range(0, 33):
-    #         key = str(i)
-    #         obj = s3_resource.Object(settings.AWS_BUCKET_NAME, key)
-    #         obj.put(Body='This is test object %s' % i)
-    #         keys.append(key)
+    def test_batch_delete_s3_objects(self):
+        with mock_aws():
+            s3_client, s3_resource = get_s3_client()
+            self._create_bucket()
+            for i in range(0, 33):
+                obj = s3_resource.Object(settings.AWS_BUCKET_NAME, str(i))
+                obj.put(Body='This is test object %s' % i)
 
-    #     all_objects = self._get_bucket_objects()
-    #     all_keys = [o.get('Key') for o in all_objects]
-    #     batch_delete_s3_objects(
-    #         all_keys,
-    #         settings.AWS_BUCKET_NAME,
-    #         chunk_size=5
-    #     )
-    #     self.assertFalse(self._get_bucket_objects())
+            # Any iterable will do, including a generator
+            all_keys = (o.get('Key') for o in self._get_bucket_objects())
+            deleted = batch_delete_s3_objects(
+                all_keys,
+                settings.AWS_BUCKET_NAME,
+                chunk_size=5,
+                workers=2
+            )
+            self.assertEqual(deleted, 33)
+            self.assertFalse(self._get_bucket_objects())
+
+    def test_batch_delete_s3_objects_retries_errors(self):
+        class FlakyClient(object):
+            calls = []
+
+            def delete_objects(self, Bucket, Delete):
+                keys = [o['Key'] for o in Delete['Objects']]
+                self.calls.append(keys)
+                # Fail the first key the first time it's seen
+                if len(self.calls) == 1:
+                    return {'Errors': [{'Key': keys[0], 'Code': 'InternalError', 'Message': 'Oops'}]}
+                return {}
+
+        client = FlakyClient()
+        deleted = batch_delete_s3_objects(['a', 'b', 'c'], 'bucket', s3_client=client, workers=1)
+        self.assertEqual(deleted, 3)
+        self.assertEqual(client.calls, [['a', 'b', 'c'], ['a']])
+
+    def test_async_delete_chunk_retries_errors(self):
+        import asyncio
+        from ..management.async_publish import AsyncPublisher
+
+        class FlakyClient(object):
+            calls = []
+
+            async def delete_objects(self, Bucket, Delete):
+                keys = [o['Key'] for o in Delete['Objects']]
+                self.calls.append(keys)
+                # Fail the whole request, then the first key, then succeed
+                if len(self.calls) == 1:
+                    raise ClientError({'Error': {'Code': 'InternalError'}}, 'DeleteObjects')
+                if len(self.calls) == 2:
+                    return {'Errors': [{'Key': keys[0], 'Code': 'InternalError', 'Message': 'Oops'}]}
+                return {}
+
+        cmd = PublishCommand()
+        cmd.aws_bucket_name = 'bucket'
+        cmd.lock = threading.Lock()
+        cmd.journal = None
+        cmd.rate_limiter = RateLimiter(8)
+        cmd.deleted_file_list = []
+        publisher = AsyncPublisher(cmd, 4)
+        publisher.client = FlakyClient()
+
+        async def delete():
+            publisher.semaphore = asyncio.Semaphore(4)
+            await publisher.delete_chunk(['a', 'b', 'c'])
+        asyncio.run(delete())
+        self.assertEqual(publisher.client.calls, [['a', 'b', 'c'], ['a', 'b', 'c'], ['a']])
+        self.assertEqual(sorted(cmd.deleted_file_list), ['a', 'b', 'c'])
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(8, cooldown=60)
+        with limiter.request():
+            self.assertEqual(limiter.in_flight, 1)
+        self.assertEqual(limiter.in_flight, 0)
+
+        # Throttles halve the requests in flight, once per cooldown
+        limiter.on_needs_retry(response=(None, {'Error': {'Code': 'SlowDown'}}))
+        self.assertEqual(limiter.limit, 4)
+        limiter.on_needs_retry(response=(None, {'Error': {'Code': 'SlowDown'}}))
+        self.assertEqual(limiter.limit, 4)
+        limiter.on_needs_retry(response=(None, {'Error': {'Code': 'NoSuchKey'}}))
+        limiter.on_needs_retry(response=None)
+        self.assertEqual(limiter.throttles, 2)
+
+        # Requests past the limit wait their turn
+        [limiter.acquire() for i in range(4)]
+        with limiter.condition:
+            self.assertTrue(limiter.delay())
+        # Each one that goes through adds a little back
+        [limiter.release() for i in range(4)]
+        self.assertTrue(4 < limiter.limit < 5)
+
+        # Bytes past the cap wait until they're earned
+        limiter = RateLimiter(8, bytes_per_second=1000)
+        limiter.acquire(2000)
+        with limiter.condition:
+            self.assertTrue(limiter.delay(10) > 0.5)
+        # As do chunks sent by requests already in flight
+        limiter = RateLimiter(8, bytes_per_second=100000)
+        limiter.consume(150000)
+        start = time.monotonic()
+        limiter.consume(10)
+        self.assertTrue(time.monotonic() - start > 0.25)
+
+    def test_publish_metrics(self):
+        with mock_aws():
+            self._create_bucket()
+            call_command("build")
+            metrics_dir = tempfile.mkdtemp()
+            json_path = os.path.join(metrics_dir, 'publish.json')
+            prom_path = os.path.join(metrics_dir, 'publish.prom')
+            call_command("publish", metrics_json=json_path, metrics_prometheus=prom_path)
+
+            with open(json_path) as f:
+                metrics = json.load(f)
+            self.assertTrue(metrics['success'])
+            for phase in ['list', 'walk', 'compare', 'upload', 'post_publish']:
+                self.assertIn(phase, metrics['phases'])
+            uploaded = len(self._get_bucket_objects())
+            self.assertEqual(metrics['counts']['uploaded_files'], uploaded)
+            self.assertTrue(metrics['counts']['bytes_uploaded'] > 0)
+            self.assertEqual(metrics['requests']['PutObject'], uploaded)
+            self.assertEqual(metrics['latency_seconds']['PutObject']['count'], uploaded)
+
+            with open(prom_path) as f:
+                prom = f.read()
+            self.assertIn("bakery_publish_success 1\n", prom)
+            self.assertIn(
+                'bakery_publish_request_duration_seconds_bucket{operation="PutObject",le="+Inf"} %d\n' % uploaded,
+                prom
+            )
+            self.assertIn('bakery_publish_phase_seconds{phase="upload"}', prom)
+
+    def test_publish_targets(self):
+        with self.assertRaises(CommandError):
+            call_command("publish", targets=["prefix=no-bucket"])
+        with self.assertRaises(CommandError):
+            call_command("publish", targets=["bucket=foo,color=blue"])
+
+        with mock_aws():
+            self._create_bucket()
+            s3_client, s3_resource = get_s3_client(region_name='us-west-2')
+            s3_resource.create_bucket(
+                Bucket='other-bucket',
+                CreateBucketConfiguration={'LocationConstraint': 'us-west-2'}
+            )
+            call_command("build")
+
+            hashed = []
+            limiters = []
+
+            class CountingCommand(PublishCommand):
+                def compute_md5(self, filename):
+                    hashed.append(filename)
+                    return super(CountingCommand, self).compute_md5(filename)
+
+                def publish_with_thread_engine(self):
+                    limiters.append(self.rate_limiter)
+                    return super(CountingCommand, self).publish_with_thread_engine()
+
+            # Publish once so the next publish has to hash everything
+            call_command("publish")
+            call_command("publish", aws_bucket_name='other-bucket')
+            call_command(CountingCommand(), targets=[
+                settings.AWS_BUCKET_NAME,
+                "bucket=other-bucket,prefix=,region=us-west-2",
+            ])
+            # Both targets were compared, but each file was only hashed once
+            self.assertTrue(hashed)
+            self.assertEqual(len(hashed), len(set(hashed)))
+            # And they shared one rate limiter, with room for both
+            self.assertEqual(len(limiters), 2)
+            self.assertIs(limiters[0], limiters[1])
+            self.assertEqual(limiters[0].max_in_flight, 2 * PublishCommand.DEFAULT_WORKERS)
+
+            # New files go to both buckets
+            with open(os.path.join(settings.BUILD_DIR, 'new.html'), 'w') as f:
+                f.write('New')
+            out = six.StringIO()
+            call_command("publish", targets=[settings.AWS_BUCKET_NAME, "other-bucket"], stdout=out)
+            self.assertIn("Published to 2 targets", out.getvalue())
+            for bucket in [settings.AWS_BUCKET_NAME, 'other-bucket']:
+                keys = [o['Key'] for o in s3_client.list_objects_v2(Bucket=bucket)['Contents']]
+                self.assertIn('new.html', keys)
+
+    def test_digest_cache(self):
+        cache = DigestCache()
+        calls = []
+
+        def compute(filename):
+            calls.append(filename)
+            return 'digest-%d' % len(calls)
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'foo')
+            f.flush()
+            self.assertEqual(cache.get(f.name, 'md5', compute), 'digest-1')
+            self.assertEqual(cache.get(f.name, 'md5', compute), 'digest-1')
+            self.assertEqual(cache.get(f.name, 'other', compute), 'digest-2')
+            # A changed file is hashed again
+            f.write(b'bar')
+            f.flush()
+            self.assertEqual(cache.get(f.name, 'md5', compute), 'digest-3')
+
+    def test_publish_max_bandwidth(self):
+        with self.assertRaises(CommandError):
+            call_command("publish", max_bandwidth=0)
+        with mock_aws():
+            self._create_bucket()
+            call_command("build")
+            call_command("publish", max_bandwidth=10 * 1024 * 1024)
+            self.assertTrue(self._get_bucket_objects())
+
+            # Large files pay for their bandwidth as each chunk is sent
+            from unittest import mock
+            with open(os.path.join(settings.BUILD_DIR, 'big.bin'), 'wb') as f:
+                f.write(os.urandom(512 * 1024))
+            with self.settings(AWS_S3_MULTIPART_THRESHOLD=256 * 1024):
+                with mock.patch.object(RateLimiter, 'consume', autospec=True) as consume, \
+                        mock.patch.object(RateLimiter, 'request', autospec=True, wraps=RateLimiter.request) as request:
+                    call_command("publish", max_bandwidth=10 * 1024 * 1024)
+            sent = [call[0][1] for call in consume.call_args_list]
+            self.assertEqual(sum(sent), 512 * 1024)
+            # Rather than all at once as the request starts
+            self.assertFalse([call for call in request.call_args_list if call[0][1:] == (512 * 1024,)])
+
+    def test_bucket_index(self):
+        md5 = 'd41d8cd98f00b204e9800998ecf8427e'
+        self.assertEqual(unpack_record(pack_record('"%s"' % md5, 5)), (md5, 5))
+        self.assertEqual(unpack_record(pack_record('"%s-12"' % md5, 5)), (md5 + '-12', 5))
+        self.assertEqual(pack_record('"not-an-md5"', 5), None)
+
+        for threshold in [None, 3]:
+            index = BucketIndex(spill_threshold=threshold)
+            index.add_page({'Contents': [
+                {'Key': 'a.html', 'ETag': '"%s"' % md5, 'Size': 1},
+                {'Key': 'b.html', 'ETag': '"%s-2"' % md5, 'Size': 2},
+                {'Key': 'c.html', 'ETag': '"odd"', 'Size': 3},
+                {'Key': 'd.html', 'ETag': '"%s"' % md5, 'Size': 4},
+            ]})
+            self.assertEqual(index.db is not None, threshold is not None)
+            self.assertEqual(len(index), 4)
+            self.assertTrue('c.html' in index)
+            self.assertEqual(index.pop('b.html'), (md5 + '-2', 2))
+            self.assertEqual(index.pop('c.html'), ('odd', 3))
+            self.assertEqual(index.pop('c.html'), None)
+            self.assertEqual(sorted(index.keys()), ['a.html', 'd.html'])
+
+            # Content stays findable after its key is popped, but only for single-part uploads
+            index.pop('a.html')
+            self.assertEqual(index.find_content(md5, 1), 'a.html')
+            self.assertEqual(index.find_content(md5, 4), 'd.html')
+            self.assertTrue(index.has_size(4))
+            self.assertFalse(index.has_size(2))
+            self.assertEqual(index.find_content(md5, 2), None)
+            db_path = index.db_path
+            index.close()
+            if db_path:
+                self.assertFalse(os.path.exists(db_path))
 
 
 @override_settings(BAKERY_FILESYSTEM='mem://')
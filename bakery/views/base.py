@@ -10,11 +10,16 @@ import six
 import sys
 import gzip
 import logging
+import posixpath
+import threading
 import mimetypes
 from fs import path
+from contextlib import contextmanager
 from django.apps import apps
 from django.conf import settings
+from django.db import connections, router
 from django.utils.encoding import smart_str
+from django.core.exceptions import ImproperlyConfigured
 from bakery import DEFAULT_GZIP_CONTENT_TYPES
 from django.test.client import RequestFactory
 from bakery.management.commands import get_s3_client
@@ -25,6 +30,101 @@ except ImportError:  # Starting with Django 2.0, django.core.urlresolvers does n
     from django.urls import reverse, NoReverseMatch
 logger = logging.getLogger(__name__)
 
+# The sets collecting built paths for each thread
+_recorders = threading.local()
+
+# The database alias builds read from in each thread
+_build_database = threading.local()
+
+
+@contextmanager
+def record_build_paths():
+    """
+    Collects the paths of the files written or removed in the build
+    directory inside the block, relative to it.
+
+    Yields a set that's filled in as the files are built. Blocks can be nested.
+    """
+    paths = set()
+    stack = getattr(_recorders, 'stack', None)
+    if stack is None:
+        stack = _recorders.stack = []
+    stack.append(paths)
+    try:
+        yield paths
+    finally:
+        stack.pop()
+
+
+def record_path(target_path):
+    """
+    Adds the provided path in the build directory to every set being
+    collected by record_build_paths.
+
+    Views call it for each file they write or remove. Call it yourself for
+    files built some other way, like in a model's _build_extra method.
+    """
+    stack = getattr(_recorders, 'stack', None)
+    if not stack:
+        return
+    build_dir = str(settings.BUILD_DIR).rstrip('/') + '/'
+    key = smart_str(target_path)
+    if key.startswith(build_dir):
+        key = key[len(build_dir):]
+    key = posixpath.normpath(key).lstrip('/')
+    for paths in stack:
+        paths.add(key)
+
+
+def record_directory(filesystem, target_dir):
+    """
+    Adds every file under the provided directory of the filesystem to the
+    sets being collected by record_build_paths.
+    """
+    target_dir = smart_str(target_dir)
+    if not getattr(_recorders, 'stack', None) or not filesystem.isdir(target_dir):
+        return
+    for file_path in filesystem.walk.files(target_dir):
+        record_path(file_path)
+
+
+class BuildDatabaseRouter(object):
+    """
+    Sends reads to the database chosen with build_database, in the
+    threads that chose one. Everything else is left to the project's
+    own routers.
+    """
+    def db_for_read(self, model, **hints):
+        return getattr(_build_database, 'alias', None)
+
+
+_build_router = BuildDatabaseRouter()
+
+
+@contextmanager
+def build_database(alias):
+    """
+    Sends every queryset read inside the block, in this thread, to the
+    provided database alias, such as a read replica. Writes still go
+    wherever the project's routers send them.
+
+    Does nothing if the alias is empty.
+    """
+    if not alias:
+        yield
+        return
+    if alias not in connections.databases:
+        raise ImproperlyConfigured("The database %s is not in the DATABASES setting" % alias)
+    # Our router goes ahead of the project's, and defers to them outside of a block
+    if _build_router not in router.routers:
+        router.routers.insert(0, _build_router)
+    previous = getattr(_build_database, 'alias', None)
+    _build_database.alias = alias
+    try:
+        yield
+    finally:
+        _build_database.alias = previous
+
 
 class BuildableMixin(object):
     """
@@ -77,6 +177,14 @@ class BuildableMixin(object):
         with self.fs.open(smart_str(target_path), 'wb') as outfile:
             outfile.write(six.binary_type(html))
             outfile.close()
+        record_path(target_path)
+
+    def remove_directory(self, target_path):
+        """
+        Removes the directory at the provided path and everything inside it.
+        """
+        record_directory(self.fs, target_path)
+        self.fs.removetree(smart_str(target_path))
 
     def is_gzippable(self, path):
         """
@@ -123,6 +231,7 @@ class BuildableMixin(object):
         with self.fs.open(smart_str(target_path), 'wb') as outfile:
             outfile.write(data_buffer.getvalue())
             outfile.close()
+        record_path(target_path)
 
 
 class BuildableTemplateView(TemplateView, BuildableMixin):
@@ -222,20 +331,49 @@ class BuildableRedirectView(RedirectView, BuildableMixin):
             return None
         return url
 
-    def post_publish(self, bucket):
+    def get_upload_extra_args(self):
+        """
+        Returns the extra arguments the publish command should include
+        when it uploads this redirect, keyed by its path in the build directory.
+
+        Setting the WebsiteRedirectLocation header here saves a second
+        request to S3 after the file is uploaded.
+        """
+        return {
+            self.build_path: {'WebsiteRedirectLocation': self.get_redirect_url()}
+        }
+
+    def post_publish(self, bucket, uploads=None, s3_client=None, prefix=''):
+        """
+        Adds the S3 redirect header to the published file.
+
+        The publish command passes in a dict of the keys it uploaded, and the
+        extra arguments they were uploaded with, along with a shared S3 client
+        and the prefix the keys were published under. Redirects that weren't
+        uploaded, or that were uploaded with the header already in place, are skipped.
+        """
+        redirect_url = self.get_redirect_url()
+        if uploads is not None:
+            key = self.build_path.lstrip('/')
+            if key not in uploads:
+                return
+            if uploads[key].get('WebsiteRedirectLocation') == redirect_url:
+                return
         logger.debug("Adding S3 redirect header from {} to in {} to {}".format(
             self.build_path,
             bucket.name,
-            self.get_redirect_url()
+            redirect_url
         ))
-        s3_client, s3_resource = get_s3_client()
+        if s3_client is None:
+            s3_client, s3_resource = get_s3_client()
+        s3_key = prefix + self.build_path.lstrip('/') if prefix else self.build_path
         s3_client.copy_object(
             ACL='public-read',
             Bucket=bucket.name,
             CopySource={
                  'Bucket': bucket.name,
-                 'Key': self.build_path
+                 'Key': s3_key
             },
-            Key=self.build_path,
-            WebsiteRedirectLocation=self.get_redirect_url()
+            Key=s3_key,
+            WebsiteRedirectLocation=redirect_url
         )
@@ -127,7 +127,7 @@ class BuildableYearArchiveView(YearArchiveView, BuildableMixin):
         target_path = os.path.split(self.get_build_path())[0]
         if self.fs.exists(target_path):
             logger.debug("Removing {}".format(target_path))
-            self.fs.removetree(target_path)
+            self.remove_directory(target_path)
 
 
 class BuildableMonthArchiveView(MonthArchiveView, BuildableMixin):
@@ -215,7 +215,7 @@ class BuildableMonthArchiveView(MonthArchiveView, BuildableMixin):
         target_path = os.path.split(self.get_build_path())[0]
         if self.fs.exists(target_path):
             logger.debug("Removing {}".format(target_path))
-            self.fs.removetree(target_path)
+            self.remove_directory(target_path)
 
 
 class BuildableDayArchiveView(DayArchiveView, BuildableMixin):
@@ -324,4 +324,4 @@ class BuildableDayArchiveView(DayArchiveView, BuildableMixin):
         target_path = os.path.split(self.get_build_path())[0]
         if self.fs.exists(target_path):
             logger.debug("Removing {}".format(target_path))
-            self.fs.removetree(target_path)
+            self.remove_directory(target_path)
@@ -79,4 +79,4 @@ set a ``get_absolute_url`` method on the %s model or override the %s view's \
         target_path = os.path.split(self.get_build_path(obj))[0]
         if self.fs.exists(target_path):
             logger.debug("Removing {}".format(target_path))
-            self.fs.removetree(target_path)
+            self.remove_directory(target_path)
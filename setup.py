@@ -58,7 +58,13 @@ class TestCommand(Command):
                     'NAME': 'test.db',
                     'TEST_NAME': 'test.db',
                     'ENGINE': 'django.db.backends.sqlite3'
-                }
+                },
+                # Stands in for a read replica
+                'replica': {
+                    'NAME': 'test.db',
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    'TEST': {'MIRROR': 'default'},
+                },
             },
             INSTALLED_APPS = (
                 'django.contrib.auth',
@@ -156,6 +162,9 @@ setup(
         'boto3>=1.4.4',
         'fs>=2.0.17',
     ],
+    extras_require={
+        'async': ['aiobotocore'],
+    },
     cmdclass={'test': TestCommand},
     setup_requires=["setuptools_scm"],
     use_scm_version={"version_scheme": version_scheme, "local_scheme": local_version},